@@ -1,4 +1,5 @@
 # from __future__ import annotations
+import argparse
 import contextlib
 import datetime
 import json
@@ -37,6 +38,27 @@ SYSTEM_STYLES_DIR = Path("/usr/share/magics/styles/ecmwf")
 log = logging.getLogger("arkimaps")
 
 
+def parse_size(value: str) -> int:
+    """
+    Parse a positive size in bytes, with an optional K, M or G (power of
+    1024) suffix
+    """
+    multipliers = {"k": 1024, "m": 1024**2, "g": 1024**3}
+    value = value.strip()
+    multiplier = multipliers.get(value[-1:].lower())
+    if multiplier is not None:
+        value = value[:-1]
+    else:
+        multiplier = 1
+    try:
+        size = int(float(value) * multiplier)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid size: {value!r}")
+    if size <= 0:
+        raise argparse.ArgumentTypeError(f"size must be positive: {value!r}")
+    return size
+
+
 class LogCollector(logging.Handler):
     def __init__(self, *args, **kw):
         super().__init__(*args, **kw)
@@ -86,8 +108,15 @@ class DefinitionsCommand(Command):
     def __init__(self, *args, **kw):
         super().__init__(*args, **kw)
         self.config = Config()
+        self.configure()
         self.defs = self._create_defs()
 
+    def configure(self) -> None:
+        """
+        Set configuration values from command line arguments
+        """
+        pass
+
     def _create_defs(self) -> Definitions:
         """
         Create and load a Definitions object
@@ -169,8 +198,38 @@ class WorkingKitchenCommand(KitchenCommand):
             action="store_true",
             help="read input as GRIB data instead of arkimet output. Implies --filter=eccodes",
         )
+        parser.add_argument(
+            "--grib-filter",
+            action="store_true",
+            help="with --filter=eccodes, dispatch input by running grib_filter instead of matching it in-process",
+        )
+        parser.add_argument(
+            "--dispatch-open-files",
+            type=int,
+            metavar="N",
+            action="store",
+            help="maximum number of pantry files to keep open while dispatching input. Default: 64",
+        )
+        parser.add_argument(
+            "--dispatch-jobs",
+            type=int,
+            metavar="N",
+            action="store",
+            help="number of threads used to match input messages while dispatching. Default: 1",
+        )
         return parser
 
+    def configure(self) -> None:
+        super().configure()
+        if self.args.dispatch_open_files is not None:
+            if self.args.dispatch_open_files < 1:
+                raise Fail("--dispatch-open-files must be at least 1")
+            self.config.dispatch_max_open_files = self.args.dispatch_open_files
+        if self.args.dispatch_jobs is not None:
+            if self.args.dispatch_jobs < 1:
+                raise Fail("--dispatch-jobs must be at least 1")
+            self.config.dispatch_jobs = self.args.dispatch_jobs
+
     def create_kitchen(self) -> WorkingKitchen:
         return self.make_kitchen()
 
@@ -178,7 +237,9 @@ class WorkingKitchenCommand(KitchenCommand):
         if self.args.grib or self.args.filter == "eccodes":
             from arkimapslib.kitchen import EccodesKitchen
 
-            return EccodesKitchen(definitions=self.defs, workdir=workdir, grib_input=self.args.grib)
+            return EccodesKitchen(
+                definitions=self.defs, workdir=workdir, grib_input=self.args.grib, grib_filter=self.args.grib_filter
+            )
         elif self.args.filter == "arkimet":
             from arkimapslib.kitchen import ArkimetKitchen
 
@@ -250,6 +311,83 @@ class RenderCommand(WorkingKitchenCommand):
             action="store",
             help="write rendered output to the given file. Default: write to stdout",
         )
+        parser.add_argument(
+            "--derived-jobs",
+            type=int,
+            metavar="N",
+            action="store",
+            help="number of derived inputs to generate in parallel. Default: the number of available CPUs",
+        )
+        parser.add_argument(
+            "--derived-instant-jobs",
+            type=int,
+            metavar="N",
+            action="store",
+            help="number of instants of each derived input to generate in parallel."
+            " Default: the number of available CPUs, divided by the number of derived inputs generated in parallel",
+        )
+        parser.add_argument(
+            "--grib-cache",
+            type=Path,
+            metavar="dir",
+            action="store",
+            help="cache decoded GRIB values shared by derived inputs in this directory, and reuse them in later runs",
+        )
+        parser.add_argument(
+            "--render-jobs",
+            type=int,
+            metavar="N",
+            action="store",
+            help="number of render scripts to run in parallel. Default: the number of available CPUs",
+        )
+        parser.add_argument(
+            "--render-memory",
+            type=parse_size,
+            metavar="size",
+            action="store",
+            help="do not start new render scripts if their estimated memory use would exceed this size"
+            " (accepts K, M, G suffixes). Default: no limit",
+        )
+        parser.add_argument(
+            "--render-max-pending",
+            type=parse_size,
+            metavar="size",
+            action="store",
+            help="pause rendering while rendered images waiting to be added to the output exceed this size"
+            " (accepts K, M, G suffixes). Default: 256M",
+        )
+        parser.add_argument(
+            "--render-bundle-jobs",
+            type=int,
+            metavar="N",
+            action="store",
+            help="number of threads preparing rendered images for the output, like slicing and encoding tiles."
+            " Default: the number of available CPUs",
+        )
+        parser.add_argument(
+            "--render-cache",
+            type=Path,
+            metavar="dir",
+            action="store",
+            help="cache rendered images in this directory, and reuse them in later runs"
+            " when inputs and recipes have not changed",
+        )
+        parser.add_argument(
+            "--render-history",
+            type=Path,
+            metavar="file",
+            action="append",
+            help="output bundle or products.json of a previous run, used to estimate rendering costs."
+            " Can be given multiple times",
+        )
+        parser.add_argument(
+            "--tile-group-time",
+            type=float,
+            metavar="seconds",
+            action="store",
+            help="with --render-history, size groups of tiles rendered together so that each takes about this time"
+            " to render. Default: render groups of a fixed size",
+        )
 
         return parser
 
@@ -263,6 +401,39 @@ class RenderCommand(WorkingKitchenCommand):
         root_logger = logging.getLogger()
         root_logger.addHandler(self.log_collector)
 
+    def configure(self) -> None:
+        super().configure()
+        if self.args.derived_jobs is not None:
+            if self.args.derived_jobs < 1:
+                raise Fail("--derived-jobs must be at least 1")
+            self.config.derived_jobs = self.args.derived_jobs
+        if self.args.derived_instant_jobs is not None:
+            if self.args.derived_instant_jobs < 1:
+                raise Fail("--derived-instant-jobs must be at least 1")
+            self.config.derived_instant_jobs = self.args.derived_instant_jobs
+        if self.args.grib_cache is not None:
+            self.config.grib_cache_dir = self.args.grib_cache
+        if self.args.render_jobs is not None:
+            if self.args.render_jobs < 1:
+                raise Fail("--render-jobs must be at least 1")
+            self.config.render_jobs = self.args.render_jobs
+        if self.args.render_memory is not None:
+            self.config.render_memory_budget = self.args.render_memory
+        if self.args.render_max_pending is not None:
+            self.config.render_max_pending_bytes = self.args.render_max_pending
+        if self.args.render_bundle_jobs is not None:
+            if self.args.render_bundle_jobs < 1:
+                raise Fail("--render-bundle-jobs must be at least 1")
+            self.config.render_bundle_jobs = self.args.render_bundle_jobs
+        if self.args.render_cache is not None:
+            self.config.render_cache_dir = self.args.render_cache
+        if self.args.render_history:
+            self.config.render_history = self.args.render_history
+        if self.args.tile_group_time is not None:
+            if self.args.tile_group_time <= 0:
+                raise Fail("--tile-group-time must be positive")
+            self.config.tile_group_time_ns = int(self.args.tile_group_time * 1_000_000_000)
+
     def get_styles_directory(self) -> Path:
         """
         Return the directory where Magics styles are stored
@@ -288,10 +459,11 @@ class RenderCommand(WorkingKitchenCommand):
         """
         Render all recipes for which inputs are available, into a tarball
         """
-        orders: List[Order] = []
-        for flavour in self.flavours:
-            # List of products that should be rendered
-            orders += self.kitchen.make_orders(flavour=flavour)
+        # Generate derived inputs in advance, in parallel
+        self.kitchen.generate_derived(self.flavours)
+
+        # List of products that should be rendered
+        orders: List[Order] = self.kitchen.make_orders_for_flavours(self.flavours)
 
         # Prepare input summary after we're done with input processing
         input_summary = outputbundle.InputSummary()
@@ -324,6 +496,7 @@ class RenderCommand(WorkingKitchenCommand):
         """
         Print a list of operations that would be done during rendering
         """
+        self.kitchen.generate_derived(self.flavours)
         for flavour in self.flavours:
             # List of products that should be rendered
             orders = self.kitchen.make_orders(flavour=flavour)
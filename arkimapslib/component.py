@@ -34,9 +34,15 @@ class Component(Generic[SPEC], ABC):
         if not hasattr(cls, "Spec"):
             raise InvalidComponentError(f"Component class {cls.__name__} is not abstract but lacks a Spec member")
 
-    def __init__(self, *, config: "Config", name: str, defined_in: str, args: Dict[str, Any]) -> None:
+    def __init__(
+        self, *, config: "Config", name: str, defined_in: str, args: Dict[str, Any], spec: Optional[SPEC] = None
+    ) -> None:
         """
-        Common initialization for all components
+        Common initialization for all components.
+
+        If spec is given, it is used instead of parsing args, and it is
+        expected to be a validated version of args not shared with other
+        components
         """
         # Configuration for this run
         self.config = config
@@ -45,7 +51,7 @@ class Component(Generic[SPEC], ABC):
         # File name where this component was defined
         self.defined_in = defined_in
         # Input data that defines the component
-        self.spec = self.Spec(**args)
+        self.spec = spec if spec is not None else self.Spec(**args)
 
 
 class TypeRegistry(Generic[ROOT]):
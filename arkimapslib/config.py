@@ -1,7 +1,7 @@
 # from __future__ import annotations
 
 from pathlib import Path
-from typing import List
+from typing import List, Optional
 
 
 class Config:
@@ -16,5 +16,51 @@ class Config:
         self.tile_group_width: int = 8
         # Height of tile-of-tiles grouped rendering (in number of tiles)
         self.tile_group_height: int = 8
+        # Target render time, in nanoseconds, of a group of tiles rendered
+        # together. If set, and render_history has statistics for a recipe,
+        # tile groups are sized by estimated cost instead of
+        # tile_group_width and tile_group_height
+        self.tile_group_time_ns: Optional[int] = None
+        # Maximum number of tiles in a group sized by estimated cost
+        self.tile_group_max_tiles: int = 128
+        # Number of threads used to match input messages while dispatching
+        self.dispatch_jobs: int = 1
+        # Maximum number of pantry files kept open while dispatching input
+        self.dispatch_max_open_files: int = 64
+        # Size in bytes of the write buffer of each pantry file while
+        # dispatching input
+        self.dispatch_buffer_size: int = 1024 * 1024
+        # Maximum number of derived inputs to generate in parallel (None:
+        # number of CPUs available to this process)
+        self.derived_jobs: Optional[int] = None
+        # Maximum number of instants of a single derived input to generate in
+        # parallel (None: the number of CPUs available to this process, divided
+        # by the number of derived inputs generated in parallel)
+        self.derived_instant_jobs: Optional[int] = None
+        # Memory, in bytes, used to keep decoded GRIB values shared by derived
+        # inputs
+        self.grib_cache_memory: int = 512 * 1024 * 1024
+        # Directory where decoded GRIB values are cached across runs (None: do
+        # not cache)
+        self.grib_cache_dir: Optional[Path] = None
+        # Maximum number of render scripts to run in parallel (None: number of
+        # CPUs available to this process)
+        self.render_jobs: Optional[int] = None
+        # Estimated memory, in bytes, that parallel rendering should not exceed
+        # (None: no limit)
+        self.render_memory_budget: Optional[int] = None
+        # Size in bytes of rendered images that can wait to be added to the
+        # output bundle before rendering is paused (None: no limit)
+        self.render_max_pending_bytes: Optional[int] = 256 * 1024 * 1024
+        # Number of threads preparing rendered images for the output bundle,
+        # like slicing and encoding tiles (None: number of CPUs available to
+        # this process)
+        self.render_bundle_jobs: Optional[int] = None
+        # Output bundles or products.json files of previous runs, used to
+        # estimate rendering costs
+        self.render_history: List[Path] = []
+        # Directory where rendered images are cached across runs (None: do not
+        # cache)
+        self.render_cache_dir: Optional[Path] = None
         # Directories where static files are looked up
         self.static_dir: List[Path] = [(Path(__file__).parent / "static").absolute()]
@@ -0,0 +1,150 @@
+# from __future__ import annotations
+import functools
+import json
+import logging
+import math
+import tarfile
+import zipfile
+from pathlib import Path
+from typing import TYPE_CHECKING, Dict, Optional, Tuple
+
+from . import outputbundle
+
+if TYPE_CHECKING:
+    from .config import Config
+    from .orders import Order
+
+log = logging.getLogger("costs")
+
+
+class CostModel:
+    """
+    Render cost of each recipe and flavour, learnt from the products.json
+    statistics of previous runs
+    """
+
+    def __init__(self) -> None:
+        # Total render time in nanoseconds, by (flavour, recipe)
+        self.time_ns: Dict[outputbundle.ProductKey, int] = {}
+        # Total number of products rendered, by (flavour, recipe)
+        self.count: Dict[outputbundle.ProductKey, int] = {}
+
+    def __bool__(self) -> bool:
+        return bool(self.count)
+
+    def add_products(self, products: outputbundle.Products) -> None:
+        """
+        Add render statistics from the products information of an output
+        bundle
+        """
+        for key, recipe_products in products.products.items():
+            for reftime_products in recipe_products.reftimes.values():
+                count = len(reftime_products.products) - reftime_products.render_stats.cached
+                if count <= 0:
+                    continue
+                self.time_ns[key] = self.time_ns.get(key, 0) + reftime_products.render_stats.time_ns
+                self.count[key] = self.count.get(key, 0) + count
+
+    def load(self, path: Path) -> None:
+        """
+        Add render statistics from an output bundle, or from its products.json
+        """
+        if zipfile.is_zipfile(path):
+            reader: outputbundle.Reader = outputbundle.ZipReader(path)
+        elif tarfile.is_tarfile(path):
+            reader = outputbundle.TarReader(path)
+        else:
+            with path.open("rt") as fd:
+                self.add_products(outputbundle.Products.from_jsonable(json.load(fd)))
+            return
+
+        with reader:
+            self.add_products(reader.products())
+
+    def product_cost(self, flavour: str, recipe: str) -> Optional[float]:
+        """
+        Return the average render time of one product, in nanoseconds, or None
+        if there is no history for this flavour and recipe
+        """
+        key = outputbundle.ProductKey(flavour, recipe)
+        count = self.count.get(key)
+        if not count:
+            return None
+        return self.time_ns[key] / count
+
+    def average_product_cost(self) -> float:
+        """
+        Return the average render time of one product across all recipes, in
+        nanoseconds
+        """
+        count = sum(self.count.values())
+        if not count:
+            return 0.0
+        return sum(self.time_ns.values()) / count
+
+    def order_cost(self, order: "Order") -> float:
+        """
+        Estimate the render time of an order, in nanoseconds
+        """
+        cost = self.product_cost(order.flavour.name, order.recipe.name)
+        if cost is None:
+            cost = self.average_product_cost()
+        return cost * order.product_count()
+
+
+@functools.lru_cache(maxsize=4)
+def load_cost_model(paths: Tuple[Path, ...]) -> Optional[CostModel]:
+    """
+    Load render statistics from the output bundles or products.json files of
+    previous runs, or return None if no paths are given.
+
+    Results are cached, so that they can be shared by planning and rendering
+    """
+    if not paths:
+        return None
+    cost_model = CostModel()
+    for path in paths:
+        cost_model.load(path)
+    return cost_model
+
+
+def tile_group_sizes(
+    config: "Config", flavour: str, recipe: str, tiles_by_zoom: Dict[int, int]
+) -> Dict[int, Tuple[int, int]]:
+    """
+    Return the width and height, in tiles, of the groups of tiles rendered
+    together for each zoom level of a tileset, given the number of tiles
+    rendered at each zoom level.
+
+    Without a target render time, or without render history for this flavour
+    and recipe, the configured tile_group_width and tile_group_height are used
+    """
+    default = (config.tile_group_width, config.tile_group_height)
+    tile_cost: Optional[float] = None
+    if config.tile_group_time_ns is not None and tiles_by_zoom:
+        cost_model = load_cost_model(tuple(config.render_history))
+        if cost_model is not None:
+            tile_cost = cost_model.product_cost(flavour, recipe)
+    if not tile_cost:
+        return {z: default for z in tiles_by_zoom}
+
+    # Each zoom level covers the same area and data, so rendering a zoom level
+    # is assumed to take the same time regardless of its number of tiles: the
+    # average cost of a tile is spread accordingly
+    average_tiles = sum(tiles_by_zoom.values()) / len(tiles_by_zoom)
+    res: Dict[int, Tuple[int, int]] = {}
+    for z, count in tiles_by_zoom.items():
+        cost = tile_cost * average_tiles / max(count, 1)
+        tiles = min(max(int(config.tile_group_time_ns / cost), 1), config.tile_group_max_tiles)
+        side = max(int(math.sqrt(tiles)), 1)
+        res[z] = (side, side)
+        log.debug(
+            "%s/%s: zoom %d: estimated %.0fns per tile, rendering %dx%d tiles together",
+            flavour,
+            recipe,
+            z,
+            cost,
+            side,
+            side,
+        )
+    return res
@@ -0,0 +1,192 @@
+# from __future__ import annotations
+import re
+from typing import Any, Callable, Dict, Iterator, Optional, Tuple, Union
+
+import eccodes
+
+# Tokens of grib_filter conditions
+re_token = re.compile(
+    r"""\s*(?:
+        (?P<string>"[^"]*"|'[^']*')
+      | (?P<number>-?\d+(?:\.\d*)?(?:[eE][-+]?\d+)?)
+      | (?P<op>==|!=|<=|>=|<|>|!|\(|\))
+      | (?P<word>[A-Za-z_][A-Za-z0-9_.:]*)
+    )""",
+    re.VERBOSE,
+)
+
+Literal = Union[int, float, str]
+
+
+class MessageKeys:
+    """
+    Access keys of a GRIB message, reading each key at most once
+    """
+
+    def __init__(self, gid: int) -> None:
+        self.gid = gid
+        # Values already read, by key name and type
+        self.cache: Dict[Tuple[str, type], Any] = {}
+
+    def get(self, key: str, type_: type) -> Any:
+        """
+        Return the value of a key as int, float or str, or None if the key is
+        missing in the message
+        """
+        cache_key = (key, type_)
+        try:
+            return self.cache[cache_key]
+        except KeyError:
+            pass
+
+        value: Any
+        try:
+            if type_ is int:
+                value = eccodes.codes_get_long(self.gid, key)
+            elif type_ is float:
+                value = eccodes.codes_get_double(self.gid, key)
+            else:
+                value = eccodes.codes_get_string(self.gid, key)
+        except eccodes.GribInternalError:
+            value = None
+        self.cache[cache_key] = value
+        return value
+
+
+Matcher = Callable[[MessageKeys], bool]
+
+COMPARISONS: Dict[str, Callable[[Any, Any], bool]] = {
+    "==": lambda a, b: a == b,
+    "!=": lambda a, b: a != b,
+    "<": lambda a, b: a < b,
+    "<=": lambda a, b: a <= b,
+    ">": lambda a, b: a > b,
+    ">=": lambda a, b: a >= b,
+}
+
+
+class Parser:
+    """
+    Compile a grib_filter condition into a Python function.
+
+    This supports the subset of the grib_filter language used in input
+    definitions: comparisons between a key and a literal with ``==``, ``!=``,
+    ``<``, ``<=``, ``>``, ``>=`` and ``is``, combined with ``and``, ``or``,
+    ``not``/``!`` and parentheses.
+    """
+
+    def __init__(self, expr: str) -> None:
+        self.expr = expr
+        self.tokens = list(self.tokenize(expr))
+        self.pos = 0
+
+    def tokenize(self, expr: str) -> Iterator[Tuple[str, str]]:
+        pos = 0
+        expr = expr.rstrip()
+        while pos < len(expr):
+            mo = re_token.match(expr, pos)
+            if mo is None or mo.end() == pos:
+                raise RuntimeError(f"{expr!r}: cannot parse filter at {expr[pos:]!r}")
+            assert mo.lastgroup is not None
+            yield mo.lastgroup, mo.group(mo.lastgroup)
+            pos = mo.end()
+
+    def peek(self) -> Optional[Tuple[str, str]]:
+        if self.pos >= len(self.tokens):
+            return None
+        return self.tokens[self.pos]
+
+    def next(self) -> Tuple[str, str]:
+        token = self.peek()
+        if token is None:
+            raise RuntimeError(f"{self.expr!r}: unexpected end of filter")
+        self.pos += 1
+        return token
+
+    def accept(self, *values: str) -> Optional[str]:
+        token = self.peek()
+        if token is None or token[0] not in ("op", "word") or token[1] not in values:
+            return None
+        self.pos += 1
+        return token[1]
+
+    def parse(self) -> Matcher:
+        res = self.parse_or()
+        token = self.peek()
+        if token is not None:
+            raise RuntimeError(f"{self.expr!r}: unexpected {token[1]!r} in filter")
+        return res
+
+    def parse_or(self) -> Matcher:
+        terms = [self.parse_and()]
+        while self.accept("or"):
+            terms.append(self.parse_and())
+        if len(terms) == 1:
+            return terms[0]
+        return lambda keys: any(term(keys) for term in terms)
+
+    def parse_and(self) -> Matcher:
+        terms = [self.parse_not()]
+        while self.accept("and"):
+            terms.append(self.parse_not())
+        if len(terms) == 1:
+            return terms[0]
+        return lambda keys: all(term(keys) for term in terms)
+
+    def parse_not(self) -> Matcher:
+        if self.accept("not", "!"):
+            term = self.parse_not()
+            return lambda keys: not term(keys)
+        return self.parse_atom()
+
+    def parse_atom(self) -> Matcher:
+        if self.accept("("):
+            res = self.parse_or()
+            if not self.accept(")"):
+                raise RuntimeError(f"{self.expr!r}: missing closing parenthesis in filter")
+            return res
+
+        kind, key = self.next()
+        if kind != "word" or key in ("and", "or", "not", "is"):
+            raise RuntimeError(f"{self.expr!r}: expected a key name instead of {key!r} in filter")
+
+        op = self.accept("is", *COMPARISONS.keys())
+        if op is None:
+            raise RuntimeError(f"{self.expr!r}: expected a comparison after {key!r} in filter")
+
+        value = self.parse_literal()
+        if op == "is":
+            return self.make_comparison(key, "==", str(value), str)
+        return self.make_comparison(key, op, value, type(value))
+
+    def parse_literal(self) -> Literal:
+        kind, value = self.next()
+        if kind == "string":
+            return value[1:-1]
+        elif kind == "number":
+            if re.match(r"^-?\d+$", value):
+                return int(value)
+            return float(value)
+        raise RuntimeError(f"{self.expr!r}: expected a value instead of {value!r} in filter")
+
+    def make_comparison(self, key: str, op: str, value: Literal, type_: type) -> Matcher:
+        compare = COMPARISONS[op]
+
+        def match(keys: MessageKeys) -> bool:
+            # Comparisons with keys missing in the message never match
+            actual = keys.get(key, type_)
+            if actual is None:
+                return False
+            return compare(actual, value)
+
+        return match
+
+
+def compile_filter(expr: str) -> Matcher:
+    """
+    Compile a grib_filter condition into a function that matches
+    MessageKeys.
+
+    Raises RuntimeError if the condition cannot be parsed
+    """
+    return Parser(expr).parse()
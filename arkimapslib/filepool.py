@@ -0,0 +1,142 @@
+# from __future__ import annotations
+import errno
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import BinaryIO, Callable, Set, Union
+
+
+class FilePool:
+    """
+    Pool of buffered files open for appending, used to dispatch data into the
+    pantry without opening and closing a file for each message.
+
+    When more than ``max_open`` files are open, the least recently used one is
+    closed.
+    """
+
+    def __init__(self, max_open: int = 64, buffer_size: int = 1024 * 1024) -> None:
+        self.max_open = max_open
+        self.buffer_size = buffer_size
+        # Open files, from the least to the most recently used
+        self.files: "OrderedDict[Path, BinaryIO]" = OrderedDict()
+        # Files created by this pool
+        self.created: Set[Path] = set()
+        # Lock protecting the pool, for dispatching in multiple threads
+        self.lock = threading.Lock()
+        # Kernel-side copy functions that still need to be tried
+        self.use_copy_file_range = hasattr(os, "copy_file_range")
+        self.use_sendfile = hasattr(os, "sendfile")
+
+    def _get(self, path: Path, truncate: bool) -> BinaryIO:
+        """
+        Return the open file for path, opening it if needed
+        """
+        out = self.files.get(path)
+        if out is not None:
+            self.files.move_to_end(path)
+            return out
+
+        while len(self.files) >= self.max_open:
+            old_path, old_out = self.files.popitem(last=False)
+            old_out.close()
+
+        # Truncate existing files only the first time they are written.
+        # Files are not opened with O_APPEND, which would prevent copying
+        # data with copy_file_range
+        flags = os.O_WRONLY | os.O_CREAT
+        if truncate and path not in self.created:
+            flags |= os.O_TRUNC
+        fd = os.open(path, flags, 0o666)
+        try:
+            os.lseek(fd, 0, os.SEEK_END)
+            out = open(fd, "wb", buffering=self.buffer_size)
+        except BaseException:
+            os.close(fd)
+            raise
+        self.created.add(path)
+        self.files[path] = out
+        return out
+
+    def write(self, path: Path, data: Union[bytes, Callable[[BinaryIO], None]], truncate: bool = False) -> None:
+        """
+        Append data to a file.
+
+        ``data`` can be a function that writes to the open file, so that
+        callers can write without building an intermediate bytes object.
+
+        If ``truncate`` is True, a file that existed before the pool first
+        opened it is truncated instead of appended to.
+        """
+        with self.lock:
+            out = self._get(path, truncate)
+            if callable(data):
+                data(out)
+            else:
+                out.write(data)
+
+    def copy(self, path: Path, src_fd: int, offset: int, length: int, truncate: bool = False) -> None:
+        """
+        Append a range of bytes from another file to a file.
+
+        The data is copied by the kernel where possible, without going through
+        user space.
+        """
+
+        def write(out: BinaryIO) -> None:
+            out.flush()
+            dst_fd = out.fileno()
+            end = offset + length
+            pos = offset
+            while pos < end:
+                copied = self._copy_range(src_fd, dst_fd, pos, end - pos)
+                if copied == 0:
+                    raise RuntimeError(f"{path}: source data ended {end - pos} bytes before the end of the range")
+                pos += copied
+
+        self.write(path, write, truncate=truncate)
+
+    def _copy_range(self, src_fd: int, dst_fd: int, offset: int, count: int) -> int:
+        """
+        Copy up to count bytes from src_fd at offset to the current position
+        of dst_fd, returning the number of bytes copied
+        """
+        if self.use_copy_file_range:
+            try:
+                return os.copy_file_range(src_fd, dst_fd, count, offset)
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF):
+                    raise
+                self.use_copy_file_range = False
+        if self.use_sendfile:
+            try:
+                return os.sendfile(dst_fd, src_fd, offset, count)
+            except OSError as e:
+                if e.errno not in (errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                    raise
+                self.use_sendfile = False
+        data = os.pread(src_fd, min(count, self.buffer_size), offset)
+        view = memoryview(data)
+        while view:
+            written = os.write(dst_fd, view)
+            view = view[written:]
+        return len(data)
+
+    def flush(self) -> None:
+        """
+        Write all buffered data to disk, keeping files open
+        """
+        with self.lock:
+            for out in self.files.values():
+                out.flush()
+
+    def close(self) -> None:
+        """
+        Close all open files, and forget which files were created
+        """
+        with self.lock:
+            while self.files:
+                path, out = self.files.popitem(last=False)
+                out.close()
+            self.created.clear()
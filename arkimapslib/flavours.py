@@ -3,10 +3,11 @@ from abc import ABC
 import fnmatch
 import logging
 import re
-from typing import TYPE_CHECKING, Any, Dict, List, Optional, Set, Type, cast, TypeVar
+from typing import TYPE_CHECKING, Any, Dict, Iterable, List, Mapping, Optional, Set, Tuple, Type, cast, TypeVar
 
 from . import inputs, orders
 from .config import Config
+from .grib import GRIB
 from .lint import Lint
 from .models import BaseDataModel, pydantic
 from .postprocess import Postprocessor
@@ -179,68 +180,9 @@ class Flavour(RootComponent[SPEC], ABC):
         """
         Scan a recipe and return a set with all the inputs it needs
         """
-        # For each output instant, map inputs names to InputFile structures
-        inputs: Optional[Dict["Instant", Dict[str, "InputFile"]]] = None
-        # Collection of input name to InputFile mappings used by all output steps
-        inputs_for_all_instants: Dict[str, "InputFile"] = {}
-
         input_names = self.get_inputs_for_recipe(recipe)
         log.debug("flavour %s: recipe %s uses inputs: %r", self.name, recipe.name, input_names)
-
-        # Find the intersection of all steps available for all inputs needed
-        for input_name in input_names:
-            # Find available steps for this input
-            output_instants: Dict[Optional["Instant"], "InputFile"]
-            output_instants = pantry.get_instants(input_name)
-
-            # Special handling for inputs that are not step-specific and
-            # are valid for all steps, like maps or orography
-            any_instant = output_instants.pop(None, None)
-            if any_instant is not None:
-                log.debug("flavour %s: recipe %s input %s available for any step", self.name, recipe.name, input_name)
-                inputs_for_all_instants[input_name] = any_instant
-                # This input is valid for all steps and does not
-                # introduce step limitations
-                if not output_instants:
-                    continue
-            elif output_instants:
-                log.debug(
-                    "flavour %s: recipe %s input %s available for instants %s",
-                    self.name,
-                    recipe.name,
-                    input_name,
-                    ", ".join(str(i) for i in output_instants.keys()),
-                )
-            else:
-                log.debug(
-                    "flavour %s: recipe %s input %s not available",
-                    self.name,
-                    recipe.name,
-                    input_name,
-                )
-
-            # Intersect the output instants for the recipe input list
-            if inputs is None:
-                # The first time this output_instant has been seen, populate
-                # the `inputs` mapping with all available inputs
-                inputs = {}
-                for output_instant, ifile in output_instants.items():
-                    # None was popped earlier
-                    assert output_instant is not None
-                    inputs[output_instant] = {input_name: ifile}
-            else:
-                # The subsequent times this output_instant is seen, intersect
-                instants_to_delete: List[Instant] = []
-                for output_instant, input_files in inputs.items():
-                    if output_instant not in output_instants:
-                        # We miss an input for this instant, so we cannot
-                        # generate an order for it
-                        instants_to_delete.append(output_instant)
-                    else:
-                        input_files[input_name] = output_instants[output_instant]
-                for output_instant in instants_to_delete:
-                    del inputs[output_instant]
-
+        inputs, inputs_for_all_instants = find_instants(input_names, pantry)
         return self.inputs_to_orders(recipe, inputs, inputs_for_all_instants)
 
     def inputs_to_orders(
@@ -252,6 +194,73 @@ class Flavour(RootComponent[SPEC], ABC):
         raise NotImplementedError(f"{self.__class__}.inputs_to_orders not implemented")
 
 
+def find_instants(
+    input_names: Iterable[str], pantry: "pantry.DiskPantry"
+) -> Tuple[Optional[Dict["Instant", Dict[str, "InputFile"]]], Dict[str, "InputFile"]]:
+    """
+    Find the instants for which all the given inputs are available.
+
+    Return a dict mapping each instant to the input files to use for it (or
+    None if input_names is empty or only has inputs valid for any instant),
+    and a dict with the input files valid for all instants.
+    """
+    # For each output instant, map inputs names to InputFile structures
+    inputs: Optional[Dict["Instant", Dict[str, "InputFile"]]] = None
+    # Collection of input name to InputFile mappings used by all output steps
+    inputs_for_all_instants: Dict[str, "InputFile"] = {}
+
+    # Find the intersection of all steps available for all inputs needed
+    for input_name in input_names:
+        # Find available steps for this input
+        output_instants: Mapping[Optional["Instant"], "InputFile"]
+        output_instants = pantry.get_instants(input_name)
+
+        # Special handling for inputs that are not step-specific and
+        # are valid for all steps, like maps or orography
+        any_instant = output_instants.get(None)
+        if any_instant is not None:
+            log.debug("input %s available for any step", input_name)
+            inputs_for_all_instants[input_name] = any_instant
+            # This input is valid for all steps and does not
+            # introduce step limitations
+            if len(output_instants) == 1:
+                continue
+            # The result of get_instants is shared and cannot be modified
+            output_instants = {k: v for k, v in output_instants.items() if k is not None}
+        elif output_instants:
+            log.debug(
+                "input %s available for instants %s",
+                input_name,
+                ", ".join(str(i) for i in output_instants.keys()),
+            )
+        else:
+            log.debug("input %s not available", input_name)
+
+        # Intersect the output instants for the recipe input list
+        if inputs is None:
+            # The first time this output_instant has been seen, populate
+            # the `inputs` mapping with all available inputs
+            inputs = {}
+            for output_instant, ifile in output_instants.items():
+                # None was skipped earlier
+                assert output_instant is not None
+                inputs[output_instant] = {input_name: ifile}
+        else:
+            # The subsequent times this output_instant is seen, intersect
+            instants_to_delete: List[Instant] = []
+            for output_instant, input_files in inputs.items():
+                if output_instant not in output_instants:
+                    # We miss an input for this instant, so we cannot
+                    # generate an order for it
+                    instants_to_delete.append(output_instant)
+                else:
+                    input_files[input_name] = output_instants[output_instant]
+            for output_instant in instants_to_delete:
+                del inputs[output_instant]
+
+    return inputs, inputs_for_all_instants
+
+
 class Simple(Flavour[FlavourSpec]):
     Spec = FlavourSpec
 
@@ -281,6 +290,21 @@ class Simple(Flavour[FlavourSpec]):
         return res
 
 
+class TileArea(BaseDataModel):
+    """
+    Geographical area for TileSpec
+    """
+
+    #: minimum latitude
+    lat_min: float
+    #: maximum latitude
+    lat_max: float
+    #: minimum longitude
+    lon_min: float
+    #: maximum longitude
+    lon_max: float
+
+
 class TileSpec(BaseDataModel):
     """
     Tile definition for TiledSpec
@@ -298,6 +322,18 @@ class TileSpec(BaseDataModel):
     lon_min: float
     #: maximum longitude
     lon_max: float
+    #: do not store fully transparent tiles, and store tiles of a single
+    #: colour only once
+    dedup_uniform: bool = False
+    #: render only one zoom level, and build the lower ones by downsampling
+    #: its tiles
+    pyramid: bool = False
+    #: zoom level rendered in pyramid mode (default: zoom_max)
+    pyramid_zoom: Optional[int] = None
+    #: if set, only render groups of tiles that intersect one of these areas
+    mask: Optional[List[TileArea]] = None
+    #: skip groups of tiles outside of the grid of the GRIB inputs of a recipe
+    cull_outside_data: bool = False
 
 
 class TiledSpec(FlavourSpec):
@@ -316,6 +352,19 @@ class Tiled(Flavour[TiledSpec]):
 
     Spec = TiledSpec
 
+    def __init__(
+        self,
+        *,
+        config: Config,
+        name: str,
+        defined_in: str,
+        args: Dict[str, Any],
+    ):
+        super().__init__(config=config, name=name, defined_in=defined_in, args=args)
+        # Area covered by the grid of each GRIB input, as (lon_min, lat_min,
+        # lon_max, lat_max), or None if it could not be read
+        self.grid_areas: Dict["inputs.Input", Optional[Tuple[float, float, float, float]]] = {}
+
     def summarize(self) -> Dict[str, Any]:
         res = super().summarize()
         for name in ("zoom", "lat", "lon"):
@@ -323,6 +372,78 @@ class Tiled(Flavour[TiledSpec]):
             res[f"{name}_max"] = getattr(self.spec.tile, f"{name}_max")
         return res
 
+    def pyramid_zoom(self) -> Optional[int]:
+        """
+        Return the zoom level rendered to build lower zoom levels, or None if
+        all zoom levels are rendered
+        """
+        if not self.spec.tile.pyramid:
+            return None
+        if self.spec.tile.pyramid_zoom is None:
+            return self.spec.tile.zoom_max
+        return self.spec.tile.pyramid_zoom
+
+    def mask(self) -> Optional[List[Tuple[float, float, float, float]]]:
+        """
+        Return the areas where tiles are rendered, as (lon_min, lat_min,
+        lon_max, lat_max) tuples, or None to render all tiles
+        """
+        if self.spec.tile.mask is None:
+            return None
+        return [(area.lon_min, area.lat_min, area.lon_max, area.lat_max) for area in self.spec.tile.mask]
+
+    def grid_area(self, input_file: "inputs.InputFile") -> Optional[Tuple[float, float, float, float]]:
+        """
+        Return the area covered by the grid of a GRIB input, reading it only
+        the first time
+        """
+        try:
+            return self.grid_areas[input_file.info]
+        except KeyError:
+            pass
+
+        area: Optional[Tuple[float, float, float, float]]
+        try:
+            with GRIB(input_file.pathname) as grib:
+                area = grib.bounding_box()
+        except Exception as e:
+            log.warning("%s: cannot read the grid area, rendering all tiles: %s", input_file.pathname, e)
+            area = None
+        else:
+            log.debug("%s: grid covers %s", input_file.info.name, area)
+        self.grid_areas[input_file.info] = area
+        return area
+
+    def data_area(self, input_files: Dict[str, "inputs.InputFile"]) -> Optional[Tuple[float, float, float, float]]:
+        """
+        Return the area covered by the GRIB inputs of an order, as (lon_min,
+        lat_min, lon_max, lat_max), or None if tiles should not be culled
+        """
+        if not self.spec.tile.cull_outside_data:
+            return None
+        areas = []
+        for input_file in input_files.values():
+            if isinstance(input_file.info, inputs.Static):
+                continue
+            area = self.grid_area(input_file)
+            if area is None:
+                return None
+            areas.append(area)
+        if not areas:
+            return None
+        if len(areas) == 1:
+            return areas[0]
+        if any(area[0] > area[2] for area in areas):
+            # The union of longitude ranges crossing the antimeridian is not
+            # worth computing: render all tiles
+            return None
+        return (
+            min(area[0] for area in areas),
+            min(area[1] for area in areas),
+            max(area[2] for area in areas),
+            max(area[3] for area in areas),
+        )
+
     def make_order_for_legend(
         self, recipe: "recipes.Recipe", input_files: Dict[str, "inputs.InputFile"], output_instant: "inputs.Instant"
     ):
@@ -441,6 +562,10 @@ class Tiled(Flavour[TiledSpec]):
                         lon_max=self.spec.tile.lon_max,
                         zoom_min=self.spec.tile.zoom_min,
                         zoom_max=self.spec.tile.zoom_max,
+                        dedup_uniform=self.spec.tile.dedup_uniform,
+                        pyramid_zoom=self.pyramid_zoom(),
+                        mask=self.mask(),
+                        data_area=self.data_area(input_files),
                     )
                 )
 
@@ -1,8 +1,17 @@
 # from __future__ import annotations
+import logging
+import os
+import tempfile
+import threading
+from collections import OrderedDict
 from pathlib import Path
-from typing import TYPE_CHECKING, BinaryIO, Optional, Union
+from typing import TYPE_CHECKING, BinaryIO, Callable, Dict, Iterator, Optional, Tuple, Union
+
+from .utils import file_digest
 
 if TYPE_CHECKING:
+    import mmap
+
     from numpy.typing import NDArray
 
 try:
@@ -12,6 +21,77 @@ try:
 except ModuleNotFoundError:
     HAVE_ECCODES = False
 
+log = logging.getLogger("arkimaps.grib")
+
+
+def new_from_message_headers(data: Union[bytes, memoryview]) -> int:
+    """
+    Create an eccodes handle to read the header keys of a GRIB message,
+    without decoding its data section if the eccodes version allows it
+    """
+    try:
+        return eccodes.codes_new_from_message(data, partial=True)
+    except TypeError:
+        # eccodes-python before partial message support
+        return eccodes.codes_new_from_message(bytes(data))
+
+
+def _message_length(buf: Union[bytes, memoryview, "mmap.mmap"], offset: int) -> Optional[int]:
+    """
+    Read the length of the GRIB message at offset from its indicator section,
+    or return None if it cannot be read
+    """
+    edition = buf[offset + 7]
+    if edition == 1:
+        start, end = offset + 4, offset + 7
+        length = int.from_bytes(buf[start:end], "big")
+        # Large GRIB1 messages encode their length differently
+        if length & 0x800000:
+            return None
+        return length
+    elif edition == 2:
+        start, end = offset + 8, offset + 16
+        return int.from_bytes(buf[start:end], "big")
+    return None
+
+
+def scan_messages(buf: "mmap.mmap", fileobj: BinaryIO) -> Iterator[Tuple[int, int]]:
+    """
+    Find the GRIB messages in a memory mapped file, generating their offset
+    and length.
+
+    Message lengths are read from their indicator section, and checked
+    against the end section. Messages whose length cannot be read this way
+    are scanned with eccodes from fileobj, and data that is not a valid
+    GRIB message is skipped.
+    """
+    pos = 0
+    size = len(buf)
+    while True:
+        offset = buf.find(b"GRIB", pos)
+        if offset == -1 or offset + 16 > size:
+            return
+        length = _message_length(buf, offset)
+        end = offset + length if length is not None else size + 1
+        trailer = end - 4
+        if end > size or buf[trailer:end] != b"7777":
+            fileobj.seek(offset)
+            try:
+                gid = eccodes.codes_grib_new_from_file(fileobj, headers_only=True)
+            except eccodes.GribInternalError:
+                # Not the start of a valid message
+                pos = offset + 4
+                continue
+            if gid is None:
+                return
+            try:
+                offset = eccodes.codes_get_message_offset(gid)
+                length = eccodes.codes_get_message_size(gid)
+            finally:
+                eccodes.codes_release(gid)
+        yield offset, length
+        pos = offset + length
+
 
 class GRIB:
     def __init__(self, fname: Path):
@@ -70,3 +150,133 @@ class GRIB:
     def dumps(self) -> bytes:
         assert self.gid is not None
         return eccodes.codes_get_message(self.gid)
+
+    def bounding_box(self) -> Tuple[float, float, float, float]:
+        """
+        Return the area covered by the grid, as (lon_min, lat_min, lon_max,
+        lat_max) in degrees, with longitudes between -180 and 180.
+
+        If the grid crosses the antimeridian, lon_min is greater than lon_max.
+
+        Coordinates are computed for each grid point, so that rotated and
+        projected grids are also supported
+        """
+        import numpy
+
+        assert self.gid is not None
+        lats = eccodes.codes_get_array(self.gid, "latitudes")
+        lons = numpy.unique((eccodes.codes_get_array(self.gid, "longitudes") + 180.0) % 360.0 - 180.0)
+        lon_min = float(lons[0])
+        lon_max = float(lons[-1])
+        # The grid crosses the antimeridian if the widest gap between its
+        # longitudes is not the one across the antimeridian
+        if len(lons) > 1:
+            gaps = numpy.diff(lons)
+            widest = int(gaps.argmax())
+            if gaps[widest] > lon_min + 360.0 - lon_max:
+                lon_min = float(lons[widest + 1])
+                lon_max = float(lons[widest])
+        return (lon_min, float(lats.min()), lon_max, float(lats.max()))
+
+
+class ValuesCache:
+    """
+    Cache of decoded GRIB values, shared by all the inputs that use them.
+
+    Values are indexed by file name, size and modification time, and by the
+    name of the transformation applied to them after decoding. Cached arrays
+    are read-only, and are shared among all callers without copying.
+
+    The least recently used arrays are evicted when the cache grows past
+    ``max_bytes``.
+
+    If ``cache_dir`` is set, values are also stored there as ``.npy`` files
+    indexed by the contents of the GRIB file, and loaded back as memory maps,
+    so that constant fields are only decoded once across runs.
+    """
+
+    def __init__(self, max_bytes: int = 512 * 1024 * 1024, cache_dir: Optional[Path] = None) -> None:
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        if self.cache_dir is not None:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+        # Cached arrays, from the least to the most recently used
+        self.values: "OrderedDict[Tuple[str, int, int, str], NDArray]" = OrderedDict()
+        # Total size of the cached arrays
+        self.size = 0
+        # Lock protecting the cache contents
+        self.lock = threading.Lock()
+        # Locks preventing the same values from being decoded concurrently
+        self.key_locks: Dict[Tuple[str, int, int, str], threading.Lock] = {}
+        # Cache statistics
+        self.hits = 0
+        self.misses = 0
+
+    def get(
+        self, path: Path, name: str = "values", transform: Optional[Callable[["NDArray"], "NDArray"]] = None
+    ) -> "NDArray":
+        """
+        Return the values of the first GRIB in ``path``, read-only.
+
+        If ``transform`` is given, it is applied to the decoded values before
+        caching them, and ``name`` identifies it in the cache.
+        """
+        pathname = os.fspath(path)
+        st = os.stat(pathname)
+        key = (pathname, st.st_size, st.st_mtime_ns, name)
+
+        with self.lock:
+            key_lock = self.key_locks.setdefault(key, threading.Lock())
+
+        with key_lock:
+            with self.lock:
+                values = self.values.get(key)
+                if values is not None:
+                    self.values.move_to_end(key)
+                    self.hits += 1
+                    return values
+                self.misses += 1
+
+            values = self._load(path, name, transform)
+            values.setflags(write=False)
+
+            with self.lock:
+                self.values[key] = values
+                self.size += values.nbytes
+                while self.size > self.max_bytes and len(self.values) > 1:
+                    old_key, old_values = self.values.popitem(last=False)
+                    self.size -= old_values.nbytes
+                    self.key_locks.pop(old_key, None)
+        return values
+
+    def _load(self, path: Path, name: str, transform: Optional[Callable[["NDArray"], "NDArray"]]) -> "NDArray":
+        """
+        Decode and transform values, going through the disk cache if enabled
+        """
+        cached: Optional[Path] = None
+        if self.cache_dir is not None:
+            import numpy
+
+            cached = self.cache_dir / f"{file_digest(path)}-{name}.npy"
+            try:
+                return numpy.load(cached, mmap_mode="r")
+            except FileNotFoundError:
+                pass
+
+        with GRIB(path) as grib:
+            values = grib.values
+        if transform is not None:
+            values = transform(values)
+
+        if cached is not None:
+            fd, tmpname = tempfile.mkstemp(dir=cached.parent, prefix=cached.name, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as out:
+                    numpy.save(out, values)
+                os.replace(tmpname, cached)
+            except BaseException:
+                os.unlink(tmpname)
+                raise
+            log.debug("%s: cached %s values as %s", path, name, cached)
+
+        return values
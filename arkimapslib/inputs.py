@@ -9,8 +9,22 @@ import shutil
 import subprocess
 import tempfile
 from abc import ABC
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import TYPE_CHECKING, Any, Dict, Generator, Iterable, List, NamedTuple, Optional, Tuple, Type, TypeVar
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Dict,
+    Generator,
+    Iterable,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+    Type,
+    TypeVar,
+)
 
 from .config import Config
 from .grib import GRIB
@@ -18,7 +32,7 @@ from .lint import Lint
 from .models import BaseDataModel, pydantic
 from .types import Instant
 from .component import RootComponent, TypeRegistry
-from .utils import perf_counter_ns
+from .utils import available_cpus, perf_counter_ns
 
 if TYPE_CHECKING:
     from numpy.typing import NDArray
@@ -97,7 +111,7 @@ class Inputs:
         for inps in self.inputs.values():
             for inp in inps:
                 stats = pantry.input_stats[inp]
-                if stats.used_by or stats.computation_log:
+                if stats.used_by or stats.computation_log or stats.dropped_duplicates:
                     summary.add(inp.name, stats)
 
     def add_inputs_recursive(self, name: str, res: List[str]) -> None:
@@ -799,6 +813,59 @@ class GribSetMixin(Derived[GSPEC], ABC):
             eval(self.clip_fn, values)
         return values[self.name]
 
+    def write_grib(self, pantry: "pantry.DiskPantry", instant: Instant, output_name: str, grib: GRIB) -> None:
+        """
+        Write the encoded grib to the pantry as the given output instant
+        """
+        log.info("input %s: generating instant %s as %s", self.name, instant, output_name)
+        output_pathname = os.path.join(pantry.data_root, output_name)
+        with open(output_pathname, "wb") as out:
+            out.write(grib.dumps())
+
+    def generate_instants(
+        self, pantry: "pantry.DiskPantry", jobs: List[Tuple[Instant, str, Callable[[], bool]]]
+    ) -> bool:
+        """
+        Run the functions generating each instant, in parallel.
+
+        ``jobs`` is a list of ``(instant, description, function)``, where
+        ``function`` writes the instant to the pantry and returns False if it
+        decided to skip it.
+
+        Statistics are collected and instants are added to the pantry in the
+        order of ``jobs``, regardless of the order of completion.
+
+        Returns True if at least one instant was generated.
+        """
+
+        def run(job: Tuple[Instant, str, Callable[[], bool]]) -> Tuple[int, bool]:
+            start = perf_counter_ns()
+            generated = job[2]()
+            return perf_counter_ns() - start, generated
+
+        max_jobs = self.config.derived_instant_jobs if self.config is not None else 1
+        if max_jobs is None:
+            # Share the CPUs with the other derived inputs being generated in
+            # parallel, instead of starting a full pool for each of them
+            max_jobs = max(1, available_cpus() // pantry.derived_jobs)
+        max_jobs = min(max_jobs, len(jobs))
+
+        has_output = False
+        with contextlib.ExitStack() as stack:
+            if max_jobs > 1:
+                executor = stack.enter_context(ThreadPoolExecutor(max_workers=max_jobs))
+                results: Iterable[Tuple[int, bool]] = executor.map(run, jobs)
+            else:
+                results = map(run, jobs)
+
+            for (instant, what, func), (elapsed, generated) in zip(jobs, results):
+                pantry.input_stats[self].add_computation_log(elapsed, what)
+                pantry.log_input_processing(self, what)
+                if generated:
+                    pantry.add_instant(self, instant)
+                    has_output = True
+        return has_output
+
 
 class GroundToMSL(GribSetMixin[GribSetInputSpec]):
     """
@@ -835,27 +902,12 @@ class GroundToMSL(GribSetMixin[GribSetInputSpec]):
             log.info("input %s: missing z data", self.name)
             return
 
-        with GRIB(z_input.pathname) as z_grib:
-            # Read z_input into a numpy matrix
-            z = z_grib.values
-            # Convert to meters
-            z /= 9.80665
+        # Read z_input into a numpy matrix, converted to meters. The matrix
+        # is read-only, and shared with other inputs using the same z
+        z = pantry.values_cache.get(z_input.pathname, "meters", lambda values: values / 9.80665)
 
-        has_output = False
-        for instant, input_file in pantry.get_instants(self.spec.inputs[1]).items():
-            assert instant is not None
-            output_name = pantry.get_basename(self, instant)
-            with self._collect_stats(
-                pantry,
-                " ".join(
-                    (
-                        "groundtomsl",
-                        shlex.quote(str(z_input.pathname)),
-                        shlex.quote(str(input_file.pathname)),
-                        str(output_name),
-                    )
-                ),
-            ):
+        def make_instant(instant: Instant, input_file: InputFile, output_name: str) -> Callable[[], bool]:
+            def generate_instant() -> bool:
                 with GRIB(input_file.pathname) as val_grib:
                     # Add z
                     vals = val_grib.values
@@ -865,12 +917,26 @@ class GroundToMSL(GribSetMixin[GribSetInputSpec]):
                     val_grib.values = vals
 
                     # Write output
-                    log.info("input %s: generating instant %s as %s", self.name, instant, output_name)
-                    output_pathname = os.path.join(pantry.data_root, output_name)
-                    with open(output_pathname, "wb") as out:
-                        out.write(val_grib.dumps())
-                    pantry.add_instant(self, instant)
-                    has_output = True
+                    self.write_grib(pantry, instant, output_name, val_grib)
+                return True
+
+            return generate_instant
+
+        jobs: List[Tuple[Instant, str, Callable[[], bool]]] = []
+        for instant, input_file in pantry.get_instants(self.spec.inputs[1]).items():
+            assert instant is not None
+            output_name = pantry.get_basename(self, instant)
+            what = " ".join(
+                (
+                    "groundtomsl",
+                    shlex.quote(str(z_input.pathname)),
+                    shlex.quote(str(input_file.pathname)),
+                    str(output_name),
+                )
+            )
+            jobs.append((instant, what, make_instant(instant, input_file, output_name)))
+
+        has_output = self.generate_instants(pantry, jobs)
 
         if not has_output:
             log.info("input %s: missing source data", self.name)
@@ -910,13 +976,8 @@ class Expr(GribSetMixin[ExprInputSpec], AlignInstants[ExprInputSpec]):
         if not available_instants:
             return
 
-        # For each instant, run the expression
-        for instant, input_files in available_instants.items():
-            assert instant is not None
-            output_name = pantry.get_basename(self, instant)
-            with self._collect_stats(
-                pantry, "expr " + ",".join(shlex.quote(str(i.pathname)) for i in input_files) + f" {output_name}"
-            ):
+        def make_instant(instant: Instant, input_files: List[InputFile], output_name: str) -> Callable[[], bool]:
+            def generate_instant() -> bool:
                 with contextlib.ExitStack() as stack:
                     # Open all input GRIBs
                     gribs: Dict[str, GRIB] = {}
@@ -938,7 +999,7 @@ class Expr(GribSetMixin[ExprInputSpec], AlignInstants[ExprInputSpec]):
                     result = values.get(self.name)
                     if result is None:
                         log.warning("input %s: the expression did not set %s: skipping step", self.name, self.name)
-                        continue
+                        return False
 
                     # Apply clip
                     result = self.apply_clip(values)
@@ -948,12 +1009,20 @@ class Expr(GribSetMixin[ExprInputSpec], AlignInstants[ExprInputSpec]):
                     template.values = result
 
                     # Write output
-                    log.info("input %s: generating instant %s as %s", self.name, instant, output_name)
-                    output_pathname = os.path.join(pantry.data_root, output_name)
-                    with open(output_pathname, "wb") as out:
-                        out.write(template.dumps())
+                    self.write_grib(pantry, instant, output_name, template)
+                return True
 
-                    pantry.add_instant(self, instant)
+            return generate_instant
+
+        # For each instant, run the expression
+        jobs: List[Tuple[Instant, str, Callable[[], bool]]] = []
+        for instant, input_files in available_instants.items():
+            assert instant is not None
+            output_name = pantry.get_basename(self, instant)
+            what = "expr " + ",".join(shlex.quote(str(i.pathname)) for i in input_files) + f" {output_name}"
+            jobs.append((instant, what, make_instant(instant, input_files, output_name)))
+
+        self.generate_instants(pantry, jobs)
 
 
 class SFFraction(GribSetMixin[GribSetInputSpec], AlignInstants[GribSetInputSpec]):
@@ -975,14 +1044,8 @@ class SFFraction(GribSetMixin[GribSetInputSpec], AlignInstants[GribSetInputSpec]
         if not available_instants:
             return
 
-        # For each instant, run the expression
-        for instant, input_files in available_instants.items():
-            assert instant is not None
-            output_name = pantry.get_basename(self, instant)
-            with self._collect_stats(
-                pantry,
-                "sffraction " + ",".join(shlex.quote(str(i.pathname)) for i in input_files) + " " + str(output_name),
-            ):
+        def make_instant(instant: Instant, input_files: List[InputFile], output_name: str) -> Callable[[], bool]:
+            def generate_instant() -> bool:
                 with GRIB(input_files[0].pathname) as grib_tp:
                     template = grib_tp
                     with GRIB(input_files[1].pathname) as grib_snow:
@@ -1011,12 +1074,20 @@ class SFFraction(GribSetMixin[GribSetInputSpec], AlignInstants[GribSetInputSpec]
                     template.values = sffraction
 
                     # Write output
-                    log.info("input %s: generating instant %s as %s", self.name, instant, output_name)
-                    output_pathname = os.path.join(pantry.data_root, output_name)
-                    with open(output_pathname, "wb") as out:
-                        out.write(template.dumps())
+                    self.write_grib(pantry, instant, output_name, template)
+                return True
 
-                    pantry.add_instant(self, instant)
+            return generate_instant
+
+        # For each instant, run the expression
+        jobs: List[Tuple[Instant, str, Callable[[], bool]]] = []
+        for instant, input_files in available_instants.items():
+            assert instant is not None
+            output_name = pantry.get_basename(self, instant)
+            what = "sffraction " + ",".join(shlex.quote(str(i.pathname)) for i in input_files) + " " + str(output_name)
+            jobs.append((instant, what, make_instant(instant, input_files, output_name)))
+
+        self.generate_instants(pantry, jobs)
 
 
 class InputFile(NamedTuple):
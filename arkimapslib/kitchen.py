@@ -5,7 +5,7 @@ import logging
 import os
 from pathlib import Path
 import tempfile
-from typing import Any, Dict, List, Optional, Set, Union
+from typing import Any, Dict, FrozenSet, List, Optional, Set, Tuple, Union
 
 import yaml
 
@@ -18,11 +18,13 @@ except ModuleNotFoundError:
 
 from . import orders, pantry
 from .config import Config
-from .flavours import Flavour
+from .flavours import Flavour, find_instants
+from .grib import ValuesCache
 from .recipes import Recipe
-from .inputs import Inputs
-from .types import ModelStep
+from .inputs import InputFile, Inputs
+from .types import Instant, ModelStep
 from .definitions import Definitions
+from .utils import available_cpus
 
 # if TYPE_CHECKING:
 # Used for kwargs-style dicts
@@ -93,6 +95,22 @@ class WorkingKitchen(Kitchen):
             self.tempdir = None
             self.workdir = workdir
 
+        # Decoded GRIB values shared by derived inputs
+        self.values_cache = ValuesCache(max_bytes=self.config.grib_cache_memory, cache_dir=self.config.grib_cache_dir)
+
+    def pantry_kwargs(self) -> Dict[str, Any]:
+        """
+        Return the configuration arguments common to all working pantries
+        """
+        return {
+            "root": self.workdir,
+            "values_cache": self.values_cache,
+            "max_open_files": self.config.dispatch_max_open_files,
+            "write_buffer_size": self.config.dispatch_buffer_size,
+            "dispatch_jobs": self.config.dispatch_jobs,
+            "inputs": self.defs.inputs,
+        }
+
     def fill_pantry(self, path: Optional[Path] = None, flavours: Optional[List[Flavour]] = None):
         """
         Fill the pantry from the given path or standard input
@@ -103,24 +121,55 @@ class WorkingKitchen(Kitchen):
             all_inputs = self.list_inputs(flavours)
             self.pantry.fill(path, input_filter=all_inputs)
 
+    def generate_derived(self, flavours: List[Flavour]):
+        """
+        Generate the derived inputs needed by the given flavours, running
+        independent ones in parallel
+        """
+        jobs = self.config.derived_jobs or available_cpus()
+        self.pantry.generate_derived(self.list_inputs(flavours), jobs=jobs)
+
     def make_orders(self, flavour: Union[Flavour, str], recipe: Optional[str] = None) -> List[orders.Order]:
         """
         Generate all possible orders for all available recipes
         """
         if isinstance(flavour, str):
             flavour = self.defs.flavours[flavour]
+        return self.make_orders_for_flavours([flavour], recipe=recipe)
 
+    def make_orders_for_flavours(self, flavours: List[Flavour], recipe: Optional[str] = None) -> List[orders.Order]:
+        """
+        Generate all possible orders for all available recipes, for all the
+        given flavours.
+
+        The instants available for a recipe are computed once for each
+        distinct set of inputs, and shared by all recipes and flavours that
+        use the same inputs
+        """
         recipes: List[Recipe]
         if recipe is None:
             recipes = list(self.defs.recipes)
         else:
             recipes = [self.defs.recipes.get(recipe)]
 
+        # Available instants for each set of input names
+        plans: Dict[FrozenSet[str], Tuple[Optional[Dict[Instant, Dict[str, InputFile]]], Dict[str, InputFile]]] = {}
+
         res: List[orders.Order] = []
-        for rec in recipes:
-            if not flavour.allows_recipe(rec):
-                continue
-            res.extend(flavour.make_orders(rec, self.pantry))
+        for flavour in flavours:
+            for rec in recipes:
+                if not flavour.allows_recipe(rec):
+                    continue
+                input_names = frozenset(flavour.get_inputs_for_recipe(rec))
+                plan = plans.get(input_names)
+                if plan is None:
+                    plan = plans[input_names] = find_instants(input_names, self.pantry)
+                inputs, inputs_for_all_instants = plan
+                # Orders keep their input files, and flavours may change the
+                # mappings they are given: give each its own copy
+                if inputs is not None:
+                    inputs = {instant: input_files.copy() for instant, input_files in inputs.items()}
+                res.extend(flavour.inputs_to_orders(rec, inputs, dict(inputs_for_all_instants)))
         return res
 
     def make_order(
@@ -195,7 +244,7 @@ class ArkimetKitchen(ArkimetRecipesMixin, WorkingKitchen):
         super().__init__(**kwargs)
         from .pantry import ArkimetPantry
 
-        self.pantry = ArkimetPantry(root=self.workdir, session=self.session, inputs=self.defs.inputs)
+        self.pantry = ArkimetPantry(session=self.session, **self.pantry_kwargs())
 
 
 class EccodesEmptyKitchen(Kitchen):
@@ -209,6 +258,6 @@ class EccodesEmptyKitchen(Kitchen):
 
 
 class EccodesKitchen(WorkingKitchen):
-    def __init__(self, *, grib_input=False, **kwargs):
+    def __init__(self, *, grib_input=False, grib_filter=False, **kwargs):
         super().__init__(**kwargs)
-        self.pantry = pantry.EccodesPantry(root=self.workdir, grib_input=grib_input, inputs=self.defs.inputs)
+        self.pantry = pantry.EccodesPantry(grib_input=grib_input, grib_filter=grib_filter, **self.pantry_kwargs())
@@ -1,16 +1,23 @@
 # from __future__ import annotations
+import functools
+import hashlib
 import io
+import json
 import logging
 import math
 import os
+import threading
 from abc import ABC, abstractmethod
-from typing import TYPE_CHECKING, Any, Dict, Generator, List, NamedTuple, Optional, Tuple
+from collections import Counter
+from typing import TYPE_CHECKING, Any, Callable, Dict, Generator, Iterable, List, NamedTuple, Optional, Tuple, cast
 
+import numpy
 from PIL import Image
 
 from . import outputbundle
 from .pygen import PyGen
 from .recipes import RecipeStepSkipped
+from .utils import file_digest
 
 if TYPE_CHECKING:
     from . import inputs, steps
@@ -23,6 +30,27 @@ TILE_WIDTH_CM = 256 / 40.0
 TILE_HEIGHT_CM = 256 / 40.0
 TILE_WIDTH_PX = 256
 TILE_HEIGHT_PX = 256
+# Magics defaults for the size of a rendered page
+DEFAULT_OUTPUT_WIDTH_PX = 800
+DEFAULT_PAGE_ASPECT = 21.0 / 29.7
+
+
+class BundleProduct(NamedTuple):
+    """
+    Image data prepared to be added to an output bundle
+    """
+
+    #: Path of the product in the bundle
+    path: str
+    #: PNG image data, or None if the image is fully transparent and is not
+    #: stored
+    data: Optional[bytes]
+    #: True if the image has a single colour, and its data can be shared with
+    #: identical products
+    uniform: bool = False
+    #: Zoom level and coordinates of a tile built by a TilePyramid instead of
+    #: being sliced from the rendered image
+    tile: Optional[Tuple[int, int, int]] = None
 
 
 class Output(NamedTuple):
@@ -69,12 +97,58 @@ class Order(ABC):
 
         # Summary stats about the rendering
         self.render_time_ns: int = 0
+        # True if the output was taken from the render cache instead of being
+        # rendered
+        self.cached: bool = False
 
     @abstractmethod
+    def output_relpath(self) -> Tuple[str, str]:
+        """
+        Return the directory, relative to the working directory, and the file
+        name (without path or .png extension) of the image rendered by Magics
+        """
+
     def print_python_function(self, function_name: str, gen: PyGen):
         """
         Print a function that renders this order
         """
+        relpath, basename = self.output_relpath()
+        gen.magics_renderer(function_name, self, relpath, basename)
+
+    def fingerprint(self) -> str:
+        """
+        Return a hex digest identifying the image that this order renders.
+
+        Orders with the same fingerprint render the same image: the fingerprint
+        covers the contents of input files, Magics macro parameters,
+        postprocessing and output options
+        """
+        # Input files are identified by their contents rather than their
+        # location in the working directory
+        digests: Dict[str, str] = {}
+        for input_file in self.input_files.values():
+            digests[input_file.pathname.as_posix()] = file_digest(input_file.pathname)
+
+        macros = []
+        for step in self.order_steps:
+            name, params = step.as_magics_macro()
+            macros.append((name, params))
+        macros_json = json.dumps(macros, sort_keys=True, default=str)
+        for pathname, digest in digests.items():
+            macros_json = macros_json.replace(json.dumps(pathname), json.dumps(f"sha256:{digest}"))
+
+        postprocessors = [
+            (postprocessor.name, postprocessor.spec.dict()) for postprocessor in self.flavour.postprocessors
+        ]
+
+        hasher = hashlib.sha256()
+        hasher.update(self.__class__.__name__.encode())
+        hasher.update(json.dumps(self.output_relpath()).encode())
+        hasher.update(json.dumps(sorted(digests.values())).encode())
+        hasher.update(macros_json.encode())
+        hasher.update(json.dumps(postprocessors, sort_keys=True, default=str).encode())
+        hasher.update(json.dumps(self.output_options, sort_keys=True, default=str).encode())
+        return hasher.hexdigest()
 
     def set_output(self, output: Output, timing: int = 0):
         """
@@ -85,9 +159,37 @@ class Order(ABC):
         self.output = output
         self.render_time_ns += timing
 
-    def add_to_bundle(self, workdir: str, bundle: outputbundle.Writer):
+    def prepare_bundle(self, workdir: str) -> Optional[List[BundleProduct]]:
         """
-        Add render results to a tarball
+        Compute the products to add to the bundle, or None if the rendered
+        output is added as it is.
+
+        This is run in a worker thread, concurrently with other orders, and
+        does not modify the order: state shared with other orders needs to be
+        protected by a lock
+        """
+        return None
+
+    def finish_bundle(self) -> Optional[List[BundleProduct]]:
+        """
+        Compute the products still missing from the bundle after all orders
+        have been added to it, or None if there are none.
+
+        This is run in a worker thread
+        """
+        return None
+
+    def add_finished_to_bundle(self, bundle: outputbundle.Writer, finished: List[BundleProduct]) -> None:
+        """
+        Add the results of finish_bundle to the bundle
+        """
+        pass
+
+    def add_to_bundle(self, workdir: str, bundle: outputbundle.Writer, prepared: Optional[List[BundleProduct]] = None):
+        """
+        Add render results to a tarball.
+
+        ``prepared`` is the result of prepare_bundle, if it was already called
         """
         if self.output is None:
             raise AssertionError(f"{self}: product has not been rendered")
@@ -99,6 +201,28 @@ class Order(ABC):
             bundle.add_product(self.output.relpath, data)
         os.unlink(path)
 
+    def product_count(self) -> int:
+        """
+        Return the number of products generated by this order
+        """
+        return 1
+
+    def output_pixels(self) -> int:
+        """
+        Return the estimated number of pixels of the image rendered by this
+        order
+        """
+        width = self.output_options.get("output_width", DEFAULT_OUTPUT_WIDTH_PX)
+        aspect = DEFAULT_PAGE_ASPECT
+        for step in self.order_steps:
+            if step.name == "add_basemap":
+                params = step.spec.params
+                width = self.output_options.get("output_width", params.output_width)
+                if params.page_x_length > 0:
+                    aspect = params.page_y_length / params.page_x_length
+                break
+        return int(width * width * aspect)
+
     def georeference(self) -> Optional[Dict[str, Any]]:
         """
         Return a dict with georeferencing information for the image produced by
@@ -179,15 +303,12 @@ class MapOrder(Order):
     def __repr__(self):
         return f"{self.__class__.__name__}({os.path.basename(self.recipe.name)}{self.instant.step_suffix()})"
 
-    def print_python_function(self, function_name: str, gen: PyGen):
-        """
-        Print a function that renders this order
-        """
+    def output_relpath(self) -> Tuple[str, str]:
         # Destination directory inside the output
         relpath = f"{self.instant.reftime:%Y-%m-%dT%H:%M:%S}/{self.recipe.name}_{self.flavour.name}"
         # Destination file name (without path or .png extension)
         basename = f"{os.path.basename(self.recipe.name)}{self.instant.step_suffix()}"
-        gen.magics_renderer(function_name, self, relpath, basename)
+        return relpath, basename
 
 
 def num2deg(xtile: int, ytile: int, zoom: int) -> Tuple[float, float]:
@@ -213,6 +334,298 @@ def deg2num(lon_deg: float, lat_deg: float, zoom: int) -> Tuple[int, int]:
     return (xtile, ytile)
 
 
+def tile_georeference(z: int, x: int, y: int, w: int, h: int) -> Dict[str, Any]:
+    """
+    Return the georeferencing information of a tile cluster
+    """
+    min_lon, max_lat = num2deg(x, y, z)
+    max_lon, min_lat = num2deg(x + w, y + h, z)
+    return {
+        "projection": "EPSG",
+        "epsg": 3857,
+        "bbox": [min(min_lon, max_lon), min(min_lat, max_lat), max(min_lon, max_lon), max(min_lat, max_lat)],
+    }
+
+
+def tileset_relpath(flavour: "Flavour", recipe: "Recipe", instant: "inputs.Instant") -> str:
+    """
+    Return the path in the output of the tiles of a recipe and instant,
+    without the zoom level
+    """
+    return f"{instant.reftime:%Y-%m-%dT%H:%M:%S}/{recipe.name}_{flavour.name}{instant.step_suffix()}"
+
+
+def tile_product(
+    bundle_path: str,
+    pixels: numpy.ndarray,
+    has_alpha: bool,
+    dedup_uniform: bool,
+    make_image: Callable[[], Image.Image],
+    tile: Optional[Tuple[int, int, int]] = None,
+) -> BundleProduct:
+    """
+    Encode a tile for the output bundle.
+
+    If dedup_uniform is True, fully transparent tiles are not encoded, and
+    tiles of a single colour are marked as uniform
+    """
+    uniform = False
+    if dedup_uniform:
+        if has_alpha and not pixels[..., -1].any():
+            return BundleProduct(bundle_path, None, tile=tile)
+        uniform = bool((pixels == pixels[0, 0]).all())
+    with io.BytesIO() as buf:
+        make_image().save(buf, "PNG")
+        return BundleProduct(bundle_path, buf.getvalue(), uniform, tile)
+
+
+def image_from_pixels(pixels: numpy.ndarray, like: Image.Image) -> Image.Image:
+    """
+    Create an image from a slice of the pixels of another image
+    """
+    res = Image.fromarray(pixels, mode=like.mode)
+    res.info = like.info.copy()
+    return res
+
+
+def reduce_tile(pixels: numpy.ndarray) -> numpy.ndarray:
+    """
+    Downsample RGBA pixels to half their size, averaging each 2x2 block
+    weighted by the opacity of its pixels
+    """
+    height = pixels.shape[0] // 2
+    width = pixels.shape[1] // 2
+    blocks = pixels.astype(numpy.uint32).reshape(height, 2, width, 2, 4)
+    alpha = blocks[..., 3:]
+    alpha_sum = alpha.sum(axis=(1, 3))
+    colour_sum = (blocks[..., :3] * alpha).sum(axis=(1, 3))
+    res = numpy.empty((height, width, 4), dtype=numpy.uint8)
+    # Fully transparent blocks become transparent black
+    res[..., :3] = (colour_sum + alpha_sum // 2) // numpy.maximum(alpha_sum, 1)
+    res[..., 3:] = (alpha_sum + 2) // 4
+    return res
+
+
+def tile_basemap_params(z: int, x: int, y: int, w: int, h: int) -> Dict[str, Any]:
+    """
+    Return the add_basemap parameters that depend on the area of a tile
+    cluster
+    """
+    min_lon, max_lat = num2deg(x, y, z)
+    max_lon, min_lat = num2deg(x + w, y + h, z)
+    return {
+        "subpage_lower_left_latitude": min_lat,
+        "subpage_lower_left_longitude": min_lon,
+        "subpage_upper_right_latitude": max_lat,
+        "subpage_upper_right_longitude": max_lon,
+        "page_x_length": TILE_WIDTH_CM * w,
+        "page_y_length": TILE_HEIGHT_CM * h,
+        "super_page_x_length": TILE_WIDTH_CM * w,
+        "super_page_y_length": TILE_HEIGHT_CM * h,
+        "subpage_x_length": TILE_WIDTH_CM * w,
+        "subpage_y_length": TILE_HEIGHT_CM * h,
+        "output_width": TILE_WIDTH_PX * w,
+    }
+
+
+class TileBasemap:
+    """
+    add_basemap step of a TileOrder.
+
+    It shares the basemap step of all the tiles of a product, and only stores
+    the parameters that depend on the area of its tile cluster
+    """
+
+    def __init__(self, basemap: "steps.AddBasemap", params: Dict[str, Any]) -> None:
+        self.basemap = basemap
+        self.name = basemap.name
+        # Parameters overriding those of the shared basemap
+        self.params = params
+        self._spec: Optional["steps.AddBasemapSpec"] = None
+
+    @property
+    def spec(self) -> "steps.AddBasemapSpec":
+        """
+        Full specification of the step, built the first time it is needed
+        """
+        if self._spec is None:
+            spec = self.basemap.spec.copy(deep=True)
+            for name, value in self.params.items():
+                setattr(spec.params, name, value)
+            self._spec = spec
+        return self._spec
+
+    def as_magics_macro(self) -> Tuple[str, Dict[str, Any]]:
+        name, params = self.basemap.as_magics_macro()
+        params.update(self.params)
+        return name, params
+
+
+class TileSteps:
+    """
+    Steps shared by all the TileOrders of a recipe, flavour and instant
+    """
+
+    def __init__(self, flavour: "Flavour", recipe: "Recipe", input_files: Dict[str, "inputs.InputFile"]) -> None:
+        from .steps import AddBasemap, AddContour
+
+        self.steps: List["steps.Step"] = []
+        # Position of the add_basemap step in steps, if present
+        self.basemap_index: Optional[int] = None
+
+        for recipe_step in recipe.steps:
+            try:
+                compiled_step = recipe_step.create_step(flavour, input_files)
+            except RecipeStepSkipped:
+                log.debug("%s: %s (skipped)", recipe.name, recipe_step.name)
+                continue
+            if recipe_step.step_class is AddBasemap:
+                # Set the parameters common to all tiles. Area parameters are
+                # set here too, so that they keep their position in the
+                # macro arguments when overridden by each tile
+                params = compiled_step.spec.params
+                params.subpage_map_projection = "EPSG:3857"
+                for name, value in tile_basemap_params(0, 0, 0, 1, 1).items():
+                    setattr(params, name, value)
+                params.subpage_x_position = 0.0
+                params.subpage_y_position = 0.0
+                params.subpage_frame = False
+                params.page_frame = False
+                params.skinny_mode = True
+                params.page_id_line = False
+                self.basemap_index = len(self.steps)
+            elif recipe_step.step_class is AddContour:
+                # Strip legend from add_contour
+                compiled_step.spec.params.legend = False
+            self.steps.append(compiled_step)
+
+    def for_tile(self, z: int, x: int, y: int, w: int, h: int) -> List["steps.Step"]:
+        """
+        Return the steps for rendering a tile cluster
+        """
+        res = list(self.steps)
+        if self.basemap_index is not None:
+            basemap = cast("steps.AddBasemap", self.steps[self.basemap_index])
+            res[self.basemap_index] = cast("steps.Step", TileBasemap(basemap, tile_basemap_params(z, x, y, w, h)))
+        return res
+
+
+class TilePyramid:
+    """
+    Build the lower zoom levels of a tileset by downsampling the tiles
+    rendered at its base zoom level.
+
+    Each lower level tile is built as soon as all the tiles that it covers
+    have been added. Tiles are added by concurrent worker threads, and the
+    pyramid state is protected by a lock
+    """
+
+    def __init__(
+        self,
+        relpath: str,
+        zoom: int,
+        zoom_min: int,
+        tiles: Iterable[Tuple[int, int]],
+        dedup_uniform: bool = False,
+    ) -> None:
+        # Path in the output of the tileset, without the zoom level
+        self.relpath = relpath
+        # Zoom level of the rendered tiles
+        self.zoom = zoom
+        # Minimum zoom level to build
+        self.zoom_min = zoom_min
+        self.dedup_uniform = dedup_uniform
+        # Number of tiles covered by each lower level tile, by (z, x, y)
+        self.expected: Dict[Tuple[int, int, int], int] = {}
+        level = set(tiles)
+        for z in range(zoom, zoom_min, -1):
+            parents = Counter((x >> 1, y >> 1) for x, y in level)
+            for (x, y), count in parents.items():
+                self.expected[(z - 1, x, y)] = count
+            level = set(parents)
+        # Lower level tiles being built, with the number of tiles added so far
+        self.pending: Dict[Tuple[int, int, int], Tuple[numpy.ndarray, int]] = {}
+        # Lock protecting pending, since tiles are added by worker threads
+        self.lock = threading.Lock()
+
+    def add(self, z: int, x: int, y: int, pixels: numpy.ndarray) -> List[BundleProduct]:
+        """
+        Add the RGBA pixels of a tile, and return the lower level tiles that
+        it completed
+        """
+        with self.lock:
+            completed = self._add(z, x, y, pixels)
+        return self._encode(completed)
+
+    def flush(self) -> List[BundleProduct]:
+        """
+        Build the lower level tiles that are still missing some of the tiles
+        that they cover, because they failed to render
+        """
+        completed: List[Tuple[Tuple[int, int, int], numpy.ndarray]] = []
+        with self.lock:
+            if self.pending:
+                log.warning("%s: %d lower zoom level tiles built from incomplete data", self.relpath, len(self.pending))
+            while self.pending:
+                # Start from the highest zoom level, since flushed tiles are
+                # added to the level below
+                key = max(self.pending)
+                canvas, _ = self.pending.pop(key)
+                completed.append((key, canvas))
+                completed.extend(self._add(*key, canvas))
+        return self._encode(completed)
+
+    def _add(self, z: int, x: int, y: int, pixels: numpy.ndarray) -> List[Tuple[Tuple[int, int, int], numpy.ndarray]]:
+        """
+        Add the RGBA pixels of a tile, and return the pixels of the lower
+        level tiles that it completed. Must be called holding the lock
+        """
+        half_width = TILE_WIDTH_PX // 2
+        half_height = TILE_HEIGHT_PX // 2
+        completed: List[Tuple[Tuple[int, int, int], numpy.ndarray]] = []
+        while z > self.zoom_min:
+            key = (z - 1, x >> 1, y >> 1)
+            expected = self.expected.get(key)
+            if expected is None:
+                break
+            canvas, count = self.pending.get(key, (None, 0))
+            if canvas is None:
+                canvas = numpy.zeros((TILE_HEIGHT_PX, TILE_WIDTH_PX, 4), dtype=numpy.uint8)
+            top = (y & 1) * half_height
+            bottom = top + half_height
+            left = (x & 1) * half_width
+            right = left + half_width
+            canvas[top:bottom, left:right] = reduce_tile(pixels)
+            count += 1
+            if count < expected:
+                self.pending[key] = (canvas, count)
+                break
+            self.pending.pop(key, None)
+            completed.append((key, canvas))
+            z, x, y = key
+            pixels = canvas
+        return completed
+
+    def _encode(self, completed: List[Tuple[Tuple[int, int, int], numpy.ndarray]]) -> List[BundleProduct]:
+        """
+        Encode lower level tiles as PNG, outside of the lock
+        """
+        res: List[BundleProduct] = []
+        for (tile_z, tile_x, tile_y), tile_pixels in completed:
+            bundle_path = os.path.join(self.relpath, str(tile_z), str(tile_x), f"{tile_y}.png")
+            res.append(
+                tile_product(
+                    bundle_path,
+                    tile_pixels,
+                    True,
+                    self.dedup_uniform,
+                    functools.partial(Image.fromarray, tile_pixels, "RGBA"),
+                    (tile_z, tile_x, tile_y),
+                )
+            )
+        return res
+
+
 class TileOrder(Order):
     def __init__(
         self,
@@ -226,9 +639,10 @@ class TileOrder(Order):
         y: int,
         w: int = 1,
         h: int = 1,
+        tile_steps: Optional[TileSteps] = None,
+        dedup_uniform: bool = False,
+        pyramid: Optional[TilePyramid] = None,
     ):
-        from .steps import AddBasemap, AddContour
-
         super().__init__(flavour=flavour, recipe=recipe, input_files=input_files, instant=instant)
         self.x = x
         self.y = y
@@ -237,47 +651,29 @@ class TileOrder(Order):
         self.width = w
         # Height, in number of tiles, of the rendering cluster
         self.height = h
-
-        min_lon, max_lat = num2deg(x, y, z)
-        max_lon, min_lat = num2deg(x + self.width, y + self.height, z)
+        # Omit fully transparent tiles, and share the data of single colour
+        # tiles
+        self.dedup_uniform = dedup_uniform
+        # Tiles whose image is shared or omitted, mapped to the path of the
+        # shared data, or to None if the tile is fully transparent
+        self.tile_refs: Dict[str, Optional[str]] = {}
+        # Pyramid building lower zoom levels from the tiles of this order
+        self.pyramid = pyramid
+        # Lower zoom level tiles completed by the tiles of this order, with
+        # their path in the bundle
+        self.pyramid_tiles: List[Tuple[Tuple[int, int, int], str]] = []
 
         self.output_options["output_cairo_transparent_background"] = True
         # TODO: if we eventually do rectangular renderings, see
         #       if there is also output_height
         self.output_options["output_width"] = TILE_WIDTH_PX * self.width
 
-        # Instantiate order steps from recipe steps
-        for recipe_step in recipe.steps:
-            try:
-                compiled_step = recipe_step.create_step(flavour, input_files)
-                if recipe_step.step_class is AddBasemap:
-                    # Adjust basemap area
-                    params = compiled_step.spec.params
-                    params.subpage_map_projection = "EPSG:3857"
-                    params.subpage_lower_left_latitude = min_lat
-                    params.subpage_lower_left_longitude = min_lon
-                    params.subpage_upper_right_latitude = max_lat
-                    params.subpage_upper_right_longitude = max_lon
-                    params.page_x_length = TILE_WIDTH_CM * self.width
-                    params.page_y_length = TILE_HEIGHT_CM * self.height
-                    params.super_page_x_length = TILE_WIDTH_CM * self.width
-                    params.super_page_y_length = TILE_HEIGHT_CM * self.height
-                    params.subpage_x_length = TILE_WIDTH_CM * self.width
-                    params.subpage_y_length = TILE_HEIGHT_CM * self.height
-                    params.subpage_x_position = 0.0
-                    params.subpage_y_position = 0.0
-                    params.subpage_frame = False
-                    params.output_width = TILE_WIDTH_PX * self.width
-                    params.page_frame = False
-                    params.skinny_mode = True
-                    params.page_id_line = False
-                elif recipe_step.step_class is AddContour:
-                    # Strip legend from add_contour
-                    compiled_step.spec.params.legend = False
-            except RecipeStepSkipped:
-                log.debug("%s: %s (skipped)", self, compiled_step.name)
-                continue
-            self.order_steps.append(compiled_step)
+        # Instantiate order steps from recipe steps, unless they are shared
+        # with other tiles
+        if tile_steps is None:
+            tile_steps = TileSteps(flavour, recipe, input_files)
+        self.has_basemap = tile_steps.basemap_index is not None
+        self.order_steps = tile_steps.for_tile(z, x, y, w, h)
 
     def __str__(self):
         return (
@@ -288,21 +684,31 @@ class TileOrder(Order):
     def __repr__(self):
         return f"{self.__class__.__name__}({str(self)})"
 
-    def print_python_function(self, function_name: str, gen: PyGen):
-        """
-        Print a function that renders this order
-        """
-        relpath = (
-            f"{self.instant.reftime:%Y-%m-%dT%H:%M:%S}/"
-            f"{self.recipe.name}_{self.flavour.name}{self.instant.step_suffix()}/"
-            f"{self.z}"
-        )
+    def product_count(self) -> int:
+        return self.width * self.height
+
+    def output_pixels(self) -> int:
+        return TILE_WIDTH_PX * self.width * TILE_HEIGHT_PX * self.height
+
+    def georeference(self) -> Optional[Dict[str, Any]]:
+        # Compute the georeferencing from the tile coordinates, without
+        # building the full basemap specification
+        if not self.has_basemap:
+            log.info("%s: Order has no add_basemap step", self)
+            return None
+        return tile_georeference(self.z, self.x, self.y, self.width, self.height)
+
+    def output_relpath(self) -> Tuple[str, str]:
+        relpath = f"{tileset_relpath(self.flavour, self.recipe, self.instant)}/{self.z}"
         basename = f"{self.x}-{self.y}-{self.width}-{self.height}"
-        gen.magics_renderer(function_name, self, relpath, basename)
+        return relpath, basename
 
-    def add_to_bundle(self, workdir: str, bundle: outputbundle.Writer):
+    def prepare_bundle(self, workdir: str) -> Optional[List[BundleProduct]]:
         """
-        Add render results to a tarball
+        Slice the rendered image into tiles, and encode each tile as PNG.
+
+        Tiles are also added to the pyramid shared with the other orders of
+        the tileset, which returns the lower zoom level tiles they complete
         """
         if self.output is None:
             raise RuntimeError("attempted to summarize an order before using it to produce an output")
@@ -310,22 +716,86 @@ class TileOrder(Order):
 
         start_x, start_y, width, height = (int(x) for x in basename[:-4].split("-"))
 
-        rendered = Image.open(os.path.join(workdir, self.output.relpath), mode="r")
-        # Requires PIL >= 8.0.0
-        # rendered = Image.open(os.path.join(workdir, self.output.relpath), mode='r', formats=('PNG',))
+        with Image.open(os.path.join(workdir, self.output.relpath), mode="r") as rendered:
+            # Requires PIL >= 8.0.0
+            # rendered = Image.open(os.path.join(workdir, self.output.relpath), mode='r', formats=('PNG',))
+            rendered.load()
+            # Decode the image once, and slice tiles as views of its pixels.
+            # Palette and other modes that do not map directly to an array
+            # are sliced with crop
+            pixels = numpy.asarray(rendered)
+            sliceable = rendered.mode in ("RGBA", "RGB", "LA", "L")
+            has_alpha = rendered.mode in ("RGBA", "LA")
+            # Lower zoom levels are built from RGBA pixels
+            pyramid_pixels: Optional[numpy.ndarray] = None
+            if self.pyramid is not None:
+                pyramid_pixels = pixels if rendered.mode == "RGBA" else numpy.asarray(rendered.convert("RGBA"))
 
-        # Slice the tile and add it to the bundle
-        for x in range(width):
-            for y in range(height):
-                tile = rendered.crop(
-                    (x * TILE_WIDTH_PX, y * TILE_HEIGHT_PX, (x + 1) * TILE_WIDTH_PX, (y + 1) * TILE_HEIGHT_PX)
-                )
-                with io.BytesIO() as buf:
-                    tile.save(buf, "PNG")
-                    buf.seek(0)
+            res: List[BundleProduct] = []
+            for x in range(width):
+                left = x * TILE_WIDTH_PX
+                right = left + TILE_WIDTH_PX
+                for y in range(height):
+                    top = y * TILE_HEIGHT_PX
+                    bottom = top + TILE_HEIGHT_PX
                     bundle_path = os.path.join(relpath, str(x + start_x), f"{y + start_y}.png")
-                    bundle.add_product(bundle_path, buf)
-                    log.info("Rendered %s to %s", self, bundle_path)
+                    tile_pixels = pixels[top:bottom, left:right]
+                    make_image: Callable[[], Image.Image]
+                    if sliceable:
+                        make_image = functools.partial(image_from_pixels, tile_pixels, rendered)
+                    else:
+                        make_image = functools.partial(rendered.crop, (left, top, right, bottom))
+                    res.append(tile_product(bundle_path, tile_pixels, has_alpha, self.dedup_uniform, make_image))
+
+                    if self.pyramid is not None and pyramid_pixels is not None:
+                        res.extend(
+                            self.pyramid.add(self.z, x + start_x, y + start_y, pyramid_pixels[top:bottom, left:right])
+                        )
+        return res
+
+    def add_to_bundle(self, workdir: str, bundle: outputbundle.Writer, prepared: Optional[List[BundleProduct]] = None):
+        """
+        Add render results to a tarball
+        """
+        if prepared is None:
+            prepared = self.prepare_bundle(workdir)
+            assert prepared is not None
+
+        # Add the tile slices to the bundle
+        self._add_products(bundle, prepared)
+
+        # The rendered cluster is not needed anymore once sliced
+        assert self.output is not None
+        os.unlink(os.path.join(workdir, self.output.relpath))
+
+    def finish_bundle(self) -> Optional[List[BundleProduct]]:
+        # Build the lower zoom level tiles left incomplete by orders of the
+        # tileset that failed
+        if self.pyramid is None:
+            return None
+        return self.pyramid.flush()
+
+    def add_finished_to_bundle(self, bundle: outputbundle.Writer, finished: List[BundleProduct]) -> None:
+        self._add_products(bundle, finished)
+
+    def _add_products(self, bundle: outputbundle.Writer, products: List[BundleProduct]) -> None:
+        """
+        Add tile products to the bundle
+        """
+        for product in products:
+            if product.tile is not None:
+                self.pyramid_tiles.append((product.tile, product.path))
+            if product.data is None:
+                self.tile_refs[product.path] = None
+                log.info("Rendered %s to %s: fully transparent, not stored", self, product.path)
+            elif product.uniform:
+                ref = bundle.add_shared_product(product.data)
+                self.tile_refs[product.path] = ref
+                log.info("Rendered %s to %s: single colour, stored as %s", self, product.path, ref)
+            else:
+                with io.BytesIO(product.data) as buf:
+                    bundle.add_product(product.path, buf)
+                log.info("Rendered %s to %s", self, product.path)
 
     def summarize_outputs(self, products_info: outputbundle.ReftimeProducts):
         """
@@ -350,7 +820,7 @@ class TileOrder(Order):
             for y in range(height):
                 bundle_path = os.path.join(relpath, str(x + start_x), f"{y + start_y}.png")
 
-                kwargs = {}
+                kwargs: Dict[str, Any] = {}
                 georef = self.georeference()
                 if georef is not None:
                     tile_georef = georef.copy()
@@ -361,8 +831,28 @@ class TileOrder(Order):
                         latmin + (y + 1) * lat_height,
                     ]
                     kwargs["georef"] = tile_georef
+                if bundle_path in self.tile_refs:
+                    ref = self.tile_refs[bundle_path]
+                    if ref is None:
+                        kwargs["empty"] = True
+                    else:
+                        kwargs["ref"] = ref
                 products_info.add_product(bundle_path, **kwargs)
 
+        # Add information about the lower zoom level tiles built from this
+        # order
+        for (z, x, y), bundle_path in self.pyramid_tiles:
+            kwargs = {}
+            if self.has_basemap:
+                kwargs["georef"] = tile_georeference(z, x, y, 1, 1)
+            if bundle_path in self.tile_refs:
+                ref = self.tile_refs[bundle_path]
+                if ref is None:
+                    kwargs["empty"] = True
+                else:
+                    kwargs["ref"] = ref
+            products_info.add_product(bundle_path, **kwargs)
+
     @classmethod
     def make_orders(
         cls,
@@ -377,13 +867,83 @@ class TileOrder(Order):
         lon_max: float,
         zoom_min: int,
         zoom_max: int,
+        dedup_uniform: bool = False,
+        pyramid_zoom: Optional[int] = None,
+        mask: Optional[List[Tuple[float, float, float, float]]] = None,
+        data_area: Optional[Tuple[float, float, float, float]] = None,
     ) -> Generator["TileOrder", None, None]:
+        """
+        Generate the orders for a tileset.
+
+        If pyramid_zoom is set, zoom levels below it are not rendered, and are
+        built by downsampling the tiles rendered at pyramid_zoom.
+
+        If mask is set, it is a list of (lon_min, lat_min, lon_max, lat_max)
+        areas, and tile groups that do not intersect any of them are skipped.
+
+        If data_area is set, it is the (lon_min, lat_min, lon_max, lat_max)
+        area covered by the input data, and tile groups outside of it are
+        skipped, since they would render as empty images. lon_min is greater
+        than lon_max if the area crosses the antimeridian
+        """
+        from .costs import tile_group_sizes
+
+        if pyramid_zoom is not None and not zoom_min <= pyramid_zoom <= zoom_max:
+            raise RuntimeError(f"pyramid zoom level {pyramid_zoom} is outside of zoom levels {zoom_min}-{zoom_max}")
+
+        # Ranges of tiles to render for each zoom level, as (x_min, x_max,
+        # y_min, y_max) with the maximum excluded
+        levels: Dict[int, Tuple[int, int, int, int]] = {}
         for z in range(zoom_min, zoom_max + 1):
+            if pyramid_zoom is not None and z < pyramid_zoom:
+                continue
             x_min, y_min = deg2num(lon_min, lat_min, z)
             x_max, y_max = deg2num(lon_max, lat_max, z)
             x_min, x_max = sorted((x_min, x_max))
             y_min, y_max = sorted((y_min, y_max))
-            for x, y, w, h in cls.tessellate(x_min, x_max + 1, y_min, y_max + 1, flavour.config.tile_group_width):
+            levels[z] = (x_min, x_max + 1, y_min, y_max + 1)
+
+        group_sizes = tile_group_sizes(
+            flavour.config,
+            flavour.name,
+            recipe.name,
+            {z: (x_max - x_min) * (y_max - y_min) for z, (x_min, x_max, y_min, y_max) in levels.items()},
+        )
+
+        data_areas: Optional[List[Tuple[float, float, float, float]]] = None
+        if data_area is not None:
+            area_lon_min, area_lat_min, area_lon_max, area_lat_max = data_area
+            if area_lon_min > area_lon_max:
+                # Split areas crossing the antimeridian in two
+                data_areas = [
+                    (area_lon_min, area_lat_min, 180.0, area_lat_max),
+                    (-180.0, area_lat_min, area_lon_max, area_lat_max),
+                ]
+            else:
+                data_areas = [data_area]
+
+        # All tiles share the same steps, except for the basemap area
+        tile_steps = TileSteps(flavour, recipe, input_files)
+        for z, (x_min, x_max, y_min, y_max) in levels.items():
+            group_width, group_height = group_sizes[z]
+            clusters = [
+                cluster
+                for cluster in cls.tessellate(x_min, x_max, y_min, y_max, group_width, group_height)
+                if (mask is None or cls.intersects(z, cluster, mask))
+                and (data_areas is None or cls.intersects(z, cluster, data_areas))
+            ]
+            if not clusters:
+                log.debug("%s/%s: no tiles to render at zoom level %d", flavour.name, recipe.name, z)
+            pyramid: Optional[TilePyramid] = None
+            if z == pyramid_zoom and z > zoom_min:
+                pyramid = TilePyramid(
+                    tileset_relpath(flavour, recipe, instant),
+                    z,
+                    zoom_min,
+                    ((x + dx, y + dy) for x, y, w, h in clusters for dx in range(w) for dy in range(h)),
+                    dedup_uniform=dedup_uniform,
+                )
+            for x, y, w, h in clusters:
                 yield cls(
                     flavour=flavour,
                     recipe=recipe,
@@ -394,17 +954,43 @@ class TileOrder(Order):
                     y=y,
                     w=w,
                     h=h,
+                    tile_steps=tile_steps,
+                    dedup_uniform=dedup_uniform,
+                    pyramid=pyramid,
                 )
 
+    @classmethod
+    def intersects(
+        cls, z: int, cluster: Tuple[int, int, int, int], areas: List[Tuple[float, float, float, float]]
+    ) -> bool:
+        """
+        Check if a (x, y, width, height) group of tiles intersects any of the
+        given (lon_min, lat_min, lon_max, lat_max) areas
+        """
+        x, y, w, h = cluster
+        lon_min, lat_min, lon_max, lat_max = tile_georeference(z, x, y, w, h)["bbox"]
+        for area_lon_min, area_lat_min, area_lon_max, area_lat_max in areas:
+            if (
+                lon_min <= area_lon_max
+                and area_lon_min <= lon_max
+                and lat_min <= area_lat_max
+                and area_lat_min <= lat_max
+            ):
+                return True
+        return False
+
     @classmethod
     def tessellate(
-        cls, x_min: int, x_max: int, y_min: int, y_max: int, max_side: int
+        cls, x_min: int, x_max: int, y_min: int, y_max: int, max_side: int, max_height: Optional[int] = None
     ) -> Generator[Tuple[int, int, int, int], None, None]:
         """
         Generate a sequence of (x, y, width, height) rectangles covering the
-        given surface. Each rectangle's area will not exceed max_side**2, and
-        the tiling will try to make square tiles
+        given surface. Each rectangle's area will not exceed max_side**2 (or
+        max_side * max_height if max_height is given), and the tiling will try
+        to make square tiles
         """
+        if max_height is None:
+            max_height = max_side
         # print("Tessellate", x_min, x_max, y_min, y_max, max_side)
         width = x_max - x_min
         height = y_max - y_min
@@ -413,8 +999,8 @@ class TileOrder(Order):
             return
 
         # Carve a horizontal stripe as large as we can go
-        tile_height = min(height, max_side)
-        tile_width = min(width, max_side * max_side // tile_height)
+        tile_height = min(height, max_height)
+        tile_width = min(width, max_side * max_height // tile_height)
         # print("     tw th", tile_width, tile_height, "iterate", width, "step=", tile_width)
         for x in range(0, width, tile_width):
             # print("       gen", x_min + x, y_min, min(tile_width, x_max - x_min - x), tile_height)
@@ -425,7 +1011,7 @@ class TileOrder(Order):
             # print("     done!")
             return
         # print("   recurse", x_min, x_max, y_min, y_max, max_side)
-        yield from cls.tessellate(x_min, x_max, y_min, y_max, max_side)
+        yield from cls.tessellate(x_min, x_max, y_min, y_max, max_side, max_height)
 
 
 class LegendOrder(Order):
@@ -447,12 +1033,9 @@ class LegendOrder(Order):
     def __repr__(self):
         return f"{self.__class__.__name__}({str(self)})"
 
-    def print_python_function(self, function_name: str, gen: PyGen):
-        """
-        Print a function that renders this order
-        """
+    def output_relpath(self) -> Tuple[str, str]:
         # Destination directory inside the output
         relpath = f"{self.instant.reftime:%Y-%m-%dT%H:%M:%S}/"
         # Destination file name (without path or .png extension)
         basename = f"{self.recipe.name}_{self.flavour.name}+legend"
-        gen.magics_renderer(function_name, self, relpath, basename)
+        return relpath, basename
@@ -28,6 +28,7 @@ Example program to show all products in a zip bundle::
         print(json.dumps({"path": path, "georef": georef, "legend": legend_info}, indent=1))
 """
 
+import hashlib
 import io
 import json
 import logging
@@ -84,6 +85,8 @@ class InputProcessingStats(Serializable):
     computation_log: List[Tuple[int, str]] = pydantic.Field(default_factory=list)
     #: List of recipes that used this input to generate products
     used_by: Set[str] = pydantic.Field(default_factory=set)
+    #: Number of duplicate messages found in input and dropped
+    dropped_duplicates: int = 0
 
     def add_computation_log(self, elapsed: int, what: str) -> None:
         """
@@ -98,6 +101,8 @@ class InputProcessingStats(Serializable):
         res = super().dict(*args, **kwargs)
         res["used_by"] = sorted(res["used_by"])
         res["computation"] = res.pop("computation_log")
+        if not res["dropped_duplicates"]:
+            del res["dropped_duplicates"]
         return res
 
     @pydantic.root_validator(pre=True, allow_reuse=True)
@@ -133,6 +138,14 @@ class RenderStats(Serializable):
     """Rendering statistics."""
 
     time_ns: int = 0
+    #: Number of products taken from the render cache, not counted in time_ns
+    cached: int = 0
+
+    def dict(self, *args: Any, **kwargs: Any) -> Dict[str, Any]:
+        res = super().dict(*args, **kwargs)
+        if not res["cached"]:
+            del res["cached"]
+        return res
 
 
 class ProductInfo(Serializable):
@@ -140,6 +153,19 @@ class ProductInfo(Serializable):
 
     #: Georeferencing information
     georef: Optional[Dict[str, Any]] = None
+    #: Path in the bundle of the image data, when it is shared with other
+    #: identical products
+    ref: Optional[str] = None
+    #: True if the product is fully transparent, and no image is stored for it
+    empty: bool = False
+
+    def dict(self, *args: Any, **kwargs: Any) -> Dict[str, Any]:
+        res = super().dict(*args, **kwargs)
+        if res["ref"] is None:
+            del res["ref"]
+        if not res["empty"]:
+            del res["empty"]
+        return res
 
 
 class ReftimeProducts(Serializable):
@@ -166,15 +192,26 @@ class ReftimeProducts(Serializable):
             for step in order.order_steps:
                 if isinstance(step, steps.AddContour):
                     self.legend_info = step.spec.params.dict(exclude_unset=True)
-        self.render_stats.time_ns += order.render_time_ns
-        order.summarize_outputs(self)
-
-    def add_product(self, relpath: str, georef: Optional[Dict[str, Any]] = None) -> None:
+        if order.cached:
+            # The product has not been rendered in this run: count it
+            # separately so that it does not skew render times
+            count = len(self.products)
+            order.summarize_outputs(self)
+            self.render_stats.cached += len(self.products) - count
+        else:
+            self.render_stats.time_ns += order.render_time_ns
+            order.summarize_outputs(self)
+
+    def add_product(
+        self, relpath: str, georef: Optional[Dict[str, Any]] = None, ref: Optional[str] = None, empty: bool = False
+    ) -> None:
         """Add information for a product."""
         product = self.products.get(relpath)
         if product is None:
             self.products[relpath] = product = ProductInfo()
         product.georef = georef
+        product.ref = ref
+        product.empty = empty
 
     def dict(self, *args: Any, **kwargs: Any) -> Dict[str, Any]:
         res = super().dict(*args, **kwargs)
@@ -240,6 +277,11 @@ class PathInfo(NamedTuple):
     recipe: str
     #: Georeferencing information
     georef: Optional[Dict[str, Any]] = None
+    #: Path in the bundle of the image data, when it is shared with other
+    #: identical products
+    ref: Optional[str] = None
+    #: True if the product is fully transparent, and no image is stored for it
+    empty: bool = False
 
 
 class RecipeOrders(NamedTuple):
@@ -284,7 +326,7 @@ class Products(Serializable):
         for (flavour, recipe), rp in self.products.items():
             for prods in rp.reftimes.values():
                 for path, info in prods.products.items():
-                    res[path] = PathInfo(recipe=recipe, georef=info.georef)
+                    res[path] = PathInfo(recipe=recipe, georef=info.georef, ref=info.ref, empty=info.empty)
         return res
 
     @property
@@ -380,11 +422,28 @@ class Log(Serializable):
         return super().parse_obj(obj)
 
 
+def empty_tile() -> bytes:
+    """
+    Return the PNG data of a fully transparent tile
+    """
+    from PIL import Image
+
+    from .orders import TILE_HEIGHT_PX, TILE_WIDTH_PX
+
+    with io.BytesIO() as buf:
+        Image.new("RGBA", (TILE_WIDTH_PX, TILE_HEIGHT_PX), (0, 0, 0, 0)).save(buf, format="PNG")
+        return buf.getvalue()
+
+
 class Reader(ABC):
     """
     Read functions for output bundles
     """
 
+    def __init__(self) -> None:
+        # Product information by path, loaded when first needed
+        self._by_path: Optional[Dict[str, PathInfo]] = None
+
     @abstractmethod
     def __enter__(self): ...
 
@@ -428,12 +487,34 @@ class Reader(ABC):
         """
 
     @abstractmethod
+    def _has(self, path: str) -> bool:
+        """
+        Check if the bundle contains a file
+        """
+
+    @abstractmethod
+    def _load_data(self, path: str) -> bytes:
+        """
+        Load the contents of a file
+        """
+
     def load_product(self, bundle_path: str) -> bytes:
         """
         Load a product by its path.
 
-        Return the raw PNG image data
+        Return the raw PNG image data. Products sharing their image data with
+        other products are read from the shared data, and fully transparent
+        products that are not stored return a transparent tile
         """
+        if not self._has(bundle_path):
+            if self._by_path is None:
+                self._by_path = self.products().by_path
+            info = self._by_path.get(bundle_path)
+            if info is not None and info.ref is not None:
+                return self._load_data(info.ref)
+            if info is not None and info.empty:
+                return empty_tile()
+        return self._load_data(bundle_path)
 
     @abstractmethod
     def load_artifact(self, bundle_path: str) -> bytes:
@@ -462,6 +543,7 @@ class TarReader(Reader):
         """
         Read an existing output bundle
         """
+        super().__init__()
         self.tarfile = tarfile.open(path, mode="r")
         self.path = Path(path)
 
@@ -485,12 +567,19 @@ class TarReader(Reader):
         with self._extract("version.txt") as fd:
             return fd.read().strip().decode()
 
-    def load_product(self, bundle_path: str) -> bytes:
-        with self._extract(bundle_path) as fd:
+    def _has(self, path: str) -> bool:
+        try:
+            self.tarfile.getmember(path)
+        except KeyError:
+            return False
+        return True
+
+    def _load_data(self, path: str) -> bytes:
+        with self._extract(path) as fd:
             return fd.read()
 
     def load_artifact(self, bundle_path: str) -> bytes:
-        return self.load_product(bundle_path)
+        return self._load_data(bundle_path)
 
     def find(self) -> List[str]:
         """
@@ -517,6 +606,7 @@ class ZipReader(Reader):
         """
         Read an existing output bundle
         """
+        super().__init__()
         self.zipfile = zipfile.ZipFile(path, mode="r")
         self.path = Path(path)
 
@@ -532,11 +622,18 @@ class ZipReader(Reader):
     def version(self) -> str:
         return self.zipfile.read("version.txt").strip().decode()
 
-    def load_product(self, bundle_path: str) -> bytes:
-        return self.zipfile.read(bundle_path)
+    def _has(self, path: str) -> bool:
+        try:
+            self.zipfile.getinfo(path)
+        except KeyError:
+            return False
+        return True
+
+    def _load_data(self, path: str) -> bytes:
+        return self.zipfile.read(path)
 
     def load_artifact(self, bundle_path: str) -> bytes:
-        return self.load_product(bundle_path)
+        return self._load_data(bundle_path)
 
     def find(self) -> List[str]:
         """
@@ -550,6 +647,10 @@ class Writer(ABC):
     Write functions for output bundles
     """
 
+    def __init__(self) -> None:
+        # Paths of image data shared by multiple products already in the bundle
+        self.shared_products: Set[str] = set()
+
     @abstractmethod
     def __enter__(self): ...
 
@@ -590,6 +691,20 @@ class Writer(ABC):
         Add a product
         """
 
+    def add_shared_product(self, data: bytes) -> str:
+        """
+        Add image data shared by multiple products, storing it only once per
+        content.
+
+        Return the path of the image data in the bundle
+        """
+        bundle_path = f"shared/{hashlib.sha256(data).hexdigest()}.png"
+        if bundle_path not in self.shared_products:
+            with io.BytesIO(data) as buf:
+                self.add_product(bundle_path, buf)
+            self.shared_products.add(bundle_path)
+        return bundle_path
+
     @abstractmethod
     def add_artifact(self, bundle_path: str, data: IO[bytes]):
         """
@@ -606,6 +721,7 @@ class TarWriter(Writer):
         """
         Create a new output bundle, written to the given file descriptor
         """
+        super().__init__()
         self.tarfile = tarfile.open(mode="w|", fileobj=out)
         with io.BytesIO() as buf:
             buf.write(b"1\n")
@@ -647,6 +763,7 @@ class ZipWriter(Writer):
         """
         Create a new output bundle, written to the given file descriptor
         """
+        super().__init__()
         self.zipfile = zipfile.ZipFile(out, mode="w", compression=zipfile.ZIP_STORED)
         self.zipfile.writestr("version.txt", "1\n")
 
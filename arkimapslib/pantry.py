@@ -2,16 +2,38 @@
 import abc
 import contextlib
 import datetime
+import functools
+import hashlib
 import logging
+import mmap
 import os
 import re
 import shutil
 import subprocess
 import sys
 import tempfile
-from collections import defaultdict
+import threading
+import types
+from collections import defaultdict, deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 from pathlib import Path
-from typing import TYPE_CHECKING, Any, BinaryIO, Dict, List, NamedTuple, Optional, Set, Tuple
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    BinaryIO,
+    Callable,
+    Deque,
+    Dict,
+    Generic,
+    Iterable,
+    List,
+    Mapping,
+    NamedTuple,
+    Optional,
+    Set,
+    Tuple,
+    TypeVar,
+)
 
 try:
     import arkimet
@@ -22,8 +44,12 @@ except ModuleNotFoundError:
 
 import eccodes
 
-from .inputs import Input, InputFile, Inputs, Instant
+from .eccodesfilter import Matcher, MessageKeys, compile_filter
+from .filepool import FilePool
+from .grib import ValuesCache, new_from_message_headers, scan_messages
+from .inputs import Derived, Input, InputFile, Inputs, Instant
 from .outputbundle import InputProcessingStats
+from .toposort import TopologicalSorter
 from .types import ModelStep
 
 if TYPE_CHECKING:
@@ -46,6 +72,175 @@ def keep_only_first_grib(fname: Path) -> None:
             eccodes.codes_release(gid)
 
 
+# Discriminating product fields of a GRIB message: (style, table, product)
+# for GRIB1, (style, category, number) for GRIB2
+ProductKey = Tuple[str, int, int]
+
+re_or = re.compile(r"\s+or\s+", re.IGNORECASE)
+
+
+def arkimet_product_keys(expression: str) -> Optional[List[ProductKey]]:
+    """
+    Return the product keys that can be matched by an arkimet match
+    expression, or None if the expression could match any product
+    """
+    for part in expression.split(";"):
+        name, sep, value = part.partition(":")
+        if sep and name.strip().lower() == "product":
+            break
+    else:
+        return None
+
+    res: List[ProductKey] = []
+    for alternative in re_or.split(value.strip()):
+        fields = [f.strip() for f in alternative.split(",")]
+        style = fields[0].upper()
+        if style == "GRIB1":
+            discriminants = fields[2:4]
+        elif style == "GRIB2":
+            discriminants = fields[3:5]
+        else:
+            return None
+        if len(discriminants) != 2 or not all(discriminants):
+            return None
+        try:
+            res.append((style, int(discriminants[0]), int(discriminants[1])))
+        except ValueError:
+            return None
+    return res
+
+
+class MatcherIndex:
+    """
+    Index of arkimet matchers by the product keys they can match, used to
+    avoid testing metadata against matchers that cannot match it
+    """
+
+    def __init__(self, todo_list: List[Tuple[Any, Input]]) -> None:
+        self.todo_list = todo_list
+        # Positions in todo_list of the matchers that can match each product
+        self.by_product: Dict[ProductKey, List[int]] = defaultdict(list)
+        # Positions in todo_list of the matchers that can match any product
+        self.any_product: List[int] = []
+        for pos, (matcher, inp) in enumerate(todo_list):
+            keys = arkimet_product_keys(getattr(inp.spec, "arkimet", None) or "")
+            if keys is None:
+                self.any_product.append(pos)
+            else:
+                for key in keys:
+                    self.by_product[key].append(pos)
+        # Candidate matchers for each product key seen so far
+        self.candidates_cache: Dict[Optional[ProductKey], List[Tuple[Any, Input]]] = {}
+
+    def candidates(self, key: Optional[ProductKey]) -> List[Tuple[Any, Input]]:
+        """
+        Return the (matcher, input) pairs that can match a product, in
+        todo_list order
+        """
+        res = self.candidates_cache.get(key)
+        if res is None:
+            positions = set(self.any_product)
+            if key is not None:
+                positions.update(self.by_product.get(key, ()))
+            res = self.candidates_cache[key] = [self.todo_list[pos] for pos in sorted(positions)]
+        return res
+
+
+MSG = TypeVar("MSG")
+RES = TypeVar("RES")
+
+
+class ShardedDispatch(Generic[MSG, RES]):
+    """
+    Match messages on multiple threads, and store the results in input order.
+
+    Messages are grouped in shards of ``shard_size`` consecutive messages,
+    which are matched in parallel while more input is read. Results are
+    stored in the main thread in the same order as the input, so that the
+    pantry contents do not depend on the number of jobs.
+
+    Threads are enough to match in parallel: most of the matching time is
+    spent decoding message headers in eccodes, whose Python bindings release
+    the GIL while calling into the C library.
+    """
+
+    def __init__(
+        self, match: Callable[[MSG], RES], store: Callable[[MSG, RES], None], jobs: int = 1, shard_size: int = 16
+    ) -> None:
+        self.match = match
+        self.store = store
+        self.jobs = jobs
+        self.shard_size = shard_size
+        self.executor: Optional[ThreadPoolExecutor] = None
+        # Messages not yet submitted for matching
+        self.pending: List[MSG] = []
+        # Shards being matched, in input order
+        self.in_flight: Deque[Tuple[List[MSG], "Future[List[RES]]"]] = deque()
+
+    def __enter__(self):
+        if self.jobs > 1:
+            self.executor = ThreadPoolExecutor(max_workers=self.jobs)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        try:
+            if exc_type is None:
+                self.flush()
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown(wait=True)
+                self.executor = None
+
+    @property
+    def parallel(self) -> bool:
+        """
+        Check if messages are matched on worker threads.
+
+        If not, add() matches and stores each message right away
+        """
+        return self.executor is not None
+
+    def _match_shard(self, shard: List[MSG]) -> List[RES]:
+        return [self.match(msg) for msg in shard]
+
+    def _store_shard(self) -> None:
+        shard, future = self.in_flight.popleft()
+        for msg, res in zip(shard, future.result()):
+            self.store(msg, res)
+
+    def add(self, msg: MSG) -> None:
+        """
+        Dispatch a message
+        """
+        if self.executor is None:
+            self.store(msg, self.match(msg))
+            return
+
+        self.pending.append(msg)
+        if len(self.pending) < self.shard_size:
+            return
+        self.in_flight.append((self.pending, self.executor.submit(self._match_shard, self.pending)))
+        self.pending = []
+        # Keep enough shards in flight to keep all workers busy
+        while len(self.in_flight) > self.jobs * 2:
+            self._store_shard()
+
+    def flush(self) -> None:
+        """
+        Store the results of all the messages dispatched so far
+        """
+        if self.pending:
+            assert self.executor is not None
+            self.in_flight.append((self.pending, self.executor.submit(self._match_shard, self.pending)))
+            self.pending = []
+        while self.in_flight:
+            self._store_shard()
+
+
+# First line of the pantry index, identifying its format
+INDEX_HEADER = "arkimaps pantry index 2"
+
+
 class ProcessLogEntry(NamedTuple):
     """
     Entry used to trace input processing operations
@@ -72,17 +267,65 @@ class Pantry(abc.ABC):
         # Set of input steps for which the data in the pantry contains multiple
         # elements and needs to be truncated
         self.input_instants_to_truncate: Dict[Input, Set[Instant]] = defaultdict(set)
+        # Lock serializing changes to the pantry contents, for inputs generated
+        # in parallel
+        self.lock = threading.Lock()
+        # Number of derived inputs currently being generated in parallel, used
+        # to share the available CPUs with the instants generated by each
+        self.derived_jobs = 1
+        # Results of get_instants, by input name and model, until instants are
+        # added for an input with that name
+        self.instants_cache: Dict[str, Dict[Optional[str], Mapping[Optional[Instant], InputFile]]] = {}
+        # Incremented every time instants are added
+        self.instants_cache_version = 0
+
+    def add_instant(self, inp: Input, instant: Instant) -> bool:
+        """
+        Notify that the pantry contains data for this input for the given step.
+
+        Returns False if the pantry already had data for it: in that case the
+        pantry file is truncated to its first message by
+        notify_pantry_filled.
+        """
+        with self.lock:
+            instants = self.input_instants[inp]
+
+            if instant in instants:
+                log.warning("%s: multiple data found for %s", inp.name, instant)
+                self.input_instants_to_truncate[inp].add(instant)
+                self.input_stats[inp].dropped_duplicates += 1
+                return False
+            instants.add(instant)
+            self._invalidate_instants(inp.name)
+            return True
 
-    def add_instant(self, inp: Input, instant: Instant) -> None:
+    def reserve_instant(self, inp: Input, instant: Instant) -> bool:
         """
-        Notify that the pantry contains data for this input for the given step
+        Notify that data for this input for the given step is about to be
+        written to the pantry.
+
+        Returns False if the pantry already has data for it: in that case the
+        duplicate data should not be written.
         """
-        instants = self.input_instants[inp]
+        with self.lock:
+            instants = self.input_instants[inp]
+
+            if instant in instants:
+                log.debug("%s: multiple data found for %s: skipping duplicate", inp.name, instant)
+                self.input_stats[inp].dropped_duplicates += 1
+                return False
+            instants.add(instant)
+            self._invalidate_instants(inp.name)
+            return True
 
-        if instant in instants:
-            log.warning("%s: multiple data found for %s", inp.name, instant)
-            self.input_instants_to_truncate[inp].add(instant)
-        instants.add(instant)
+    def _invalidate_instants(self, name: str) -> None:
+        """
+        Forget the cached instants of inputs with the given name.
+
+        This needs to be called while holding the lock
+        """
+        self.instants_cache.pop(name, None)
+        self.instants_cache_version += 1
 
     def log_input_processing(self, input: Input, message: str):
         """
@@ -122,9 +365,17 @@ class DiskPantry(Pantry):
     Pantry with disk-based storage
     """
 
-    def __init__(self, *, root: Path, **kwargs) -> None:
+    def __init__(self, *, root: Path, values_cache: Optional[ValuesCache] = None, **kwargs) -> None:
         super().__init__(**kwargs)
         self.data_root: Path = root / "pantry"
+        # Decoded GRIB values shared by derived inputs
+        self.values_cache = values_cache if values_cache is not None else ValuesCache()
+        # Index of the pantry contents, read by rescan instead of listing the
+        # pantry directory
+        self.index_file: Path = self.data_root / "index"
+        # True if input_instants lists all the data in the pantry, so that it
+        # can be written to the index
+        self.index_complete = False
 
     def get_basename(self, inp: Input, instant: Instant, fmt="grib") -> Path:
         """
@@ -168,42 +419,218 @@ class DiskPantry(Pantry):
             pantry_basename = f"{inp.spec.model}_{inp.name}"
         return self.data_root / f"{pantry_basename}_[year]_[month]_[day]_[hour]_[minute]_[second]+[endStep].{fmt}"
 
-    def get_instants(self, input_name: str, model: Optional[str] = None) -> Dict[Optional[Instant], InputFile]:
+    def get_instants(self, input_name: str, model: Optional[str] = None) -> Mapping[Optional[Instant], InputFile]:
         """
         Return the instants available in the pantry for the input with the given
-        name
+        name.
+
+        The result is cached until new instants are added for the input, and
+        is shared with other callers, so it cannot be modified
         """
+        with self.lock:
+            cached = self.instants_cache.get(input_name, {}).get(model)
+            version = self.instants_cache_version
+        if cached is not None:
+            return cached
+
         res: Dict[Optional[Instant], InputFile] = {}
 
         # Skip inputs for mismatching models (see #114)
         inps = self.inputs.get(input_name, model)
-        if not inps:
-            return res
-
         for inp in inps:
             instants = inp.get_instants(self)
             for instant, input_file in instants.items():
                 # Keep the first available version for each instant
                 res.setdefault(instant, input_file)
-        return res
+
+        result = types.MappingProxyType(res)
+        with self.lock:
+            # Do not cache results that may have been invalidated while they
+            # were computed
+            if self.instants_cache_version == version:
+                self.instants_cache.setdefault(input_name, {})[model] = result
+        return result
+
+    def generate_derived(self, input_names: Iterable[str], jobs: int = 1) -> None:
+        """
+        Generate the derived inputs with the given names, and the derived
+        inputs they depend on.
+
+        Inputs that do not depend on each other are generated in parallel, on
+        at most ``jobs`` threads. Most of the work is done by external
+        commands or eccodes and numpy, which do not hold the GIL.
+        """
+        # Build the dependency graph of derived inputs
+        graph: Dict[Derived, List[Derived]] = {}
+        todo = list(input_names)
+        seen: Set[str] = set()
+        while todo:
+            name = todo.pop()
+            if name in seen:
+                continue
+            seen.add(name)
+            for inp in self.inputs.get(name):
+                if not isinstance(inp, Derived):
+                    continue
+                deps: List[Derived] = []
+                for dep_name in inp.get_all_inputs():
+                    deps.extend(dep for dep in self.inputs.get(dep_name) if isinstance(dep, Derived))
+                    todo.append(dep_name)
+                graph[inp] = deps
+
+        if not graph:
+            return
+
+        log.info("generating %d derived inputs using %d parallel jobs", len(graph), jobs)
+        sorter = TopologicalSorter(graph)
+        sorter.prepare()
+        running: Dict[Future, Derived] = {}
+        self.derived_jobs = jobs
+        try:
+            with ThreadPoolExecutor(max_workers=jobs) as executor:
+                while sorter.is_active():
+                    for inp in sorter.get_ready():
+                        # get_instants generates the input the first time it
+                        # is called
+                        running[executor.submit(inp.get_instants, self)] = inp
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        inp = running.pop(future)
+                        # Raise any exception from generation
+                        future.result()
+                        sorter.done(inp)
+        finally:
+            self.derived_jobs = 1
+
+        self.write_index()
+
+    def start_fill(self) -> None:
+        """
+        Create the pantry directory if missing, before filling it
+        """
+        self.data_root.mkdir(parents=True, exist_ok=True)
+        # If the pantry is empty, all its contents will be known after filling
+        # it. Otherwise, the index is rebuilt on the next rescan
+        self.index_complete = not any(self.data_root.iterdir())
+
+    def write_index(self) -> None:
+        """
+        Write the list of instants available for each input to the pantry
+        index, if all the pantry contents are known
+        """
+        if not self.index_complete:
+            return
+
+        with self.lock:
+            lines = [INDEX_HEADER, self._contents_digest()]
+            for inp, instants in self.input_instants.items():
+                prefix = f"{inp.spec.model or ''},{inp.name}"
+                for instant in instants:
+                    rt = instant.reftime
+                    lines.append(
+                        f"{prefix},{rt.year},{rt.month},{rt.day},{rt.hour},{rt.minute},{rt.second},{instant.step}"
+                    )
+
+        with tempfile.NamedTemporaryFile("wt", dir=self.data_root, prefix="index.", delete=False) as fd:
+            try:
+                fd.write("\n".join(lines))
+                fd.write("\n")
+            except BaseException:
+                os.unlink(fd.name)
+                raise
+        os.replace(fd.name, self.index_file)
+
+    def _contents_digest(self) -> str:
+        """
+        Return a digest of the names, sizes and modification times of the
+        files in the pantry, used to check if the index is up to date
+        """
+        entries = []
+        with os.scandir(self.data_root) as it:
+            for entry in it:
+                # Skip the index and its temporary files
+                if entry.name.startswith("index") or not entry.is_file():
+                    continue
+                st = entry.stat()
+                entries.append(f"{entry.name},{st.st_size},{st.st_mtime_ns}")
+        entries.sort()
+        return hashlib.sha256("\n".join(entries).encode()).hexdigest()
+
+    def read_index(self) -> bool:
+        """
+        Load the instants available for each input from the pantry index.
+
+        Returns False if the index is missing, does not match the pantry
+        contents, or refers to unknown inputs
+        """
+        try:
+            lines = self.index_file.read_text().splitlines()
+        except FileNotFoundError:
+            return False
+        if len(lines) < 2 or lines[0] != INDEX_HEADER:
+            log.info("%s: unsupported pantry index format", self.index_file)
+            return False
+        if lines[1] != self._contents_digest():
+            log.info("%s: pantry index is out of date", self.index_file)
+            return False
+
+        by_name: Dict[Tuple[str, str], Input] = {}
+        input_instants: Dict[Input, Set[Instant]] = defaultdict(set)
+        for line in lines[2:]:
+            model, name, ye, mo, da, ho, mi, se, step = line.split(",")
+            inp = by_name.get((model, name))
+            if inp is None:
+                inps = [inp for inp in self.inputs.get(name) if (inp.spec.model or "") == model]
+                if not inps:
+                    log.info("%s: pantry index refers to unknown input %s", self.index_file, name)
+                    return False
+                inp = by_name[(model, name)] = inps[0]
+            reftime = datetime.datetime(int(ye), int(mo), int(da), int(ho), int(mi), int(se))
+            input_instants[inp].add(Instant(reftime, step))
+
+        with self.lock:
+            for inp, instants in input_instants.items():
+                self.input_instants[inp].update(instants)
+                self._invalidate_instants(inp.name)
+        return True
 
     def notify_pantry_filled(self):
         """
         Let inputs know that we are done filtering initial data
         """
+        for inp, stats in self.input_stats.items():
+            if stats.dropped_duplicates:
+                log.warning("%s: dropped %d duplicate input messages", inp.name, stats.dropped_duplicates)
         for inp, instants in self.input_instants_to_truncate.items():
             for instant in instants:
                 fname = self.get_fullname(inp, instant)
                 keep_only_first_grib(fname)
         self.input_instants_to_truncate.clear()
+        self.write_index()
 
     def rescan(self):
+        """
+        Load the list of data available in the pantry, from the pantry index
+        if it is up to date, or else by listing the pantry directory
+        """
+        if self.read_index():
+            self.index_complete = True
+        else:
+            self.scan_directory()
+
+    def scan_directory(self):
+        """
+        Load the list of data available in the pantry by listing the pantry
+        directory, and rebuild the pantry index
+        """
         fn_match = re.compile(
             r"^(?:(?P<model>\w+)_)?(?P<name>\w+)_" r"(?P<reftime>\d+_\d+_\d+_\d+_\d+_\d+)\+(?P<step>\d+)\.(?P<ext>\w+)$"
         )
         for fn in self.data_root.iterdir():
             if "grib_filter_rules" in fn.name or fn.name == "static" or fn.name.endswith("-processed"):
                 continue
+            if fn == self.index_file or fn.name.startswith("index."):
+                continue
 
             mo = fn_match.match(fn.name)
             if not mo:
@@ -220,12 +647,29 @@ class DiskPantry(Pantry):
             step = int(mo.group("step"))
             self.add_instant(inp, Instant(datetime.datetime.strptime(reftime, "%Y_%m_%d_%H_%M_%S"), step))
 
+        self.index_complete = True
+        self.write_index()
+
 
 class DispatchPantry(DiskPantry, abc.ABC):
     """
     Pantry with dispatching methods
     """
 
+    def __init__(
+        self, *, max_open_files: int = 64, write_buffer_size: int = 1024 * 1024, dispatch_jobs: int = 1, **kwargs
+    ) -> None:
+        super().__init__(**kwargs)
+        # Files being written by dispatching
+        self.file_pool = FilePool(max_open=max_open_files, buffer_size=write_buffer_size)
+        # Number of threads used to match input messages
+        self.dispatch_jobs = dispatch_jobs
+
+    def notify_pantry_filled(self):
+        # Write all dispatched data before looking at the pantry contents
+        self.file_pool.close()
+        super().notify_pantry_filled()
+
     @abc.abstractmethod
     def fill(self, path: Optional[Path] = None, input_filter: Optional[Set[str]] = None):
         """
@@ -278,7 +722,7 @@ if HAS_ARKIMET:
             Read data from standard input and acquire it into the pantry
             """
             # Create pantry dir if missing
-            self.data_root.mkdir(parents=True, exist_ok=True)
+            self.start_fill()
 
             # Dispatch todo-list
             todo_list: List[Tuple[Any, Input]] = []
@@ -314,57 +758,99 @@ if HAS_ARKIMET:
             self.pantry = pantry
             self.data_root = pantry.data_root
             self.todo_list = todo_list
+            self.index = MatcherIndex(todo_list)
+            # If available, write data directly from arkimet without creating
+            # an intermediate python bytes object
+            self.write_data: Optional[Callable[["arkimet.Metadata", BinaryIO], None]] = getattr(
+                arkimet.Metadata, "write_data", None
+            )
+
+        def product_key(self, md: "arkimet.Metadata") -> Optional[ProductKey]:
+            """
+            Return the product key of the metadata, or None if it has none
+            """
+            product = md.to_python("product")
+            if not product:
+                return None
+            style = product.get("style")
+            if style == "GRIB1":
+                return (style, product["table"], product["product"])
+            elif style == "GRIB2":
+                return (style, product["category"], product["number"])
+            return None
+
+        def decode_instant(self, md: "arkimet.Metadata") -> Optional[Instant]:
+            """
+            Compute the instant of the metadata, or return None if it is not
+            supported
+            """
+            trange = md.to_python("timerange")
+            style = trange["style"]
+            if style == "GRIB1":
+                if trange["trange_type"] in (0, 1):
+                    output_step = trange["p1"]
+                elif trange["trange_type"] in (2, 3, 4, 5, 6, 7):
+                    output_step = trange["p2"]
+                else:
+                    log.warning("unsupported timerange %s: skipping input", trange)
+                    return None
+                try:
+                    step = ModelStep.from_grib1(output_step, trange["unit"])
+                except NotImplementedError as e:
+                    log.warning("skipping input: %s", e)
+                    return None
+            elif style == "Timedef":
+                output_step = trange["step_len"]
+                output_step_unit = trange["step_unit"]
+                try:
+                    step = ModelStep.from_timedef(output_step, output_step_unit)
+                except NotImplementedError as e:
+                    log.warning("skipping input: %s", e)
+                    return None
+            else:
+                log.warning("unsupported timerange style in %s: skipping input", trange)
+                return None
 
-        def dispatch(self, md: "arkimet.Metadata") -> bool:
-            for matcher, inp in self.todo_list:
-                if matcher.match(md):
-                    trange = md.to_python("timerange")
-                    style = trange["style"]
-                    if style == "GRIB1":
-                        if trange["trange_type"] in (0, 1):
-                            output_step = trange["p1"]
-                        elif trange["trange_type"] in (2, 3, 4, 5, 6, 7):
-                            output_step = trange["p2"]
-                        else:
-                            log.warning("unsupported timerange %s: skipping input", trange)
-                            continue
-                        try:
-                            step = ModelStep.from_grib1(output_step, trange["unit"])
-                        except NotImplementedError as e:
-                            log.warning("skipping input: %s", e)
-                            continue
-                    elif style == "Timedef":
-                        output_step = trange["step_len"]
-                        output_step_unit = trange["step_unit"]
-                        try:
-                            step = ModelStep.from_timedef(output_step, output_step_unit)
-                        except NotImplementedError as e:
-                            log.warning("skipping input: %s", e)
-                            continue
-                    else:
-                        log.warning("unsupported timerange style in %s: skipping input", trange)
-                        continue
-
-                    reftime = md.to_python("reftime")["time"]
-                    instant = Instant(reftime, step)
-
-                    source = md.to_python("source")
-                    if inp.spec.model is None:
-                        pantry_basename = inp.name
-                    else:
-                        pantry_basename = f"{inp.spec.model}_{inp.name}"
-
-                    relname = pantry_basename + instant.pantry_suffix() + "." + source["format"]
-
-                    dest = os.path.join(self.data_root, relname)
-                    # TODO: implement Metadata.write_data to write directly without
-                    # needing to create an intermediate python bytes object
-                    with open(dest, "ab") as out:
-                        out.write(md.data)
+            reftime = md.to_python("reftime")["time"]
+            return Instant(reftime, step)
 
-                    # Take note of having added one element to this file
-                    self.pantry.add_instant(inp, instant)
-            return True
+        def match(self, md: "arkimet.Metadata") -> Optional[Tuple[Instant, str, List[Input]]]:
+            """
+            Return the instant and format of md and the inputs that match it,
+            or None if it does not need dispatching
+            """
+            matched = [inp for matcher, inp in self.index.candidates(self.product_key(md)) if matcher.match(md)]
+            if not matched:
+                return None
+            instant = self.decode_instant(md)
+            if instant is None:
+                return None
+            return instant, md.to_python("source")["format"], matched
+
+        def store(self, md: "arkimet.Metadata", match: Optional[Tuple[Instant, str, List[Input]]]) -> None:
+            """
+            Append md to the pantry files of the inputs that matched it
+            """
+            if match is None:
+                return
+            instant, fmt, matched = match
+            for inp in matched:
+                # Only keep the first message for each instant
+                if not self.pantry.reserve_instant(inp, instant):
+                    continue
+
+                if inp.spec.model is None:
+                    pantry_basename = inp.name
+                else:
+                    pantry_basename = f"{inp.spec.model}_{inp.name}"
+
+                relname = pantry_basename + instant.pantry_suffix() + "." + fmt
+
+                dest = self.data_root / relname
+                if self.write_data is not None:
+                    self.pantry.file_pool.write(dest, functools.partial(self.write_data, md))
+                else:
+                    self.pantry.file_pool.write(dest, md.data)
 
         def read(self, infd: BinaryIO):
             """
@@ -373,7 +859,13 @@ if HAS_ARKIMET:
             The input file is the output of arki-query --inline, which is the same
             as is given as input to arkimet processors.
             """
-            arkimet.Metadata.read_bundle(infd, dest=self.dispatch)
+            with ShardedDispatch(self.match, self.store, jobs=self.pantry.dispatch_jobs) as sharded:
+
+                def dispatch(md: "arkimet.Metadata") -> bool:
+                    sharded.add(md)
+                    return True
+
+                arkimet.Metadata.read_bundle(infd, dest=dispatch)
 
 
 class EccodesPantry(DispatchPantry):
@@ -381,9 +873,11 @@ class EccodesPantry(DispatchPantry):
     eccodes-based storage of GRIB files to be processed
     """
 
-    def __init__(self, grib_input=False, **kwargs) -> None:
+    def __init__(self, grib_input=False, grib_filter=False, **kwargs) -> None:
         super().__init__(**kwargs)
         self.grib_input = grib_input
+        # Dispatch by running grib_filter instead of matching in-process
+        self.grib_filter = grib_filter
         self.grib_filter_rules = self.data_root / "grib_filter_rules"
 
     def fill(self, path: Optional[Path] = None, input_filter: Optional[Set[str]] = None):
@@ -391,9 +885,11 @@ class EccodesPantry(DispatchPantry):
         Read data from standard input and acquire it into the pantry
         """
         # Create pantry dir if missing
-        self.data_root.mkdir(parents=True, exist_ok=True)
+        self.start_fill()
 
-        # Build grib_filter rules
+        # Build grib_filter rules, and their compiled version for in-process
+        # dispatch
+        rules: Optional[List[Tuple[Matcher, Input]]] = [] if not self.grib_filter else None
         with self.grib_filter_rules.open("w") as f:
             for inps in self.inputs.values():
                 for inp in inps:
@@ -414,8 +910,16 @@ class EccodesPantry(DispatchPantry):
                     )
                     print(f'  write "{self.get_eccodes_fullname(inp)}";', file=f)
                     print("}", file=f)
-
-        if self.grib_input:
+                    if rules is not None:
+                        try:
+                            rules.append((compile_filter(eccodes), inp))
+                        except RuntimeError as e:
+                            log.warning("%s: %s: dispatching with grib_filter instead", inp.name, e)
+                            rules = None
+
+        if rules is not None:
+            self.dispatch_native(rules, path)
+        elif self.grib_input:
             self.read_grib(path)
         else:
             self.read_arkimet(path)
@@ -436,12 +940,143 @@ class EccodesPantry(DispatchPantry):
             if inp.spec.model == model:
                 self.add_instant(inp, Instant(reftime, int(step)))
 
+    def dispatch_native(self, rules: List[Tuple[Matcher, Input]], path: Optional[Path]):
+        """
+        Dispatch GRIB or arkimet input to the pantry, matching filters
+        in-process
+        """
+
+        if self.grib_input and path is not None:
+            self.dispatch_grib_file(rules, path)
+            return
+
+        def match(data: bytes) -> Optional[Tuple[Instant, str, List[Input]]]:
+            gid = new_from_message_headers(data)
+            try:
+                return self.match_message(rules, gid)
+            finally:
+                eccodes.codes_release(gid)
+
+        with ShardedDispatch(match, self.store_message, jobs=self.dispatch_jobs) as sharded:
+            with self.open_dispatch_input(path=path) as infd:
+                if self.grib_input:
+                    while True:
+                        gid = eccodes.codes_grib_new_from_file(infd)
+                        if gid is None:
+                            break
+                        try:
+                            data = eccodes.codes_get_message(gid)
+                            if not sharded.parallel:
+                                # Reuse the decoded message if not matching
+                                # in parallel
+                                self.store_message(data, self.match_message(rules, gid))
+                                continue
+                        finally:
+                            eccodes.codes_release(gid)
+                        sharded.add(data)
+                else:
+
+                    def dispatch(md: "arkimet.Metadata") -> bool:
+                        sharded.add(md.data)
+                        return True
+
+                    arkimet.Metadata.read_bundle(infd, dest=dispatch)
+
+    def dispatch_grib_file(self, rules: List[Tuple[Matcher, Input]], path: Path):
+        """
+        Dispatch a GRIB file to the pantry, matching filters in-process.
+
+        The file is memory mapped: only the headers of each message are
+        decoded for matching, and matching messages are copied to the pantry
+        files by the kernel where possible, without reading them into Python
+        """
+        with path.open("rb") as fd:
+            if os.fstat(fd.fileno()).st_size == 0:
+                return
+            with mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                view = memoryview(mm)
+                try:
+
+                    def match(msg: Tuple[int, int]) -> Optional[Tuple[Instant, str, List[Input]]]:
+                        offset, length = msg
+                        end = offset + length
+                        gid = new_from_message_headers(view[offset:end])
+                        try:
+                            return self.match_message(rules, gid)
+                        finally:
+                            eccodes.codes_release(gid)
+
+                    def store(msg: Tuple[int, int], match: Optional[Tuple[Instant, str, List[Input]]]) -> None:
+                        offset, length = msg
+                        for dest in self.reserve_message_files(match):
+                            self.file_pool.copy(dest, fd.fileno(), offset, length, truncate=True)
+
+                    with ShardedDispatch(match, store, jobs=self.dispatch_jobs) as sharded:
+                        for msg in scan_messages(mm, fd):
+                            sharded.add(msg)
+                finally:
+                    view.release()
+
+    def match_message(self, rules: List[Tuple[Matcher, Input]], gid: int) -> Optional[Tuple[Instant, str, List[Input]]]:
+        """
+        Match a GRIB message against the input filters.
+
+        Return its instant, the suffix of its pantry file names, and the inputs
+        that matched it, or None if no input matched
+        """
+        keys = MessageKeys(gid)
+        matched = [inp for matcher, inp in rules if matcher(keys)]
+        if not matched:
+            return None
+
+        ye, mo, da, ho, mi, se, step = (
+            keys.get(k, int) for k in ("year", "month", "day", "hour", "minute", "second", "endStep")
+        )
+        instant = Instant(datetime.datetime(ye, mo, da, ho, mi, se), step)
+        # Use the same file names as grib_filter
+        suffix = f"_{ye}_{mo}_{da}_{ho}_{mi}_{se}+{step}.grib"
+        return instant, suffix, matched
+
+    def store_message(self, data: bytes, match: Optional[Tuple[Instant, str, List[Input]]]) -> None:
+        """
+        Append a GRIB message to the pantry files of the inputs that matched it
+        """
+        for dest in self.reserve_message_files(match):
+            self.file_pool.write(dest, data, truncate=True)
+
+    def reserve_message_files(self, match: Optional[Tuple[Instant, str, List[Input]]]) -> List[Path]:
+        """
+        Reserve the instant of a matched GRIB message for the inputs that
+        matched it, and return the pantry files where the message is to be
+        appended
+        """
+        if match is None:
+            return []
+        instant, suffix, matched = match
+        res: List[Path] = []
+        for inp in matched:
+            # Only keep the first message for each instant
+            if not self.reserve_instant(inp, instant):
+                continue
+            if inp.spec.model is None:
+                pantry_basename = inp.name
+            else:
+                pantry_basename = f"{inp.spec.model}_{inp.name}"
+            res.append(self.data_root / (pantry_basename + suffix))
+        return res
+
     def read_grib(self, path: Optional[Path]):
         """
         Run grib_filter on GRIB input
         """
         cmd = ["grib_filter", self.grib_filter_rules.as_posix(), ("-" if path is None else str(path))]
-        res = subprocess.run(cmd, stdin=sys.stdin, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+        res = subprocess.run(
+            cmd,
+            stdin=sys.stdin if path is None else subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            check=True,
+        )
         for line in res.stderr.splitlines():
             log.debug("dispatch: grib_filter stderr: %s", line)
         for line in res.stdout.splitlines():
@@ -1,9 +1,10 @@
 # from __future__ import annotations
+import copy
 import inspect
 import json
 import logging
 import os
-from typing import TYPE_CHECKING, Any, Dict, Iterable, List, Optional, Set, TextIO, Type
+from typing import TYPE_CHECKING, Any, Dict, FrozenSet, Iterable, List, Optional, TextIO, Type
 
 from . import steps, toposort
 from .config import Config
@@ -109,6 +110,46 @@ class RecipeStepSkipped(Exception):
     pass
 
 
+class CompiledRecipeStep:
+    """
+    Arguments of a recipe step compiled for a flavour, with the information
+    derived from them
+    """
+
+    def __init__(self, step_class: Type[steps.Step], args: Dict[str, Any]) -> None:
+        self.step_class = step_class
+        # Compiled arguments
+        self.args = args
+        # True if the flavour skips this step
+        self.skip = bool(args.get("skip", False))
+        # Arguments without the skip flag
+        self.step_args = {k: v for k, v in args.items() if k != "skip"}
+        # Names of the inputs used by the step, computed the first time they
+        # are needed
+        self._input_names: Optional[FrozenSet[str]] = None
+        # Validated step specification, parsed the first time it is needed
+        self._spec: Optional[steps.StepSpec] = None
+
+    def get_input_names(self) -> FrozenSet[str]:
+        """
+        Return the names of the inputs used by the step
+        """
+        if self._input_names is None:
+            if self.skip:
+                self._input_names = frozenset()
+            else:
+                self._input_names = frozenset(self.step_class.get_input_names(self.step_args))
+        return self._input_names
+
+    def make_spec(self) -> steps.StepSpec:
+        """
+        Return a new copy of the validated step specification
+        """
+        if self._spec is None:
+            self._spec = self.step_class.Spec(**self.step_args)
+        return self._spec.copy(deep=True)
+
+
 class RecipeStep:
     """
     A step of a recipe, as defined in the recipe file.
@@ -133,6 +174,8 @@ class RecipeStep:
         self.step_class: Type[steps.Step] = step_class
         self.args: Dict[str, Any] = args
         self.id: Optional[str] = id
+        # Arguments compiled for each flavour
+        self.compiled: Dict["flavours.Flavour", CompiledRecipeStep] = {}
 
     def lint(self, lint: Lint) -> None:
         args = self.compile_args(lint.flavour)
@@ -144,27 +187,43 @@ class RecipeStep:
         """
         Instantiate the Step
         """
-        args = self.compile_args(flavour)
-        if bool(args.pop("skip", False)):
+        compiled = self.compile(flavour)
+        if compiled.skip:
             raise RecipeStepSkipped()
         return self.step_class(
-            config=self.config, name=self.name, defined_in=self.defined_in, args=args, sources=input_files
+            config=self.config,
+            name=self.name,
+            defined_in=self.defined_in,
+            args=compiled.step_args,
+            spec=compiled.make_spec(),
+            sources=input_files,
         )
 
-    def get_input_names(self, flavour: "flavours.Flavour") -> Set[str]:
+    def get_input_names(self, flavour: "flavours.Flavour") -> FrozenSet[str]:
         """
         Get the names of inputs needed by this step
         """
-        args = self.compile_args(flavour)
-        if bool(args.pop("skip", False)):
-            return set()
-        return self.step_class.get_input_names(args)
+        return self.compile(flavour).get_input_names()
+
+    def compile(self, flavour: "flavours.Flavour") -> CompiledRecipeStep:
+        """
+        Return the arguments for this step compiled for the given flavour.
+
+        The result is computed once per flavour, and shared
+        """
+        res = self.compiled.get(flavour)
+        if res is None:
+            res = self.compiled[flavour] = CompiledRecipeStep(self.step_class, self._compile_args(flavour))
+        return res
 
     def compile_args(self, flavour: "flavours.Flavour") -> Dict[str, Any]:
         """
         Compute the set of arguments for this step, based on flavour
         information, arguments defined in the recipe, and step class defaults
         """
+        return copy.deepcopy(self.compile(flavour).args)
+
+    def _compile_args(self, flavour: "flavours.Flavour") -> Dict[str, Any]:
         flavour_step = flavour.step_config(self.name)
 
         # Take recipe-defined args
@@ -179,6 +238,11 @@ class RecipeStep:
             for k, v in self.step_class.DEFAULTS.items():
                 res.setdefault(k, v)
 
+        # Do not share nested values with the recipe, the flavour or the
+        # defaults, since the result is cached and setdefault_deep changes
+        # nested dictionaries
+        res = copy.deepcopy(res)
+
         # Fold in extra elements by recursing into dictionaries
         if self.step_class.DEEP_DEFAULTS is not None:
             setdefault_deep(res, self.step_class.DEEP_DEFAULTS)
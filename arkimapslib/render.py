@@ -1,20 +1,40 @@
 # from __future__ import annotations
 import asyncio
 import contextlib
+import heapq
 import json
 import logging
+import math
 import os
 import shutil
 import subprocess
 import sys
 from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import TYPE_CHECKING, Any, Deque, Dict, Generator, Iterable, List, Optional, Sequence, Set, Tuple, Union
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Awaitable,
+    Callable,
+    Deque,
+    Dict,
+    FrozenSet,
+    Iterable,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+)
 
 from . import outputbundle
 from .config import Config
+from .costs import CostModel, load_cost_model
 from .orders import Output
 from .pygen import PyGen
+from .rendercache import RenderCache
+from .utils import available_cpus
 
 if TYPE_CHECKING:
     from .orders import Order
@@ -48,18 +68,531 @@ def override_env(**kw):
                 os.environ[k] = v
 
 
-def groups(orders: Iterable["Order"], count: int) -> Generator[List["Order"], None, None]:
+def balance(costs: Sequence[float], count: int) -> List[List[int]]:
     """
-    Given an iterable of orders, generate groups of maximum count items
+    Distribute items with the given costs in at most count bins of similar
+    total cost.
+
+    Return the lists of item indices in each non-empty bin
+    """
+    # Longest processing time first: assign each item, most expensive first,
+    # to the bin with the lowest total cost so far
+    bins: List[Tuple[float, int]] = [(0.0, idx) for idx in range(count)]
+    assigned: List[List[int]] = [[] for idx in range(count)]
+    for item_idx in sorted(range(len(costs)), key=lambda idx: costs[idx], reverse=True):
+        total, bin_idx = heapq.heappop(bins)
+        assigned[bin_idx].append(item_idx)
+        heapq.heappush(bins, (total + costs[item_idx], bin_idx))
+    return [indices for indices in assigned if indices]
+
+
+class RenderGroup:
+    """
+    Orders rendered together by the same render script
+    """
+
+    def __init__(self, script_file: Path, orders: List["Order"]) -> None:
+        self.script_file = script_file
+        self.orders = orders
+        # Estimated time needed to render all the orders, in nanoseconds
+        self.cost: float = 0.0
+        # Estimated peak memory used while rendering, in bytes
+        self.memory: int = 0
+
+    def __str__(self) -> str:
+        return self.script_file.name
+
+
+class Scheduler:
+    """
+    Choose which render scripts to run, and when.
+
+    Orders are binned into render scripts of similar estimated cost, and
+    scripts are started most expensive first, so that slow renderings do not
+    end up as a long tail at the end of the run.
+
+    The cost of each order is estimated from the render times measured so far
+    for its recipe, or from the render history of previous runs if available.
+    Without history, the cost is estimated from the size of the image and of
+    the input GRIB files.
+    """
+
+    # Estimated memory used by a render worker with Magics loaded
+    WORKER_MEMORY = 256 * 1024 * 1024
+    # Estimated memory used per rendered pixel
+    MEMORY_PER_PIXEL = 16
+    # Estimated ratio between the size of decoded fields and their GRIB size
+    GRIB_EXPANSION = 4
+    # Work needed to process one byte of input, compared to rendering one pixel
+    INPUT_BYTE_WORK = 0.25
+    # Estimated render time of one unit of work, in nanoseconds, used until
+    # render times are known
+    WORK_TIME_NS = 5000
+
+    def __init__(self, config: Config, cost_model: Optional[CostModel] = None) -> None:
+        # Number of orders to bundle in a render script, on average
+        self.orders_per_script = config.orders_per_script
+        # Render costs from previous runs
+        self.cost_model = cost_model
+        # Maximum number of render scripts running at the same time
+        self.max_tasks: int = config.render_jobs or available_cpus()
+        # Memory budget for rendering, in bytes
+        self.memory_budget: Optional[int] = config.render_memory_budget
+        # Groups waiting to be rendered
+        self.queue: List[RenderGroup] = []
+        # Size of input files, cached by pathname
+        self.input_sizes: Dict[str, int] = {}
+        # Work and render time of the orders rendered so far, by recipe name
+        self.recipe_work: Dict[str, float] = {}
+        self.recipe_time: Dict[str, int] = {}
+
+    def input_size(self, order: "Order") -> int:
+        """
+        Return the total size of the input files of an order
+        """
+        total = 0
+        for input_file in order.input_files.values():
+            pathname = input_file.pathname.as_posix()
+            size = self.input_sizes.get(pathname)
+            if size is None:
+                try:
+                    size = os.path.getsize(pathname)
+                except OSError:
+                    size = 0
+                self.input_sizes[pathname] = size
+            total += size
+        return total
+
+    def order_work(self, order: "Order") -> float:
+        """
+        Estimate the amount of work needed to render an order
+        """
+        return order.output_pixels() + self.INPUT_BYTE_WORK * self.input_size(order)
+
+    def order_cost(self, order: "Order") -> float:
+        """
+        Estimate the time needed to render an order, in nanoseconds
+        """
+        work = self.recipe_work.get(order.recipe.name)
+        if work:
+            # Render time per unit of work measured in this run
+            return self.order_work(order) * self.recipe_time[order.recipe.name] / work
+        if self.cost_model:
+            return self.cost_model.order_cost(order)
+        total_work = sum(self.recipe_work.values())
+        if total_work:
+            return self.order_work(order) * sum(self.recipe_time.values()) / total_work
+        return self.order_work(order) * self.WORK_TIME_NS
+
+    def order_memory(self, order: "Order") -> int:
+        """
+        Estimate the memory needed to render an order
+        """
+        return order.output_pixels() * self.MEMORY_PER_PIXEL + self.input_size(order) * self.GRIB_EXPANSION
+
+    def estimate(self, group: RenderGroup) -> None:
+        """
+        Compute cost and memory estimates for a group
+        """
+        group.cost = sum(self.order_cost(order) for order in group.orders)
+        # Orders in a script are rendered one after the other
+        group.memory = self.WORKER_MEMORY + max((self.order_memory(order) for order in group.orders), default=0)
+
+    def input_key(self, order: "Order") -> FrozenSet[str]:
+        """
+        Return the GRIB files read by an order, ignoring static inputs
+        """
+        return frozenset(
+            input_file.pathname.as_posix()
+            for input_file in order.input_files.values()
+            if input_file.instant is not None
+        )
+
+    def group_orders(self, orders: Sequence["Order"]) -> List[List["Order"]]:
+        """
+        Split orders into groups of similar estimated cost, one per render
+        script.
+
+        Orders reading the same GRIB files are kept in the same group when
+        possible, so that the files are read by the same render process. The
+        number of groups is the same as if orders were grouped
+        orders_per_script at a time
+        """
+        count = math.ceil(len(orders) / self.orders_per_script)
+        if count <= 1:
+            return [list(orders)] if orders else []
+
+        costs = [self.order_cost(order) for order in orders]
+        target = sum(costs) / count
+
+        # Cluster orders by the input files they share
+        clusters: Dict[FrozenSet[str], List[int]] = {}
+        for idx, order in enumerate(orders):
+            clusters.setdefault(self.input_key(order), []).append(idx)
+
+        # Split clusters that are too expensive for a single group
+        chunks: List[List[int]] = []
+        for indices in clusters.values():
+            cluster_cost = sum(costs[idx] for idx in indices)
+            if target > 0 and cluster_cost > target:
+                parts = balance([costs[idx] for idx in indices], math.ceil(cluster_cost / target))
+                chunks.extend([indices[idx] for idx in part] for part in parts)
+            else:
+                chunks.append(indices)
+
+        # Distribute the chunks among groups
+        chunk_costs = [sum(costs[idx] for idx in chunk) for chunk in chunks]
+        res: List[List["Order"]] = []
+        for part in balance(chunk_costs, count):
+            # Keep the original order of orders inside each group
+            indices = sorted(idx for chunk_idx in part for idx in chunks[chunk_idx])
+            res.append([orders[idx] for idx in indices])
+        return res
+
+    def add(self, group: RenderGroup) -> None:
+        """
+        Queue a group for rendering
+        """
+        self.estimate(group)
+        self.queue.append(group)
+
+    def learn(self, orders: Iterable["Order"]) -> None:
+        """
+        Update cost estimates with the render times of rendered orders.
+
+        Only the queued groups with orders of the same recipes are estimated
+        again
+        """
+        names: Set[str] = set()
+        for order in orders:
+            name = order.recipe.name
+            names.add(name)
+            self.recipe_work[name] = self.recipe_work.get(name, 0.0) + self.order_work(order)
+            self.recipe_time[name] = self.recipe_time.get(name, 0) + order.render_time_ns
+        if not names:
+            return
+        for group in self.queue:
+            if any(order.recipe.name in names for order in group.orders):
+                self.estimate(group)
+
+    def next_group(self, running: Iterable[RenderGroup]) -> Optional[RenderGroup]:
+        """
+        Pick the next group to render, given the groups currently rendering.
+
+        Return None if no group should be started now
+        """
+        running = list(running)
+        if not self.queue or len(running) >= self.max_tasks:
+            return None
+        self.queue.sort(key=lambda group: group.cost, reverse=True)
+        if self.memory_budget is None or not running:
+            # With nothing running, start a group even if it exceeds the
+            # budget, or it would never be rendered
+            return self.queue.pop(0)
+        available = self.memory_budget - sum(group.memory for group in running)
+        for idx, group in enumerate(self.queue):
+            if group.memory <= available:
+                return self.queue.pop(idx)
+        return None
+
+
+class RenderWorker:
+    """
+    Long-running render process, which imports Magics only once and then runs
+    render scripts on request.
+
+    See :py:mod:`arkimapslib.worker` for the process side of the protocol.
+    """
+
+    # Maximum size of a line of JSON sent by the worker
+    LINE_LIMIT = 64 * 1024 * 1024
+
+    def __init__(self, name: str, env: Dict[str, str]) -> None:
+        self.name = name
+        self.env = env
+        self.proc: Optional[asyncio.subprocess.Process] = None
+
+    def __str__(self) -> str:
+        return self.name
+
+    @property
+    def alive(self) -> bool:
+        """
+        Check if the worker process is running
+        """
+        return self.proc is not None and self.proc.returncode is None
+
+    async def start(self) -> None:
+        """
+        Start the worker process and wait for it to be ready
+        """
+        worker_script = Path(__file__).parent / "worker.py"
+        # Run the worker script through runpy instead of as `python worker.py`,
+        # so that arkimapslib's own directory does not end up in sys.path
+        # (arkimapslib/types.py would shadow the standard library module)
+        self.proc = await asyncio.create_subprocess_exec(
+            sys.executable,
+            "-c",
+            "import runpy, sys; runpy.run_path(sys.argv[1], run_name='__main__')",
+            worker_script.as_posix(),
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            env=self.env,
+            limit=self.LINE_LIMIT,
+        )
+        ready = await self._read_reply()
+        log.debug("%s: worker ready, Magics imported in %.3fs", self, ready["timings"]["import_magics"] / 1e9)
+
+    async def _read_reply(self) -> Dict[str, Any]:
+        """
+        Read a JSON reply from the worker
+        """
+        assert self.proc is not None and self.proc.stdout is not None
+        line = await self.proc.stdout.readline()
+        if not line:
+            returncode = await self.proc.wait()
+            raise RuntimeError(f"{self}: render worker exited with code {returncode}")
+        try:
+            return json.loads(line)
+        except json.decoder.JSONDecodeError as e:
+            raise RuntimeError(f"{self}: render worker produced invalid JSON") from e
+
+    async def _send(self, message: Dict[str, Any]) -> None:
+        """
+        Send a JSON message to the worker
+        """
+        assert self.proc is not None and self.proc.stdin is not None
+        self.proc.stdin.write(json.dumps(message).encode() + b"\n")
+        await self.proc.stdin.drain()
+
+    async def render(
+        self, script_file: Path, workdir: Path, on_output: Callable[[Output, int], Awaitable[None]]
+    ) -> Dict[str, Any]:
+        """
+        Run a render script in the worker, returning its timings.
+
+        on_output is called with each output and its render time as soon as it
+        is rendered: the worker does not render the next output until it
+        returns
+        """
+        await self._send({"script": script_file.as_posix(), "workdir": workdir.as_posix()})
+        while True:
+            reply = await self._read_reply()
+            output = reply.get("output")
+            if output is None:
+                break
+            try:
+                await on_output(Output(*output), reply["timing"])
+            except BaseException:
+                # The worker is waiting for an acknowledgement that will not
+                # come: terminate it
+                assert self.proc is not None
+                self.proc.kill()
+                raise
+            await self._send({"ack": True})
+
+        error = reply.get("error")
+        if error is not None:
+            raise RuntimeError(f"{script_file}: rendering failed in {self}: {error}")
+        return reply
+
+    async def stop(self) -> None:
+        """
+        Stop the worker process
+        """
+        if self.proc is None:
+            return
+        if self.proc.returncode is None:
+            assert self.proc.stdin is not None
+            self.proc.stdin.close()
+        await self.proc.wait()
+        self.proc = None
+
+
+class WorkerPool:
+    """
+    Pool of pre-warmed render workers, started on demand
+    """
+
+    def __init__(self, env: Dict[str, str]) -> None:
+        # Environment for the worker processes
+        self.env = env
+        # Workers currently not rendering
+        self.idle: Deque[RenderWorker] = deque()
+        # All running workers
+        self.workers: List[RenderWorker] = []
+        self.sequence = 0
+
+    async def acquire(self) -> RenderWorker:
+        """
+        Return an idle worker, starting a new one if needed
+        """
+        while self.idle:
+            worker = self.idle.popleft()
+            if worker.alive:
+                return worker
+            # Drop workers that died while idle
+            await self.discard(worker)
+
+        worker = RenderWorker(f"worker{self.sequence:03d}", self.env)
+        self.sequence += 1
+        self.workers.append(worker)
+        try:
+            await worker.start()
+        except Exception:
+            await self.discard(worker)
+            raise
+        return worker
+
+    async def release(self, worker: RenderWorker) -> None:
+        """
+        Return a worker to the pool after use
+        """
+        if worker.alive:
+            self.idle.append(worker)
+        else:
+            # The worker died (for example, Magics crashed): it will be
+            # replaced by a new one when needed
+            log.warning("%s: render worker died, it will be restarted", worker)
+            await self.discard(worker)
+
+    async def discard(self, worker: RenderWorker) -> None:
+        """
+        Remove a worker from the pool
+        """
+        self.workers.remove(worker)
+        await worker.stop()
+
+    async def shutdown(self) -> None:
+        """
+        Stop all workers
+        """
+        self.idle.clear()
+        workers = self.workers
+        self.workers = []
+        for worker in workers:
+            await worker.stop()
+
+
+class BundleWriter:
+    """
+    Add rendered orders to the output bundle as they are produced.
+
+    Renderers wait if the size of outputs rendered and not yet added to the
+    bundle exceeds a maximum, so that they do not fill the working directory
+    faster than the bundle is written
     """
-    group = []
-    for order in orders:
-        group.append(order)
-        if len(group) == count:
-            yield group
-            group = []
-    if group:
-        yield group
+
+    def __init__(
+        self,
+        workdir: Path,
+        bundle: outputbundle.Writer,
+        max_pending_bytes: Optional[int],
+        cache: Optional[RenderCache] = None,
+        jobs: Optional[int] = None,
+    ) -> None:
+        self.workdir = workdir
+        self.bundle = bundle
+        # Cache where rendered images are stored before adding them to the bundle
+        self.cache = cache
+        # Maximum size of rendered outputs waiting to be added to the bundle
+        self.max_pending_bytes = max_pending_bytes
+        # Current size of rendered outputs waiting to be added to the bundle
+        self.pending_bytes = 0
+        # Orders added to the bundle
+        self.rendered: List["Order"] = []
+        # Number of threads preparing rendered outputs for the bundle
+        self.jobs = jobs or available_cpus()
+        self.executor: Optional[ThreadPoolExecutor] = None
+        # Queue of orders to add to the bundle, with their output size and the
+        # future preparing their products.
+        # asyncio objects are created in start(), inside the event loop
+        self.queue: "Optional[asyncio.Queue[Optional[Tuple[Order, int, Awaitable[Any]]]]]" = None
+        self.room: Optional[asyncio.Condition] = None
+        self.task: Any = None
+
+    def start(self) -> None:
+        """
+        Start adding orders to the bundle
+        """
+        self.queue = asyncio.Queue()
+        self.room = asyncio.Condition()
+        self.executor = ThreadPoolExecutor(max_workers=self.jobs)
+        self.task = asyncio_create_task(self.run())
+
+    async def stop(self) -> None:
+        """
+        Wait for all queued orders to be added to the bundle
+        """
+        if self.task is None:
+            return
+        assert self.queue is not None
+        await self.queue.put(None)
+        try:
+            await self.task
+        finally:
+            self.task = None
+            if self.executor is not None:
+                self.executor.shutdown()
+                self.executor = None
+
+    async def add(self, order: "Order") -> None:
+        """
+        Queue a rendered order to be added to the bundle, waiting if too much
+        rendered output is already waiting
+        """
+        assert self.queue is not None and self.room is not None
+        assert order.output is not None
+        try:
+            size = os.path.getsize(self.workdir / order.output.relpath)
+        except OSError:
+            size = 0
+        # Start preparing the products in a worker thread, so that the event
+        # loop only needs to write the results to the bundle
+        loop = asyncio.get_event_loop()
+        prepared = loop.run_in_executor(self.executor, order.prepare_bundle, self.workdir)
+        async with self.room:
+            self.pending_bytes += size
+            await self.queue.put((order, size, prepared))
+            if self.max_pending_bytes is not None:
+                await self.room.wait_for(lambda: self.pending_bytes <= self.max_pending_bytes)
+
+    async def run(self) -> None:
+        """
+        Add queued orders to the bundle
+        """
+        assert self.queue is not None and self.room is not None
+        while True:
+            item = await self.queue.get()
+            if item is None:
+                break
+            order, size, prepared = item
+            if self.cache is not None and not order.cached:
+                try:
+                    self.cache.store(order, self.workdir)
+                except OSError as e:
+                    log.warning("%s: cannot store rendered output in the render cache: %s", order, e)
+            try:
+                order.add_to_bundle(self.workdir, self.bundle, await prepared)
+            except Exception as e:
+                log.warning("%s: cannot add rendered output to the bundle: %s", order, e, exc_info=e)
+            else:
+                self.rendered.append(order)
+            async with self.room:
+                self.pending_bytes -= size
+                self.room.notify_all()
+
+        # Add products that are still missing, like those built from the
+        # outputs of multiple orders when some of them failed
+        loop = asyncio.get_event_loop()
+        for order in self.rendered:
+            finished = await loop.run_in_executor(self.executor, order.finish_bundle)
+            if not finished:
+                continue
+            try:
+                order.add_finished_to_bundle(self.bundle, finished)
+            except Exception as e:
+                log.warning("%s: cannot add finished products to the bundle: %s", order, e, exc_info=e)
 
 
 class Renderer:
@@ -82,6 +615,14 @@ class Renderer:
             shutil.rmtree(self.renderer_dir)
         self.renderer_dir.mkdir(parents=True)
         self.renderer_sequence = 0
+        # Pool of render workers, available while render() is running
+        self.pool: Optional[WorkerPool] = None
+        # Writer of rendered outputs, available while render() is running
+        self.writer: Optional[BundleWriter] = None
+        # Cache of previously rendered images
+        self.cache: Optional[RenderCache] = None
+        if config.render_cache_dir is not None:
+            self.cache = RenderCache(config.render_cache_dir)
 
     @contextlib.contextmanager
     def override_env(self):
@@ -98,54 +639,105 @@ class Renderer:
 
         Return the list of orders that have been rendered
         """
-        orders_per_script = self.config.orders_per_script
-        log.debug("%d orders to dispatch in groups of %d", len(orders), orders_per_script)
-
-        queue: Deque[Path] = deque()
-        for group in groups(orders, orders_per_script):
-            queue.append(self.write_render_script(group))
+        # Reuse images rendered by previous runs
+        cached: List["Order"] = []
+        if self.cache is not None:
+            to_render: List["Order"] = []
+            for order in orders:
+                if self.cache.lookup(order, self.workdir):
+                    cached.append(order)
+                else:
+                    to_render.append(order)
+            log.info("%d orders found in the render cache, %d to render", len(cached), len(to_render))
+            orders = to_render
+
+        log.debug("%d orders to dispatch in groups of about %d", len(orders), self.config.orders_per_script)
+
+        cost_model = load_cost_model(tuple(self.config.render_history))
+
+        scheduler = Scheduler(self.config, cost_model)
+        for group in scheduler.group_orders(orders):
+            render_group = RenderGroup(self.write_render_script(group), group)
+            scheduler.add(render_group)
+            input_files = set()
+            for order in group:
+                input_files.update(scheduler.input_key(order))
+            log.debug(
+                "%s: %d orders reading %d input files, estimated cost %.0f: %s",
+                render_group,
+                len(group),
+                len(input_files),
+                render_group.cost,
+                ", ".join(str(order) for order in group),
+            )
+        log.info("%d orders grouped in %d render scripts", len(orders), len(scheduler.queue))
 
         if hasattr(asyncio, "run"):
-            return asyncio.run(self.render_asyncio(queue, bundle))
+            return asyncio.run(self.render_asyncio(scheduler, bundle, cached))
         else:
             # Python 3.6
             loop = asyncio.get_event_loop()
-            res = loop.run_until_complete(self.render_asyncio(queue, bundle))
+            res = loop.run_until_complete(self.render_asyncio(scheduler, bundle, cached))
             return res
 
-    async def render_asyncio(self, queue: Deque[Path], bundle: outputbundle.Writer) -> List["Order"]:
-        # TODO: hardcoded default to os.cpu_count, can be configurable
-        max_tasks = os.cpu_count() or 1
-        pending: Set[Any] = set()
-        log.debug("%d render scripts to run on %d parallel tasks", len(queue), max_tasks)
-
-        rendered: List["Order"] = []
-        while queue or pending:
-            # Refill the queue
-            while queue and len(pending) < max_tasks:
-                script_file = queue.popleft()
-                pending.add(asyncio_create_task(self.run_render_script(script_file), name=str(script_file)))
-
-            # Execute the queue
-            log.debug("Waiting for %d tasks", len(pending))
-            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
-            log.debug("%d tasks done, %d tasks pending", len(done), len(pending))
-
-            # Notify results
-            for task in done:
-                # Python 3.6 compat
-                if hasattr(task, "get_name"):
-                    log.debug("%s: task done", task.get_name())
-                try:
-                    orders = task.result()
-                except Exception as e:
-                    log.warning("Task execution failed: %s", e, exc_info=e)
-                    continue
+    async def render_asyncio(
+        self, scheduler: Scheduler, bundle: outputbundle.Writer, cached: Sequence["Order"] = ()
+    ) -> List["Order"]:
+        pending: Dict[Any, RenderGroup] = {}
+        log.debug(
+            "%d render scripts to run on %d parallel tasks, memory budget: %s",
+            len(scheduler.queue),
+            scheduler.max_tasks,
+            "unlimited" if scheduler.memory_budget is None else f"{scheduler.memory_budget} bytes",
+        )
 
-                for order in orders:
-                    order.add_to_bundle(self.workdir, bundle)
-                    rendered.append(order)
+        env = dict(os.environ)
+        env.update(self.env_overrides)
+        self.pool = WorkerPool(env)
+        self.writer = BundleWriter(
+            self.workdir, bundle, self.config.render_max_pending_bytes, self.cache, self.config.render_bundle_jobs
+        )
+        self.writer.start()
 
+        try:
+            for order in cached:
+                await self.writer.add(order)
+
+            while scheduler.queue or pending:
+                # Refill the queue
+                while True:
+                    group = scheduler.next_group(pending.values())
+                    if group is None:
+                        break
+                    log.debug("%s: starting, estimated cost %.0f, memory %d", group, group.cost, group.memory)
+                    task = asyncio_create_task(self.run_render_script(group.script_file), name=str(group.script_file))
+                    pending[task] = group
+
+                # Execute the queue
+                log.debug("Waiting for %d tasks", len(pending))
+                done, _ = await asyncio.wait(pending.keys(), return_when=asyncio.FIRST_COMPLETED)
+                log.debug("%d tasks done, %d tasks pending", len(done), len(pending) - len(done))
+
+                # Notify results
+                for task in done:
+                    del pending[task]
+                    # Python 3.6 compat
+                    if hasattr(task, "get_name"):
+                        log.debug("%s: task done", task.get_name())
+                    try:
+                        orders = task.result()
+                    except Exception as e:
+                        log.warning("Task execution failed: %s", e, exc_info=e)
+                        continue
+
+                    scheduler.learn(orders)
+        finally:
+            await self.writer.stop()
+            await self.pool.shutdown()
+            self.pool = None
+
+        rendered = self.writer.rendered
+        self.writer = None
         return rendered
 
     def _parse_renderer_output(self, script_file: Path, stdout: bytes) -> Dict[str, Any]:
@@ -169,22 +761,28 @@ class Renderer:
         return render_info
 
     async def run_render_script(self, script_file: Path) -> List["Order"]:
-        proc = await asyncio.create_subprocess_exec(
-            sys.executable, script_file.as_posix(), stdout=asyncio.subprocess.PIPE
-        )
+        """
+        Run a render script on a worker from the pool, queueing its outputs
+        to be added to the bundle as they are rendered
+        """
+        assert self.pool is not None and self.writer is not None
+        writer = self.writer
+        orders: List["Order"] = []
 
-        stdout, stderr = await proc.communicate()
-        render_info = self._parse_renderer_output(script_file, stdout)
-        timings = render_info["timings"]
-        outputs = [Output(*o) for o in render_info["outputs"]]
-        orders: Set["Order"] = set()
-        for output in outputs:
+        async def on_output(output: Output, timing: int) -> None:
             # Set render information in the order
             order = self.orders_by_name[(script_file, output.name)]
-            order.set_output(output, timing=timings[output.name])
-            orders.add(order)
+            order.set_output(output, timing=timing)
+            orders.append(order)
+            await writer.add(order)
+
+        worker = await self.pool.acquire()
+        try:
+            await worker.render(script_file, self.workdir, on_output)
+        finally:
+            await self.pool.release(worker)
 
-        return list(orders)
+        return orders
 
     def render_one(self, order: "Order") -> "Order":
         script_file = self.write_render_script([order])
@@ -228,10 +826,21 @@ class Renderer:
                 order.print_python_function(name, sub)
             gen.empty_line()
 
-        for idx, order in enumerate(orders):
-            gen.line(f"order{idx}({str(self.workdir)!r})")
+        gen.line(f"render_functions = [{', '.join(f'order{idx}' for idx in range(len(orders)))}]")
+        gen.empty_line()
+        gen.empty_line()
+        gen.line("def main(workdir: str) -> None:")
+        with gen.nested() as sub:
+            sub.line("for render_function in render_functions:")
+            sub.line("    render_function(workdir)")
+        gen.empty_line()
         gen.empty_line()
-        gen.line("print(json.dumps({'timings': timings, 'outputs': outputs}))")
+        # Render and print results when run as a script. When loaded by a
+        # render worker, the worker will call main() itself
+        gen.line("if __name__ == '__main__':")
+        with gen.nested() as sub:
+            sub.line(f"main({str(self.workdir)!r})")
+            sub.line("print(json.dumps({'timings': timings, 'outputs': outputs}))")
 
         with open(script_file, "w") as code:
             gen.write(code)
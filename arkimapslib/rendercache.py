@@ -0,0 +1,110 @@
+# from __future__ import annotations
+import json
+import logging
+import os
+import shutil
+import tempfile
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Callable, Optional
+
+from .orders import Output
+
+if TYPE_CHECKING:
+    from .orders import Order
+
+log = logging.getLogger("rendercache")
+
+
+class RenderCache:
+    """
+    Persistent cache of rendered images, indexed by order fingerprint.
+
+    Each entry is an image file and a JSON file with its path relative to the
+    working directory. The JSON file is written last, so that its presence
+    marks a complete entry
+    """
+
+    def __init__(self, root: Path) -> None:
+        self.root = root
+        self.root.mkdir(parents=True, exist_ok=True)
+        # Cache statistics
+        self.hits = 0
+        self.misses = 0
+
+    def _entry(self, fingerprint: str) -> Path:
+        """
+        Return the path of a cache entry, without extension
+        """
+        return self.root / fingerprint[:2] / fingerprint
+
+    def _fingerprint(self, order: "Order") -> Optional[str]:
+        """
+        Compute the fingerprint of an order, or return None if it cannot be
+        computed
+        """
+        try:
+            return order.fingerprint()
+        except OSError as e:
+            log.warning("%s: cannot compute fingerprint, not using the render cache: %s", order, e)
+            return None
+
+    def lookup(self, order: "Order", workdir: Path) -> bool:
+        """
+        Look for the rendered image of an order in the cache.
+
+        If found, copy it to the working directory and set it as the order
+        output, and return True
+        """
+        fingerprint = self._fingerprint(order)
+        if fingerprint is None:
+            return False
+        entry = self._entry(fingerprint)
+        try:
+            with entry.with_suffix(".json").open("rt") as fd:
+                info = json.load(fd)
+            dest = workdir / info["relpath"]
+            dest.parent.mkdir(parents=True, exist_ok=True)
+            shutil.copyfile(entry.with_suffix(".png"), dest)
+        except FileNotFoundError:
+            self.misses += 1
+            return False
+        self.hits += 1
+        log.debug("%s: found in render cache as %s", order, fingerprint)
+        order.set_output(Output("cached", info["relpath"], info.get("magics_output", "")))
+        order.cached = True
+        return True
+
+    def store(self, order: "Order", workdir: Path) -> None:
+        """
+        Store the rendered image of an order in the cache
+        """
+        if order.output is None:
+            raise AssertionError(f"{order}: product has not been rendered")
+        fingerprint = self._fingerprint(order)
+        if fingerprint is None:
+            return
+        entry = self._entry(fingerprint)
+        if entry.with_suffix(".json").exists():
+            return
+        entry.parent.mkdir(parents=True, exist_ok=True)
+
+        # Write the image first: the JSON file marks the entry as complete
+        output = order.output
+        self._write_atomic(entry.with_suffix(".png"), lambda out: shutil.copyfile(workdir / output.relpath, out))
+        info = {"relpath": output.relpath, "magics_output": output.magics_output}
+        self._write_atomic(entry.with_suffix(".json"), lambda out: out.write_text(json.dumps(info)))
+        log.debug("%s: stored in render cache as %s", order, fingerprint)
+
+    def _write_atomic(self, dest: Path, write: Callable[[Path], Any]) -> None:
+        """
+        Write a file via a temporary file and a rename, so that concurrent runs
+        sharing the cache never see partial entries
+        """
+        fd, tmpname = tempfile.mkstemp(dir=dest.parent, prefix=dest.name, suffix=".tmp")
+        os.close(fd)
+        try:
+            write(Path(tmpname))
+            os.replace(tmpname, dest)
+        except BaseException:
+            os.unlink(tmpname)
+            raise
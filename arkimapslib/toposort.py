@@ -1,7 +1,7 @@
 # from __future__ import annotations
 from typing import Dict, Iterable, Any, List
 
-__all__ = ["CycleError", "sort"]
+__all__ = ["CycleError", "TopologicalSorter", "sort"]
 
 Node = Any
 Graph = Dict[Node, Iterable[Node]]
@@ -1,7 +1,10 @@
 # from __future__ import annotations
 
+import hashlib
+import os
 import time
-from typing import Any, Dict, Tuple
+from pathlib import Path
+from typing import Any, Dict, Tuple, Union
 
 if hasattr(time, "perf_counter_ns"):
     perf_counter_ns = time.perf_counter_ns
@@ -11,6 +14,15 @@ else:  # pragma: no cover
         return int(time.perf_counter() * 1000000000)
 
 
+def available_cpus() -> int:
+    """
+    Return the number of CPUs this process is allowed to run on
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
 def setdefault_deep(target: Dict[Any, Any], source: Dict[Any, Any], path: Tuple[Any, ...] = ()):
     """Use source as defaults for target, recursing into dicts."""
     for k, v in source.items():
@@ -27,3 +39,30 @@ def setdefault_deep(target: Dict[Any, Any], source: Dict[Any, Any], path: Tuple[
                 pass
         else:
             target[k] = v
+
+
+# Cache of file digests, indexed by (pathname, size, mtime)
+_file_digests: Dict[Tuple[str, int, int], str] = {}
+
+
+def file_digest(path: Union[str, Path]) -> str:
+    """
+    Return the hex SHA256 digest of the contents of a file.
+
+    Digests are cached for as long as the file size and modification time do
+    not change
+    """
+    pathname = os.fspath(path)
+    st = os.stat(pathname)
+    key = (pathname, st.st_size, st.st_mtime_ns)
+    digest = _file_digests.get(key)
+    if digest is None:
+        hasher = hashlib.sha256()
+        with open(pathname, "rb") as fd:
+            while True:
+                buf = fd.read(1024 * 1024)
+                if not buf:
+                    break
+                hasher.update(buf)
+        _file_digests[key] = digest = hasher.hexdigest()
+    return digest
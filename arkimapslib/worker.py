@@ -0,0 +1,108 @@
+# from __future__ import annotations
+"""
+Long-running render worker.
+
+This is run as a standalone script by :py:class:`arkimapslib.render.WorkerPool`
+and it is kept free of dependencies on the rest of arkimapslib, so that it
+can start without importing the whole package.
+
+The worker imports Magics once, then reads requests from standard input as
+lines of JSON: each request is a dict with the path to a render script
+generated by :py:meth:`arkimapslib.render.Renderer.write_render_script` and the
+working directory to render into.
+
+For each request, the worker runs the render functions of the script one at a
+time. After each function, it sends a line of JSON with its output and render
+time, then waits for an acknowledgement line before rendering the next one:
+this lets the renderer slow down rendering while it is busy writing outputs.
+When the script is done, the worker replies with ``{"done": true, "timings":
+...}``, or with ``{"error": "..."}`` if rendering failed.
+"""
+
+import json
+import os
+import sys
+import time
+import traceback
+from typing import Any, Callable, Dict, TextIO
+
+if hasattr(time, "perf_counter_ns"):
+    perf_counter_ns = time.perf_counter_ns
+else:  # pragma: no cover
+    # Polyfill for Python < 3.7
+    def perf_counter_ns() -> int:
+        return int(time.perf_counter() * 1000000000)
+
+
+def render(
+    script_file: str, workdir: str, send: Callable[[Dict[str, Any]], None], wait_ack: Callable[[], None]
+) -> Dict[str, Any]:
+    """
+    Run the render functions of a render script, sending each output as soon as
+    it is rendered. Return the timings of the script
+    """
+    with open(script_file, "rt") as fd:
+        code = compile(fd.read(), script_file, "exec")
+    # Run the script as a module that is not __main__, so that it only defines
+    # its render functions
+    namespace: Dict[str, Any] = {"__name__": "__arkimaps_render__", "__file__": script_file}
+    exec(code, namespace)
+    timings = namespace["timings"]
+    outputs = namespace["outputs"]
+    for render_function in namespace["render_functions"]:
+        start = len(outputs)
+        render_function(workdir)
+        for output in outputs[start:]:
+            send({"output": output, "timing": timings.get(output[0], 0)})
+            wait_ack()
+    return {"done": True, "timings": timings}
+
+
+def serve(infd: TextIO, outfd: TextIO) -> None:
+    """
+    Process render requests until the end of input
+    """
+
+    def send(message: Dict[str, Any]) -> None:
+        print(json.dumps(message), file=outfd, flush=True)
+
+    def wait_ack() -> None:
+        if not infd.readline():
+            raise EOFError("input closed while waiting for acknowledgement")
+
+    while True:
+        line = infd.readline()
+        if not line:
+            break
+        if not line.strip():
+            continue
+        request = json.loads(line)
+        try:
+            response = render(request["script"], request["workdir"], send, wait_ack)
+        except EOFError:
+            break
+        except Exception:
+            response = {"error": traceback.format_exc()}
+        send(response)
+
+
+def main() -> None:
+    # Keep a private copy of stdout for replies, and point file descriptor 1 to
+    # stderr: this way, whatever is printed by Magics (including its C++ part)
+    # or by render code does not end up corrupting the JSON stream
+    outfd = os.fdopen(os.dup(sys.stdout.fileno()), "wt")
+    sys.stdout.flush()
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+    # Pay the cost of importing Magics only once
+    start = perf_counter_ns()
+    from Magics import macro  # noqa: F401
+
+    elapsed = perf_counter_ns() - start
+    print(json.dumps({"ready": True, "timings": {"import_magics": elapsed}}), file=outfd, flush=True)
+
+    serve(sys.stdin, outfd)
+
+
+if __name__ == "__main__":
+    main()
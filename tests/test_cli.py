@@ -31,6 +31,18 @@ class CLITest:
         return cls(args=parsed)
 
 
+class TestParseSize(unittest.TestCase):
+    def test_parse(self) -> None:
+        self.assertEqual(cli.parse_size("1000"), 1000)
+        self.assertEqual(cli.parse_size("2K"), 2048)
+        self.assertEqual(cli.parse_size("1.5m"), 1536 * 1024)
+        self.assertEqual(cli.parse_size("1G"), 1024**3)
+        for value in ("", "M", "foo", "0", "-1", "-2G"):
+            with self.subTest(value=value):
+                with self.assertRaises(argparse.ArgumentTypeError):
+                    cli.parse_size(value)
+
+
 class TestPrintArkiQuery(CLITest, unittest.TestCase):
     def test_run(self) -> None:
         cmd = self.create(cli.PrintArkiQuery)
@@ -0,0 +1,48 @@
+# from __future__ import annotations
+import unittest
+
+import eccodes
+
+from arkimapslib.eccodesfilter import MessageKeys, compile_filter
+
+
+class TestEccodesFilter(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.gid = eccodes.codes_grib_new_from_samples("regular_ll_pl_grib2")
+        eccodes.codes_set_string(self.gid, "shortName", "t")
+        eccodes.codes_set_long(self.gid, "level", 850)
+
+    def tearDown(self):
+        eccodes.codes_release(self.gid)
+        super().tearDown()
+
+    def assertMatches(self, expr: str, expected: bool = True) -> None:
+        self.assertEqual(compile_filter(expr)(MessageKeys(self.gid)), expected, expr)
+
+    def test_match(self):
+        self.assertMatches('shortName is "t"')
+        self.assertMatches('shortName is "2t"', False)
+        self.assertMatches("level == 850 and editionNumber == 2")
+        self.assertMatches("level != 850", False)
+        self.assertMatches("level > 500 and level <= 850")
+        self.assertMatches('( shortName is "u" or shortName is "t" ) and level == 850')
+        self.assertMatches("centre != 98 and (level == 500 or level == 700)", False)
+        self.assertMatches("not level == 500")
+        self.assertMatches("!(level == 850)", False)
+
+    def test_missing_keys(self):
+        self.assertMatches("doesNotExist == 1", False)
+        self.assertMatches("doesNotExist != 1", False)
+
+    def test_memoize(self):
+        keys = MessageKeys(self.gid)
+        self.assertEqual(keys.get("level", int), 850)
+        eccodes.codes_set_long(self.gid, "level", 500)
+        self.assertEqual(keys.get("level", int), 850)
+        self.assertEqual(MessageKeys(self.gid).get("level", int), 500)
+
+    def test_syntax_errors(self):
+        for expr in ("level ==", "level 850", '(shortName is "t"', "level == 850 and", "level = 850", "== 3"):
+            with self.assertRaises(RuntimeError):
+                compile_filter(expr)
@@ -0,0 +1,74 @@
+# from __future__ import annotations
+import tempfile
+import unittest
+from pathlib import Path
+
+from arkimapslib.filepool import FilePool
+
+
+class TestFilePool(unittest.TestCase):
+    def test_write(self):
+        with tempfile.TemporaryDirectory() as workdir:
+            root = Path(workdir)
+            pool = FilePool(max_open=2)
+
+            pool.write(root / "a", b"a1")
+            pool.write(root / "b", b"b1")
+            pool.write(root / "a", lambda out: out.write(b"a2"))
+            self.assertEqual(list(pool.files.keys()), [root / "b", root / "a"])
+
+            # Opening a third file closes the least recently used one
+            pool.write(root / "c", b"c1")
+            self.assertEqual(list(pool.files.keys()), [root / "a", root / "c"])
+            self.assertEqual((root / "b").read_bytes(), b"b1")
+
+            # Closed files are reopened for appending
+            pool.write(root / "b", b"b2")
+            pool.close()
+            self.assertEqual(pool.files, {})
+            self.assertEqual((root / "a").read_bytes(), b"a1a2")
+            self.assertEqual((root / "b").read_bytes(), b"b1b2")
+            self.assertEqual((root / "c").read_bytes(), b"c1")
+
+    def test_truncate(self):
+        with tempfile.TemporaryDirectory() as workdir:
+            path = Path(workdir) / "a"
+            path.write_bytes(b"old")
+            pool = FilePool(max_open=1)
+
+            pool.write(path, b"new1", truncate=True)
+            pool.write(Path(workdir) / "b", b"b")
+            pool.write(path, b"new2", truncate=True)
+            pool.flush()
+            self.assertEqual(path.read_bytes(), b"new1new2")
+            pool.close()
+
+    def test_copy(self):
+        with tempfile.TemporaryDirectory() as workdir:
+            root = Path(workdir)
+            src = root / "src"
+            src.write_bytes(b"0123456789")
+            pool = FilePool()
+
+            with src.open("rb") as fd:
+                pool.write(root / "a", b"a")
+                pool.copy(root / "a", fd.fileno(), 2, 3)
+                pool.write(root / "a", b"b")
+                pool.copy(root / "a", fd.fileno(), 8, 2)
+            pool.close()
+            self.assertEqual((root / "a").read_bytes(), b"a234b89")
+
+    def test_copy_fallback(self):
+        with tempfile.TemporaryDirectory() as workdir:
+            root = Path(workdir)
+            src = root / "src"
+            src.write_bytes(b"0123456789")
+            # Copy without kernel-side copy functions, in small chunks
+            pool = FilePool(buffer_size=4)
+            pool.use_copy_file_range = False
+            pool.use_sendfile = False
+
+            with src.open("rb") as fd:
+                pool.copy(root / "a", fd.fileno(), 1, 9)
+            pool.close()
+            self.assertEqual((root / "a").read_bytes(), b"123456789")
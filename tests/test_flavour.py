@@ -4,6 +4,7 @@ import os
 import tempfile
 import unittest
 from pathlib import Path
+from unittest import mock
 from typing import Any, Dict, List, Optional
 
 import yaml
@@ -156,6 +157,31 @@ class TestFlavour(unittest.TestCase):
             orders = kitchen.make_orders(flavour=kitchen.defs.flavours["test"])
             self.assertCountEqual([(o.recipe.name, o.instant.step) for o in orders], [("t2m", 12)])
 
+    def test_orders_for_flavours(self):
+        with self.kitchen(
+            flavours=[
+                flavour("default"),
+                flavour("test", recipes_filter=["t2m"]),
+            ],
+            recipes={
+                "t2m": [{"step": "add_grib", "grib": "t2m"}],
+                "tcc": [{"step": "add_grib", "grib": "t2m"}],
+            },
+        ) as kitchen:
+            cls = type(kitchen.defs.flavours["default"])
+            with mock.patch.object(cls, "inputs_to_orders", autospec=True, side_effect=cls.inputs_to_orders) as patched:
+                orders = kitchen.make_orders_for_flavours(list(kitchen.defs.flavours.values()))
+            # Each flavour gets its own mapping of inputs shared by all instants
+            shared = [call.args[3] for call in patched.call_args_list]
+            self.assertEqual(len(shared), 3)
+            self.assertEqual(len({id(mapping) for mapping in shared}), 3)
+            self.assertCountEqual(
+                [(o.flavour.name, o.recipe.name, o.instant.step) for o in orders],
+                [("default", "t2m", 12), ("default", "tcc", 12), ("test", "t2m", 12)],
+            )
+            # Orders do not share their input files
+            self.assertIsNot(orders[0].input_files, orders[1].input_files)
+
     def test_recipe_filter_subdir(self):
         with self.kitchen(
             flavours=[
@@ -236,6 +262,42 @@ class TestFlavour(unittest.TestCase):
             self.assertEqual(params.layout, "test")
             self.assertTileSize(params, 2, 4)
 
+            # Tiles share all steps except the basemap
+            self.assertIs(self.get_step(orders[0], "add_grib"), self.get_step(orders[2], "add_grib"))
+            self.assertIsNot(self.get_step(orders[0], "add_basemap"), self.get_step(orders[2], "add_basemap"))
+            georef = orders[2].georeference()
+            self.assertEqual(georef["epsg"], 3857)
+            for value, expected in zip(georef["bbox"], [0, 21.9430455, 22.5, 55.7765730]):
+                self.assertAlmostEqual(value, expected)
+
+    def test_tiled_cull(self):
+        tile = {"zoom_min": 5, "zoom_max": 5, "lat_min": 30.0, "lat_max": 50.0, "lon_min": -100.0, "lon_max": 20.0}
+        recipes = {"test": [{"step": "add_basemap"}, {"step": "add_grib", "grib": "t2m"}]}
+        # Culling is disabled by default, and grids are not read
+        with self.kitchen(flavours=[flavour("test", tile=tile)], recipes=recipes) as kitchen:
+            kitchen.config.tile_group_width = 2
+            kitchen.config.tile_group_height = 2
+            all_orders = kitchen.make_orders("test", recipe="test")
+            self.assertEqual(kitchen.defs.flavours["test"].grid_areas, {})
+
+        with self.kitchen(
+            flavours=[flavour("test", tile={**tile, "cull_outside_data": True})], recipes=recipes
+        ) as kitchen:
+            kitchen.config.tile_group_width = 2
+            kitchen.config.tile_group_height = 2
+            orders = kitchen.make_orders("test", recipe="test")
+            tiled = kitchen.defs.flavours["test"]
+            self.assertEqual(len(tiled.grid_areas), 1)
+            lon_min, lat_min, lon_max, lat_max = list(tiled.grid_areas.values())[0]
+
+        # Tiles outside of the data are not rendered
+        self.assertGreater(len(orders), 0)
+        self.assertLess(len(orders), len(all_orders))
+        for order in orders:
+            bbox = order.georeference()["bbox"]
+            self.assertLessEqual(bbox[0], lon_max)
+            self.assertGreaterEqual(bbox[2], lon_min)
+
     def test_tiled1(self):
         with self.kitchen(
             flavours=[
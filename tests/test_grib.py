@@ -0,0 +1,150 @@
+# from __future__ import annotations
+import mmap
+import os
+import tempfile
+import unittest
+from pathlib import Path
+
+import eccodes
+
+from arkimapslib.grib import GRIB, ValuesCache, scan_messages
+
+
+class TestValuesCache(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.workdir = tempfile.TemporaryDirectory()
+        self.root = Path(self.workdir.name)
+
+    def tearDown(self):
+        self.workdir.cleanup()
+        super().tearDown()
+
+    def make_grib(self, name: str, value: float) -> Path:
+        gid = eccodes.codes_grib_new_from_samples("regular_ll_sfc_grib2")
+        try:
+            values = eccodes.codes_get_values(gid)
+            values[:] = value
+            eccodes.codes_set_values(gid, values)
+            path = self.root / name
+            with path.open("wb") as out:
+                out.write(eccodes.codes_get_message(gid))
+        finally:
+            eccodes.codes_release(gid)
+        return path
+
+    def test_get(self):
+        path = self.make_grib("z.grib", 98.0665)
+        cache = ValuesCache()
+
+        values = cache.get(path, "meters", lambda values: values / 9.80665)
+        self.assertAlmostEqual(values[0], 10.0, places=3)
+        self.assertFalse(values.flags.writeable)
+        self.assertEqual(cache.misses, 1)
+
+        # The same array is shared with further callers
+        self.assertIs(cache.get(path, "meters", lambda values: values / 9.80665), values)
+        self.assertEqual(cache.hits, 1)
+
+        # Untransformed values are cached separately
+        self.assertAlmostEqual(cache.get(path)[0], 98.0665, places=3)
+        self.assertEqual(cache.misses, 2)
+
+        # Changing the file invalidates the cache
+        os.utime(path, ns=(0, 0))
+        self.assertIsNot(cache.get(path, "meters", lambda values: values / 9.80665), values)
+        self.assertEqual(cache.misses, 3)
+
+    def test_evict(self):
+        path1 = self.make_grib("a.grib", 1.0)
+        path2 = self.make_grib("b.grib", 2.0)
+        cache = ValuesCache(max_bytes=1)
+
+        values1 = cache.get(path1)
+        cache.get(path2)
+        self.assertEqual(len(cache.values), 1)
+        self.assertIsNot(cache.get(path1), values1)
+        self.assertEqual(cache.misses, 3)
+
+    def test_disk_cache(self):
+        path = self.make_grib("z.grib", 98.0665)
+        cachedir = self.root / "cache"
+
+        values = ValuesCache(cache_dir=cachedir).get(path, "meters", lambda values: values / 9.80665)
+        self.assertEqual(len(list(cachedir.glob("*-meters.npy"))), 1)
+
+        # A new cache, as in a new run, loads the values from disk
+        def fail(values):
+            raise AssertionError("values should not be decoded again")
+
+        cached = ValuesCache(cache_dir=cachedir).get(path, "meters", fail)
+        self.assertEqual(cached.tolist(), values.tolist())
+        self.assertFalse(cached.flags.writeable)
+
+
+class TestScanMessages(unittest.TestCase):
+    def make_message(self, sample: str) -> bytes:
+        gid = eccodes.codes_grib_new_from_samples(sample)
+        try:
+            return eccodes.codes_get_message(gid)
+        finally:
+            eccodes.codes_release(gid)
+
+    def test_scan(self):
+        grib1 = self.make_message("regular_ll_sfc_grib1")
+        grib2 = self.make_message("regular_ll_sfc_grib2")
+        with tempfile.TemporaryFile() as fd:
+            # Data between messages is skipped
+            fd.write(grib1 + b"junk" + grib2 + b"GRIB" + grib1)
+            fd.flush()
+            with mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                self.assertEqual(
+                    list(scan_messages(mm, fd)),
+                    [
+                        (0, len(grib1)),
+                        (len(grib1) + 4, len(grib2)),
+                        (len(grib1) + len(grib2) + 8, len(grib1)),
+                    ],
+                )
+
+
+class TestGRIB(unittest.TestCase):
+    def test_bounding_box(self):
+        gid = eccodes.codes_grib_new_from_samples("regular_ll_sfc_grib2")
+        try:
+            # Grid using 0..360 longitudes, west of Greenwich
+            eccodes.codes_set(gid, "longitudeOfFirstGridPointInDegrees", 350.0)
+            eccodes.codes_set(gid, "longitudeOfLastGridPointInDegrees", 380.0)
+            data = eccodes.codes_get_message(gid)
+        finally:
+            eccodes.codes_release(gid)
+
+        with tempfile.TemporaryDirectory() as workdir:
+            path = Path(workdir) / "test.grib"
+            path.write_bytes(data)
+            with GRIB(path) as grib:
+                lon_min, lat_min, lon_max, lat_max = grib.bounding_box()
+
+        self.assertAlmostEqual(lon_min, -10.0)
+        self.assertAlmostEqual(lon_max, 20.0)
+        self.assertAlmostEqual(lat_min, 0.0)
+        self.assertAlmostEqual(lat_max, 60.0)
+
+    def test_bounding_box_antimeridian(self):
+        gid = eccodes.codes_grib_new_from_samples("regular_ll_sfc_grib2")
+        try:
+            # Grid crossing the antimeridian
+            eccodes.codes_set(gid, "longitudeOfFirstGridPointInDegrees", 170.0)
+            eccodes.codes_set(gid, "longitudeOfLastGridPointInDegrees", 200.0)
+            data = eccodes.codes_get_message(gid)
+        finally:
+            eccodes.codes_release(gid)
+
+        with tempfile.TemporaryDirectory() as workdir:
+            path = Path(workdir) / "test.grib"
+            path.write_bytes(data)
+            with GRIB(path) as grib:
+                lon_min, lat_min, lon_max, lat_max = grib.bounding_box()
+
+        self.assertAlmostEqual(lon_min, 170.0)
+        self.assertAlmostEqual(lon_max, -160.0)
@@ -4,6 +4,7 @@ import datetime
 import os
 import re
 import tempfile
+import time
 import unittest
 from pathlib import Path
 from typing import Iterator, List, Optional
@@ -14,7 +15,7 @@ import numpy
 import arkimapslib.inputs
 from arkimapslib.config import Config
 from arkimapslib.inputs import Input, Inputs, GribSetInputSpec
-from arkimapslib.pantry import DiskPantry
+from arkimapslib.pantry import DiskPantry, Pantry
 from arkimapslib.types import Instant
 
 
@@ -148,6 +149,38 @@ class TestInputs(unittest.TestCase):
         hzero = o.apply_clip({"hzero": hzero, "z": z})
         self.assertEqual(hzero.tolist(), [-999, -999, 3, 4])
 
+    def test_generate_instants(self) -> None:
+        class Tester(arkimapslib.inputs.GribSetMixin[GribSetInputSpec]):
+            Spec = GribSetInputSpec
+
+        class TestPantry(Pantry):
+            def __init__(self):
+                super().__init__(Inputs())
+                self.added: List[Instant] = []
+
+            def add_instant(self, inp: Input, instant: Instant) -> None:
+                self.added.append(instant)
+
+        config = Config()
+        config.derived_instant_jobs = 4
+        o = Tester(config=config, name="test", defined_in=__file__, args={})
+        pantry = TestPantry()
+        reftime = datetime.datetime(2021, 1, 10)
+
+        def make_job(step: int):
+            def job() -> bool:
+                # Make earlier steps finish later
+                time.sleep((10 - step) / 1000)
+                return step != 3
+
+            return (Instant(reftime, step), f"step {step}", job)
+
+        self.assertTrue(o.generate_instants(pantry, [make_job(step) for step in range(10)]))
+        self.assertEqual(pantry.added, [Instant(reftime, step) for step in range(10) if step != 3])
+        self.assertEqual(
+            [what for elapsed, what in pantry.input_stats[o].computation_log], [f"step {step}" for step in range(10)]
+        )
+
     def test_model_mix_allowed(self) -> None:
         with self.pantry() as pantry:
             # Inputs from two different models
@@ -1,9 +1,12 @@
 # from __future__ import annotations
 import datetime
+import json
+import tempfile
 import unittest
-from typing import Any, Dict
+from pathlib import Path
+from typing import Any, Dict, List
 
-from arkimapslib import flavours, inputs, orders
+from arkimapslib import costs, flavours, inputs, orders, outputbundle
 from arkimapslib.config import Config
 from arkimapslib.inputs import Instant
 from arkimapslib.recipes import Recipe
@@ -82,3 +85,147 @@ class TestTypes(unittest.TestCase):
                 "bbox": [9.19, 43.71, 12.82, 45.14],
             },
         )
+
+    def _make_order(self, params: Dict[str, Any]) -> orders.MapOrder:
+        recipe = Recipe(
+            config=self.config,
+            name="recipe",
+            defined_in="recipe.yaml",
+            args={"recipe": [{"step": "add_basemap", "params": params}]},
+        )
+        return orders.MapOrder(flavour=self.flavour, instant=self.instant, recipe=recipe, input_files={})
+
+    def test_fingerprint(self):
+        params = {"subpage_map_projection": "cylindrical"}
+        fingerprint = self._make_order(params).fingerprint()
+        self.assertEqual(len(fingerprint), 64)
+        # Fingerprints are stable
+        self.assertEqual(self._make_order(params).fingerprint(), fingerprint)
+        # Fingerprints change with macro parameters
+        self.assertNotEqual(self._make_order({"subpage_map_projection": "EPSG:3857"}).fingerprint(), fingerprint)
+        # Fingerprints change with output options
+        order = self._make_order(params)
+        order.output_options["output_width"] = 1024
+        self.assertNotEqual(order.fingerprint(), fingerprint)
+        # Fingerprints change with the output instant
+        order = self._make_order(params)
+        order.instant = Instant(reftime=datetime.datetime(2023, 12, 16), step=12)
+        self.assertNotEqual(order.fingerprint(), fingerprint)
+
+
+class TestTileOrders(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.config = Config()
+        self.flavour = flavours.Simple(config=self.config, name="flavour", defined_in="flavour.yaml", args={})
+        self.recipe = Recipe(
+            config=self.config, name="recipe", defined_in="recipe.yaml", args={"recipe": [{"step": "add_basemap"}]}
+        )
+        self.workdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.workdir.cleanup()
+        super().tearDown()
+
+    def make_orders(self, **kwargs: Any) -> List[orders.TileOrder]:
+        args: Dict[str, Any] = {
+            "flavour": self.flavour,
+            "recipe": self.recipe,
+            "input_files": {},
+            "instant": Instant(reftime=datetime.datetime(2023, 12, 15), step=12),
+            "lat_min": 36.0,
+            "lat_max": 47.0,
+            "lon_min": 6.0,
+            "lon_max": 19.0,
+            "zoom_min": 5,
+            "zoom_max": 7,
+        }
+        args.update(kwargs)
+        return list(orders.TileOrder.make_orders(**args))
+
+    def test_tessellate_height(self):
+        self.assertCountEqual(
+            orders.TileOrder.tessellate(0, 4, 0, 4, 4, 2),
+            [(0, 0, 4, 2), (0, 2, 4, 2)],
+        )
+
+    def test_group_sizes(self):
+        # Without a target render time, tile groups have a fixed size
+        self.config.tile_group_width = 2
+        self.config.tile_group_height = 2
+        self.assertTrue(all(order.width <= 2 and order.height <= 2 for order in self.make_orders()))
+
+        # History of a previous run that rendered 10 tiles in 10 seconds
+        history = orders.TileOrder(
+            flavour=self.flavour,
+            recipe=self.recipe,
+            input_files={},
+            instant=Instant(reftime=datetime.datetime(2023, 12, 14), step=12),
+            z=6,
+            x=32,
+            y=22,
+            w=5,
+            h=2,
+        )
+        history.set_output(orders.Output("history", "recipe/6/32-22-5-2.png", ""), timing=10_000_000_000)
+        products = outputbundle.Products()
+        products.add_order(history)
+        history_path = Path(self.workdir.name) / "products.json"
+        with history_path.open("wt") as fd:
+            json.dump(products.to_jsonable(), fd)
+        self.config.render_history = [history_path]
+        self.config.tile_group_time_ns = 20_000_000_000
+
+        sizes = costs.tile_group_sizes(self.config, "flavour", "recipe", {5: 4, 6: 16, 7: 64})
+        # Each zoom level is estimated to take 28 seconds to render
+        self.assertEqual(sizes, {5: (1, 1), 6: (3, 3), 7: (6, 6)})
+        self.assertEqual(costs.tile_group_sizes(self.config, "flavour", "other", {5: 4}), {5: (2, 2)})
+
+        # Larger groups are rendered at higher zoom levels
+        tiles = self.make_orders()
+        self.assertLess(
+            max(order.width for order in tiles if order.z == 5), max(order.width for order in tiles if order.z == 7)
+        )
+
+    def test_mask(self):
+        self.config.tile_group_width = 1
+        self.config.tile_group_height = 1
+        full = self.make_orders()
+        masked = self.make_orders(mask=[(12.0, 44.0, 13.0, 45.0)])
+        self.assertLess(len(masked), len(full))
+        self.assertEqual(len([order for order in masked if order.z == 5]), 1)
+        for order in masked:
+            lon_min, lat_min, lon_max, lat_max = order.georeference()["bbox"]
+            self.assertLessEqual(lon_min, 13.0)
+            self.assertGreaterEqual(lon_max, 12.0)
+            self.assertLessEqual(lat_min, 45.0)
+            self.assertGreaterEqual(lat_max, 44.0)
+
+        # The pyramid only expects the rendered tiles
+        masked = self.make_orders(mask=[(12.0, 44.0, 13.0, 45.0)], pyramid_zoom=7)
+        self.assertEqual({order.z for order in masked}, {7})
+        pyramid = masked[0].pyramid
+        assert pyramid is not None
+        self.assertEqual(sum(count for (z, x, y), count in pyramid.expected.items() if z == 6), len(masked))
+
+    def test_data_area(self):
+        self.config.tile_group_width = 1
+        self.config.tile_group_height = 1
+        full = self.make_orders()
+        culled = self.make_orders(data_area=(6.0, 36.0, 10.0, 40.0))
+        self.assertLess(len(culled), len(full))
+        for order in culled:
+            lon_min, lat_min, lon_max, lat_max = order.georeference()["bbox"]
+            self.assertLessEqual(lon_min, 10.0)
+            self.assertLessEqual(lat_min, 40.0)
+
+        # Data outside of the tileset leaves nothing to render
+        self.assertEqual(self.make_orders(data_area=(-80.0, 36.0, -70.0, 40.0)), [])
+
+        # Data crossing the antimeridian covers both ends of the longitude range
+        wrapped = self.make_orders(data_area=(170.0, 36.0, 10.0, 40.0))
+        self.assertEqual(
+            [str(order) for order in wrapped],
+            [str(order) for order in self.make_orders(data_area=(-180.0, 36.0, 10.0, 40.0))],
+        )
+        self.assertEqual(self.make_orders(data_area=(170.0, 36.0, -170.0, 40.0)), [])
@@ -86,6 +86,16 @@ class InputProcessingStatsTests(BaseFixture, unittest.TestCase):
         val1 = ob.InputProcessingStats.from_jsonable(as_json)
         self.assertEqual(val1, val)
 
+    def test_dropped_duplicates(self):
+        val = ob.InputProcessingStats()
+        val.dropped_duplicates = 3
+
+        as_json = val.to_jsonable()
+        self.assertEqual(as_json, {"computation": [], "used_by": [], "dropped_duplicates": 3})
+
+        val1 = ob.InputProcessingStats.from_jsonable(as_json)
+        self.assertEqual(val1, val)
+
 
 class InputSummaryTests(BaseFixture, unittest.TestCase):
     def test_inputsummary(self):
@@ -164,6 +174,20 @@ class ReftimeProductsTests(BaseFixture, unittest.TestCase):
         val1 = ob.ReftimeProducts.from_jsonable(as_json)
         self.assertEqual(val1, val)
 
+    def test_cached(self) -> None:
+        order = self.order()
+        order.cached = True
+        order.render_time_ns = 1000
+
+        val = ob.ReftimeProducts()
+        val.add_order(order)
+
+        as_json = val.to_jsonable()
+        self.assertEqual(as_json["render_stats"], {"time_ns": 0, "cached": 1})
+
+        val1 = ob.ReftimeProducts.from_jsonable(as_json)
+        self.assertEqual(val1, val)
+
 
 class RecipeProductsTests(BaseFixture, unittest.TestCase):
     def test_recipeproducts(self) -> None:
@@ -227,6 +251,24 @@ class ProductsTests(BaseFixture, unittest.TestCase):
             },
         )
 
+    def test_shared_products_info(self):
+        info = ob.ReftimeProducts()
+        info.add_product("test/0.png")
+        info.add_product("test/1.png", ref="shared/1234.png")
+        info.add_product("test/2.png", empty=True)
+
+        # Default values are not serialized
+        as_json = info.to_jsonable()
+        self.assertEqual(
+            as_json["products"],
+            {
+                "test/0.png": {"georef": None},
+                "test/1.png": {"georef": None, "ref": "shared/1234.png"},
+                "test/2.png": {"georef": None, "empty": True},
+            },
+        )
+        self.assertEqual(ob.ReftimeProducts.from_jsonable(as_json), info)
+
     def test_by_recipe(self):
         val = ob.Products()
         val.add_order(self.order(with_legend=True))
@@ -270,6 +312,22 @@ class BundleTestsMixin(BaseFixture):
 
         self.assertEqual(p1, artifact)
 
+    def test_shared_product(self):
+        with tempfile.NamedTemporaryFile() as tf:
+            with self.writer_cls(out=tf) as writer:
+                path1 = writer.add_shared_product(b"TEST DATA")
+                path2 = writer.add_shared_product(b"TEST DATA")
+                path3 = writer.add_shared_product(b"OTHER DATA")
+
+            tf.flush()
+
+            with self.reader_cls(path=tf.name) as reader:
+                # Identical data is stored only once
+                self.assertEqual(path1, path2)
+                self.assertNotEqual(path1, path3)
+                self.assertCountEqual(reader.find(), ["version.txt", path1, path3])
+                self.assertEqual(reader.load_product(path1), b"TEST DATA")
+
     def test_serialize(self):
         stats = ob.InputProcessingStats()
         stats.add_computation_log(100_000_000, "mock processing")
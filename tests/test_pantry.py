@@ -2,11 +2,15 @@
 import contextlib
 import datetime
 import os
+import shutil
 import tempfile
+import time
 from pathlib import Path
 from typing import Iterator, Optional
 from unittest import TestCase
 
+import eccodes
+
 from arkimapslib import pantry
 from arkimapslib.config import Config
 from arkimapslib.inputs import Inputs, Input, Instant
@@ -109,6 +113,34 @@ class PantryTestMixin:
                 instants = inp.get_instants(pantry)
                 self.assertCountEqual(instants.keys(), [Instant(datetime.datetime(2021, 1, 10), 12)])
 
+    def test_generate_derived(self):
+        with self.pantry() as pantry:
+            pantry.inputs.add(
+                Input.create(
+                    config=Config(),
+                    name="test",
+                    defined_in="memory",
+                    args={
+                        "arkimet": "product:GRIB1,,2,11;level:GRIB1,105,2",
+                        "eccodes": 'shortName is "2t" and indicatorOfTypeOfLevel == 105',
+                    },
+                )
+            )
+            # derived2 depends on derived1, derived3 is independent
+            for name, inputs in (("derived1", ["test"]), ("derived2", ["derived1"]), ("derived3", ["test"])):
+                pantry.inputs.add(
+                    Input.create(config=Config(), name=name, defined_in="memory", type="cat", args={"inputs": inputs})
+                )
+            pantry.fill(self.get_test_data("cosmo", "t2m", "t2m", 12))
+
+            pantry.generate_derived(["derived2", "derived3"], jobs=4)
+
+            instant = Instant(datetime.datetime(2021, 1, 10), 12)
+            for name in ("derived1", "derived2", "derived3"):
+                inp = pantry.inputs.get(name)[0]
+                self.assertTrue(pantry.get_accessory_fullname(inp, "processed").exists())
+                self.assertEqual(pantry.input_instants[inp], {instant})
+
 
 class TestArkimetPantry(PantryTestMixin, TestCase):
     @contextlib.contextmanager
@@ -157,3 +189,179 @@ class TestEccodesPantry(PantryTestMixin, TestCase):
             )
             pantry.fill(self.get_test_data("cosmo", "t2m", "t2m", 12))
             self.assertEqual(os.listdir(pantry.data_root), ["grib_filter_rules"])
+
+    def test_dispatch_duplicates(self):
+        with self.pantry() as pantry:
+            inp = Input.create(
+                config=Config(),
+                name="test",
+                defined_in="memory",
+                args={"arkimet": "skip", "eccodes": 'shortName is "2t"'},
+            )
+            pantry.inputs.add(inp)
+
+            # GRIB input with the second message duplicated
+            messages = []
+            for step in (0, 3, 3):
+                gid = eccodes.codes_grib_new_from_samples("regular_ll_sfc_grib2")
+                eccodes.codes_set_string(gid, "shortName", "2t")
+                eccodes.codes_set_long(gid, "step", step)
+                messages.append(eccodes.codes_get_message(gid))
+                eccodes.codes_release(gid)
+            source = pantry.data_root.parent / "input.grib"
+            source.write_bytes(b"".join(messages))
+
+            pantry.grib_input = True
+            pantry.fill(source)
+
+            self.assertEqual(len(pantry.input_instants[inp]), 2)
+            self.assertEqual(pantry.input_stats[inp].dropped_duplicates, 1)
+            for instant in pantry.input_instants[inp]:
+                self.assertEqual(pantry.get_fullname(inp, instant).stat().st_size, len(messages[0]))
+
+    def test_get_instants_cache(self):
+        with self.pantry() as pantry:
+            inp = Input.create(
+                config=Config(),
+                name="test",
+                defined_in="memory",
+                args={"arkimet": "skip", "eccodes": 'shortName is "2t"'},
+            )
+            pantry.inputs.add(inp)
+            reftime = datetime.datetime(2021, 1, 10)
+            pantry.add_instant(inp, Instant(reftime, 0))
+
+            instants = pantry.get_instants("test")
+            self.assertCountEqual(instants.keys(), [Instant(reftime, 0)])
+            # Results are shared, and cannot be modified
+            self.assertIs(pantry.get_instants("test"), instants)
+            with self.assertRaises(TypeError):
+                instants[Instant(reftime, 3)] = instants[Instant(reftime, 0)]
+
+            # Adding instants invalidates the cache
+            pantry.add_instant(inp, Instant(reftime, 3))
+            self.assertCountEqual(pantry.get_instants("test").keys(), [Instant(reftime, 0), Instant(reftime, 3)])
+
+    def test_index(self):
+        def add_inputs(pantry):
+            inp = Input.create(
+                config=Config(),
+                name="test",
+                defined_in="memory",
+                args={"arkimet": "skip", "eccodes": 'shortName is "2t"'},
+            )
+            pantry.inputs.add(inp)
+            return inp
+
+        reftime = datetime.datetime(2007, 3, 23, 12)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            workdir = Path(tmpdir)
+            with self.pantry(workdir) as pantry:
+                add_inputs(pantry)
+                gid = eccodes.codes_grib_new_from_samples("regular_ll_sfc_grib2")
+                eccodes.codes_set_string(gid, "shortName", "2t")
+                eccodes.codes_set_long(gid, "step", 3)
+                source = workdir / "input.grib"
+                source.write_bytes(eccodes.codes_get_message(gid))
+                eccodes.codes_release(gid)
+                pantry.grib_input = True
+                pantry.fill(source)
+                self.assertTrue(pantry.index_file.exists())
+
+            # The pantry contents are loaded from the index
+            with self.pantry(workdir) as pantry:
+                inp = add_inputs(pantry)
+                self.assertTrue(pantry.read_index())
+                self.assertEqual(pantry.input_instants[inp], {Instant(reftime, 3)})
+
+            # Adding data to the pantry makes the index out of date
+            with self.pantry(workdir) as pantry:
+                inp = add_inputs(pantry)
+                shutil.copy(
+                    pantry.get_fullname(inp, Instant(reftime, 3)), pantry.get_fullname(inp, Instant(reftime, 6))
+                )
+                self.assertFalse(pantry.read_index())
+                pantry.rescan()
+                self.assertEqual(pantry.input_instants[inp], {Instant(reftime, 3), Instant(reftime, 6)})
+
+            # Rescanning the directory rebuilt the index
+            with self.pantry(workdir) as pantry:
+                inp = add_inputs(pantry)
+                self.assertTrue(pantry.read_index())
+                self.assertEqual(pantry.input_instants[inp], {Instant(reftime, 3), Instant(reftime, 6)})
+
+            # Appending data is detected even if the modification time does
+            # not change
+            with self.pantry(workdir) as pantry:
+                inp = add_inputs(pantry)
+                path = Path(pantry.get_fullname(inp, Instant(reftime, 6)))
+                st = path.stat()
+                with path.open("ab") as fd:
+                    fd.write(path.read_bytes())
+                os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+                self.assertFalse(pantry.read_index())
+
+
+class TestEccodesGribFilterPantry(TestEccodesPantry):
+    @contextlib.contextmanager
+    def pantry(self, workdir: Optional[Path] = None):
+        with self.workdir(workdir) as workdir:
+            yield pantry.EccodesPantry(root=workdir, grib_filter=True, inputs=Inputs())
+
+
+class TestMatcherIndex(TestCase):
+    def test_product_keys(self):
+        self.assertEqual(pantry.arkimet_product_keys("product:GRIB1,98,128,167;level:GRIB1,1"), [("GRIB1", 128, 167)])
+        self.assertEqual(pantry.arkimet_product_keys("level:GRIB1,1; product: GRIB1,,2,11"), [("GRIB1", 2, 11)])
+        self.assertEqual(pantry.arkimet_product_keys("PRODUCT:GRIB2,,,001,66,,"), [("GRIB2", 1, 66)])
+        self.assertEqual(
+            pantry.arkimet_product_keys("product:GRIB1,98,228,28 or GRIB1,,201,187 or GRIB2,00080,000,002,022,015,"),
+            [("GRIB1", 228, 28), ("GRIB1", 201, 187), ("GRIB2", 2, 22)],
+        )
+        # Matchers that cannot be indexed
+        self.assertIsNone(pantry.arkimet_product_keys("level:GRIB1,1"))
+        self.assertIsNone(pantry.arkimet_product_keys("product:GRIB2,,,,078,015,"))
+        self.assertIsNone(pantry.arkimet_product_keys("product:GRIB1,98,128"))
+        self.assertIsNone(pantry.arkimet_product_keys("product:GRIB1,,2,11 or BUFR,,,"))
+        self.assertIsNone(pantry.arkimet_product_keys(""))
+
+    def test_candidates(self):
+        config = Config()
+        todo_list = []
+        for name, matcher in (
+            ("t2m", "product:GRIB1,,2,11;level:GRIB1,105,2"),
+            ("tp", "product:GRIB2,,,001,052,, or GRIB2,,,001,008,,"),
+            ("any", "level:GRIB1,1"),
+            ("t850", "product:GRIB1,,2,11;level:GRIB1,100,850"),
+        ):
+            inp = Input.create(config=config, name=name, defined_in="memory", args={"arkimet": matcher})
+            todo_list.append((name, inp))
+        index = pantry.MatcherIndex(todo_list)
+
+        def candidates(key):
+            return [matcher for matcher, inp in index.candidates(key)]
+
+        self.assertEqual(candidates(("GRIB1", 2, 11)), ["t2m", "any", "t850"])
+        self.assertEqual(candidates(("GRIB2", 1, 8)), ["tp", "any"])
+        self.assertEqual(candidates(("GRIB2", 1, 9)), ["any"])
+        self.assertEqual(candidates(None), ["any"])
+
+
+class TestShardedDispatch(TestCase):
+    def test_order(self):
+        for jobs in (1, 4):
+            with self.subTest(jobs=jobs):
+                stored = []
+
+                def match(msg: int) -> int:
+                    # Make earlier messages take longer to match
+                    time.sleep((100 - msg) / 100000)
+                    return msg * 2
+
+                with pantry.ShardedDispatch(
+                    match, lambda msg, res: stored.append((msg, res)), jobs=jobs, shard_size=3
+                ) as sharded:
+                    self.assertEqual(sharded.parallel, jobs > 1)
+                    for msg in range(100):
+                        sharded.add(msg)
+                self.assertEqual(stored, [(msg, msg * 2) for msg in range(100)])
@@ -31,6 +31,33 @@ class TestRecipeStep(unittest.TestCase):
             },
         )
 
+        # Changing the result does not change the step or further results
+        compiled["params"]["map_user_layer_colour"] = "blue"
+        self.assertEqual(step.compile_args(flavour)["params"]["map_user_layer_colour"], "red")
+        self.assertEqual(step.args, {"params": {"map_user_layer_colour": "red"}})
+
+    def test_create_step(self):
+        flavour = flavours.Simple(config=self.config, name="test", defined_in="test.yaml", args={})
+        step = RecipeStep(
+            config=self.config,
+            name="add_user_boundaries",
+            defined_in="test.yaml",
+            step_class=steps.AddUserBoundaries,
+            args={"shape": "test", "params": {"map_user_layer_colour": "red"}},
+        )
+        self.assertEqual(step.get_input_names(flavour), {"test"})
+        sources = {"test": object()}
+        step1 = step.create_step(flavour, sources)
+        step2 = step.create_step(flavour, sources)
+
+        # Steps get their own copy of the validated spec
+        self.assertIsNot(step1.spec, step2.spec)
+        step1.spec.params.map_user_layer_colour = "blue"
+        self.assertEqual(step2.spec.params.map_user_layer_colour, "red")
+        self.assertEqual(
+            step2.spec.params.dict(exclude_unset=True), {"map_user_layer": True, "map_user_layer_colour": "red"}
+        )
+
 
 class TestRecipe(unittest.TestCase):
     def setUp(self):
@@ -1,11 +1,23 @@
 # from __future__ import annotations
+import asyncio
+import datetime
+import io
 import os
+import tarfile
 import tempfile
 import unittest
 from pathlib import Path
+from typing import Dict, List, Optional
 
+import numpy
+from PIL import Image
+
+from arkimapslib import flavours, orders, outputbundle
 from arkimapslib.config import Config
-from arkimapslib.render import Renderer
+from arkimapslib.costs import CostModel
+from arkimapslib.inputs import Input, InputFile, Instant
+from arkimapslib.recipes import Recipe
+from arkimapslib.render import BundleWriter, RenderGroup, Renderer, Scheduler
 
 
 class TestRender(unittest.TestCase):
@@ -60,3 +72,483 @@ class TestRender(unittest.TestCase):
                         " for details, and set PROJ_LIB=/usr/share/proj (or the"
                         " equivalent path in your system) as a workaround"
                     )
+
+
+class TestScheduler(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.config = Config()
+        self.flavour = flavours.Simple(config=self.config, name="flavour", defined_in="flavour.yaml", args={})
+        self.recipe = Recipe(
+            config=self.config,
+            name="recipe",
+            defined_in="recipe.yaml",
+            args={"recipe": [{"step": "add_basemap"}]},
+        )
+
+    def make_tiles(
+        self, count: int, w: int, h: int, input_files: Optional[Dict[str, InputFile]] = None
+    ) -> List[orders.Order]:
+        res: List[orders.Order] = []
+        for step in range(count):
+            res.append(
+                orders.TileOrder(
+                    flavour=self.flavour,
+                    recipe=self.recipe,
+                    input_files=input_files or {},
+                    instant=Instant(reftime=datetime.datetime(2023, 12, 15), step=step),
+                    z=6,
+                    x=32,
+                    y=22,
+                    w=w,
+                    h=h,
+                )
+            )
+        return res
+
+    def test_jobs(self):
+        self.assertGreaterEqual(Scheduler(self.config).max_tasks, 1)
+        self.config.render_jobs = 3
+        self.assertEqual(Scheduler(self.config).max_tasks, 3)
+
+    def test_expensive_first(self):
+        self.config.render_jobs = 1
+        scheduler = Scheduler(self.config)
+        small = RenderGroup(Path("small.py"), self.make_tiles(2, 1, 1))
+        large = RenderGroup(Path("large.py"), self.make_tiles(2, 4, 4))
+        scheduler.add(small)
+        scheduler.add(large)
+        self.assertGreater(large.cost, small.cost)
+
+        self.assertIs(scheduler.next_group([]), large)
+        # Only one job allowed
+        self.assertIsNone(scheduler.next_group([large]))
+        self.assertIs(scheduler.next_group([]), small)
+        self.assertIsNone(scheduler.next_group([]))
+
+    def test_memory_budget(self):
+        scheduler = Scheduler(self.config)
+        small = RenderGroup(Path("small.py"), self.make_tiles(1, 1, 1))
+        large = RenderGroup(Path("large.py"), self.make_tiles(1, 8, 8))
+        scheduler.add(small)
+        scheduler.add(large)
+
+        # A group is started even if it exceeds the budget, if nothing else is running
+        scheduler.memory_budget = large.memory - 1
+        self.assertIs(scheduler.next_group([]), large)
+        # The small group does not fit alongside the large one
+        self.assertIsNone(scheduler.next_group([large]))
+        self.assertIs(scheduler.next_group([]), small)
+
+    def test_learn(self):
+        scheduler = Scheduler(self.config)
+        tiles = self.make_tiles(2, 2, 2)
+        group = RenderGroup(Path("group.py"), tiles[1:])
+        scheduler.add(group)
+        # Groups of other recipes are not estimated again
+        other = self.make_tiles(1, 2, 2)[0]
+        other.recipe = Recipe(
+            config=self.config, name="other", defined_in="other.yaml", args={"recipe": [{"step": "add_basemap"}]}
+        )
+        other_group = RenderGroup(Path("other.py"), [other])
+        scheduler.add(other_group)
+        other_cost = other_group.cost
+        self.assertEqual(other_cost, scheduler.order_work(other) * scheduler.WORK_TIME_NS)
+
+        tiles[0].render_time_ns = 1000
+        scheduler.learn(tiles[:1])
+        self.assertEqual(group.cost, 1000)
+        self.assertEqual(other_group.cost, other_cost)
+
+    def test_group_orders(self):
+        self.config.orders_per_script = 4
+        scheduler = Scheduler(self.config)
+        large = self.make_tiles(2, 4, 4)
+        small = self.make_tiles(6, 1, 1)
+        groups = scheduler.group_orders(large + small)
+        self.assertEqual(len(groups), 2)
+        # Each large order ends up in a different group
+        for group in groups:
+            self.assertEqual(len([o for o in group if o.width == 4]), 1)
+            self.assertEqual(len(group), 4)
+        # Order is preserved inside groups
+        self.assertEqual(groups[0], [large[0]] + small[0::2])
+        self.assertEqual(groups[1], [large[1]] + small[1::2])
+
+    def test_cost_model(self):
+        history, cached = self.make_tiles(2, 2, 2)
+        history.set_output(orders.Output("order0", f"{history.recipe.name}/6/32-22-2-2.png", ""), timing=4000)
+        # Products taken from the render cache do not count in the render time
+        cached.set_output(orders.Output("cached", f"{cached.recipe.name}+1/6/32-22-2-2.png", ""))
+        cached.cached = True
+        products = outputbundle.Products()
+        products.add_order(history)
+        products.add_order(cached)
+        for reftime_products in products.products[outputbundle.ProductKey("flavour", "recipe")].reftimes.values():
+            self.assertEqual(len(reftime_products.products), 8)
+            self.assertEqual(reftime_products.render_stats.cached, 4)
+        cost_model = CostModel()
+        cost_model.add_products(products)
+        self.assertEqual(cost_model.product_cost("flavour", "recipe"), 1000)
+        self.assertIsNone(cost_model.product_cost("flavour", "other"))
+
+        # Load history from an output bundle
+        with tempfile.NamedTemporaryFile(suffix=".tar") as tf:
+            with outputbundle.TarWriter(out=tf) as bundle:
+                bundle.add_products(products)
+            tf.flush()
+            loaded = CostModel()
+            loaded.load(Path(tf.name))
+        self.assertEqual(loaded.product_cost("flavour", "recipe"), 1000)
+
+        scheduler = Scheduler(self.config, cost_model)
+        group = RenderGroup(Path("group.py"), self.make_tiles(2, 4, 4))
+        scheduler.add(group)
+        self.assertEqual(group.cost, 2 * 16 * 1000)
+
+    def test_group_by_inputs(self):
+        self.config.orders_per_script = 4
+        scheduler = Scheduler(self.config)
+        inp = Input.create(config=self.config, name="t2m", defined_in="memory", args={})
+        reftime = datetime.datetime(2023, 12, 15)
+        clusters = []
+        for step in (0, 12):
+            instant = Instant(reftime=reftime, step=step)
+            input_files = {"t2m": InputFile(Path(f"t2m+{step}.grib"), inp, instant)}
+            clusters.append(self.make_tiles(4, 1, 1, input_files=input_files))
+
+        # Interleave orders from the two steps
+        interleaved = [order for pair in zip(*clusters) for order in pair]
+        groups = scheduler.group_orders(interleaved)
+        self.assertCountEqual(groups, clusters)
+
+    def test_bundle_writer(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            workdir = Path(tempdir)
+            rendered = []
+            for idx in range(3):
+                order = orders.MapOrder(
+                    flavour=self.flavour,
+                    recipe=self.recipe,
+                    input_files={},
+                    instant=Instant(reftime=datetime.datetime(2023, 12, 15), step=idx),
+                )
+                relpath = f"recipe+{idx}.png"
+                (workdir / relpath).write_bytes(b"x" * 100)
+                order.set_output(orders.Output(f"order{idx}", relpath, ""))
+                rendered.append(order)
+
+            out = io.BytesIO()
+            bundle = outputbundle.TarWriter(out=out)
+            writer = BundleWriter(workdir, bundle, max_pending_bytes=150)
+
+            async def run():
+                writer.start()
+                for order in rendered:
+                    await writer.add(order)
+                    # Adding waits until there is room for more outputs
+                    self.assertLessEqual(writer.pending_bytes, 150)
+                await writer.stop()
+
+            with bundle:
+                asyncio.run(run())
+
+            self.assertEqual(writer.rendered, rendered)
+            self.assertEqual(writer.pending_bytes, 0)
+            out.seek(0)
+            with tarfile.open(fileobj=out) as tf:
+                self.assertEqual(sorted(tf.getnames()), ["recipe+0.png", "recipe+1.png", "recipe+2.png", "version.txt"])
+            self.assertEqual(os.listdir(workdir), [])
+
+    def test_bundle_writer_tiles(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            workdir = Path(tempdir)
+            order = self.make_tiles(1, 2, 2)[0]
+            relpath = "tiles/6/32-22-2-2.png"
+            (workdir / "tiles" / "6").mkdir(parents=True)
+            # Paint each tile with a different colour
+            rendered = Image.new("RGBA", (512, 512))
+            for x in range(2):
+                for y in range(2):
+                    rendered.paste((x * 100, y * 100, 50, 255), (x * 256, y * 256, (x + 1) * 256, (y + 1) * 256))
+            rendered.save(workdir / relpath)
+            order.set_output(orders.Output("tiles", relpath, ""))
+
+            out = io.BytesIO()
+            bundle = outputbundle.TarWriter(out=out)
+            writer = BundleWriter(workdir, bundle, max_pending_bytes=None, jobs=2)
+
+            async def run():
+                writer.start()
+                await writer.add(order)
+                await writer.stop()
+
+            with bundle:
+                asyncio.run(run())
+
+            self.assertEqual(writer.rendered, [order])
+            self.assertIsNone(writer.executor)
+            out.seek(0)
+            with tarfile.open(fileobj=out) as tf:
+                self.assertEqual(
+                    sorted(tf.getnames()),
+                    ["tiles/6/32/22.png", "tiles/6/32/23.png", "tiles/6/33/22.png", "tiles/6/33/23.png", "version.txt"],
+                )
+                for x in range(2):
+                    for y in range(2):
+                        data = tf.extractfile(f"tiles/6/{32 + x}/{22 + y}.png")
+                        assert data is not None
+                        with Image.open(data) as tile:
+                            self.assertEqual(tile.size, (256, 256))
+                            self.assertEqual(tile.mode, "RGBA")
+                            self.assertEqual(tile.getcolors(), [(256 * 256, (x * 100, y * 100, 50, 255))])
+            # The rendered cluster has been removed
+            self.assertEqual(list(workdir.rglob("*.png")), [])
+
+    def test_bundle_writer_tiles_dedup(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            workdir = Path(tempdir)
+            tiles = []
+            for idx, order in enumerate(self.make_tiles(2, 2, 1)):
+                order.dedup_uniform = True
+                relpath = f"tiles{idx}/6/32-22-2-1.png"
+                (workdir / relpath).parent.mkdir(parents=True)
+                # One transparent tile and one single colour tile
+                rendered = Image.new("RGBA", (512, 256), (0, 0, 0, 0))
+                rendered.paste((10, 20, 30, 255), (256, 0, 512, 256))
+                rendered.save(workdir / relpath)
+                order.set_output(orders.Output("tiles", relpath, ""))
+                tiles.append(order)
+
+            out = io.BytesIO()
+            bundle = outputbundle.TarWriter(out=out)
+            writer = BundleWriter(workdir, bundle, max_pending_bytes=None)
+
+            async def run():
+                writer.start()
+                for order in tiles:
+                    await writer.add(order)
+                await writer.stop()
+
+            products = outputbundle.Products()
+            with bundle:
+                asyncio.run(run())
+                for order in tiles:
+                    products.add_order(order)
+                bundle.add_products(products)
+
+            out.seek(0)
+            with tarfile.open(fileobj=out) as tf:
+                names = tf.getnames()
+            # Only one copy of the single colour tile is stored
+            shared = [name for name in names if name.startswith("shared/")]
+            self.assertEqual(len(shared), 1)
+            self.assertCountEqual(names, ["version.txt", "products.json"] + shared)
+            self.assertEqual(list(workdir.rglob("*.png")), [])
+
+            by_path = products.by_path
+            for idx in range(2):
+                self.assertTrue(by_path[f"tiles{idx}/6/32/22.png"].empty)
+                self.assertIsNone(by_path[f"tiles{idx}/6/32/22.png"].ref)
+                self.assertFalse(by_path[f"tiles{idx}/6/33/22.png"].empty)
+                self.assertEqual(by_path[f"tiles{idx}/6/33/22.png"].ref, shared[0])
+
+            # Readers load deduplicated tiles by their path
+            bundle_path = workdir / "bundle.tar"
+            bundle_path.write_bytes(out.getvalue())
+            with outputbundle.TarReader(bundle_path) as reader:
+                for idx in range(2):
+                    with Image.open(io.BytesIO(reader.load_product(f"tiles{idx}/6/32/22.png"))) as tile:
+                        self.assertEqual(tile.size, (256, 256))
+                        self.assertEqual(tile.convert("RGBA").getpixel((0, 0)), (0, 0, 0, 0))
+                    with Image.open(io.BytesIO(reader.load_product(f"tiles{idx}/6/33/22.png"))) as tile:
+                        self.assertEqual(tile.convert("RGBA").getpixel((0, 0)), (10, 20, 30, 255))
+                with self.assertRaises(KeyError):
+                    reader.load_product("tiles0/6/34/22.png")
+
+
+class TestTilePyramid(unittest.TestCase):
+    def test_reduce_tile(self):
+        pixels = numpy.zeros((2, 4, 4), dtype=numpy.uint8)
+        # One opaque red pixel in a transparent block
+        pixels[0, 0] = (255, 0, 0, 255)
+        # A block of opaque pixels with different colours
+        pixels[:, 2:] = (100, 0, 0, 255)
+        pixels[1, 3] = (200, 0, 0, 255)
+        reduced = orders.reduce_tile(pixels)
+        self.assertEqual(reduced.tolist(), [[[255, 0, 0, 64], [125, 0, 0, 255]]])
+
+    def test_add(self):
+        tiles = [(x, y) for x in range(4) for y in range(4)]
+        pyramid = orders.TilePyramid("tiles", 2, 0, tiles)
+        self.assertEqual(len(pyramid.expected), 5)
+
+        products: List[orders.BundleProduct] = []
+        for x, y in tiles:
+            pixels = numpy.full((256, 256, 4), (x * 10, y * 10, 0, 255), dtype=numpy.uint8)
+            products.extend(pyramid.add(2, x, y, pixels))
+
+        self.assertEqual(
+            [product.tile for product in products],
+            [(1, 0, 0), (1, 0, 1), (1, 1, 0), (1, 1, 1), (0, 0, 0)],
+        )
+        self.assertEqual(products[-1].path, "tiles/0/0/0.png")
+        self.assertEqual(pyramid.pending, {})
+
+        # Each lower level tile has its covered tiles in the right quadrant
+        assert products[0].data is not None
+        with Image.open(io.BytesIO(products[0].data)) as tile:
+            self.assertEqual(tile.getpixel((0, 0)), (0, 0, 0, 255))
+            self.assertEqual(tile.getpixel((128, 0)), (10, 0, 0, 255))
+            self.assertEqual(tile.getpixel((0, 128)), (0, 10, 0, 255))
+            self.assertEqual(tile.getpixel((255, 255)), (10, 10, 0, 255))
+
+    def test_flush(self):
+        tiles = [(x, y) for x in range(4) for y in range(4)]
+        pyramid = orders.TilePyramid("tiles", 2, 0, tiles)
+        self.assertEqual(pyramid.flush(), [])
+
+        # The tiles of one quadrant fail to render
+        products: List[orders.BundleProduct] = []
+        for x, y in tiles:
+            if x >= 2 and y >= 2:
+                continue
+            pixels = numpy.full((256, 256, 4), (10, 20, 30, 255), dtype=numpy.uint8)
+            products.extend(pyramid.add(2, x, y, pixels))
+        self.assertEqual([product.tile for product in products], [(1, 0, 0), (1, 0, 1), (1, 1, 0)])
+        self.assertEqual(list(pyramid.pending), [(0, 0, 0)])
+
+        with self.assertLogs(level="WARNING"):
+            products = pyramid.flush()
+        self.assertEqual([product.tile for product in products], [(0, 0, 0)])
+        self.assertEqual(pyramid.pending, {})
+
+        # The missing quadrant is transparent
+        assert products[0].data is not None
+        with Image.open(io.BytesIO(products[0].data)) as tile:
+            self.assertEqual(tile.getpixel((0, 0)), (10, 20, 30, 255))
+            self.assertEqual(tile.getpixel((255, 255)), (0, 0, 0, 0))
+
+    def test_make_orders(self):
+        config = Config()
+        flavour = flavours.Simple(config=config, name="flavour", defined_in="flavour.yaml", args={})
+        recipe = Recipe(
+            config=config, name="recipe", defined_in="recipe.yaml", args={"recipe": [{"step": "add_basemap"}]}
+        )
+        kwargs = {
+            "flavour": flavour,
+            "recipe": recipe,
+            "input_files": {},
+            "instant": Instant(reftime=datetime.datetime(2023, 12, 15), step=12),
+            "lat_min": 43.0,
+            "lat_max": 47.0,
+            "lon_min": 6.0,
+            "lon_max": 14.0,
+            "zoom_min": 3,
+            "zoom_max": 6,
+        }
+        tiles = list(orders.TileOrder.make_orders(pyramid_zoom=5, **kwargs))
+        self.assertEqual({order.z for order in tiles}, {5, 6})
+        pyramids = {id(order.pyramid) for order in tiles if order.z == 5}
+        self.assertEqual(len(pyramids), 1)
+        self.assertTrue(all(order.pyramid is None for order in tiles if order.z == 6))
+        self.assertEqual({key[0] for key in tiles[0].pyramid.expected}, {3, 4})
+
+        with self.assertRaisesRegex(RuntimeError, "outside of zoom levels"):
+            list(orders.TileOrder.make_orders(pyramid_zoom=7, **kwargs))
+
+    def test_bundle(self):
+        config = Config()
+        flavour = flavours.Simple(config=config, name="flavour", defined_in="flavour.yaml", args={})
+        recipe = Recipe(
+            config=config, name="recipe", defined_in="recipe.yaml", args={"recipe": [{"step": "add_basemap"}]}
+        )
+        instant = Instant(reftime=datetime.datetime(2023, 12, 15), step=12)
+        pyramid = orders.TilePyramid("tiles", 1, 0, [(x, y) for x in range(2) for y in range(2)])
+        order = orders.TileOrder(
+            flavour=flavour, recipe=recipe, input_files={}, instant=instant, z=1, x=0, y=0, w=2, h=2, pyramid=pyramid
+        )
+
+        with tempfile.TemporaryDirectory() as tempdir:
+            workdir = Path(tempdir)
+            relpath = "tiles/1/0-0-2-2.png"
+            (workdir / "tiles" / "1").mkdir(parents=True)
+            Image.new("RGBA", (512, 512), (10, 20, 30, 255)).save(workdir / relpath)
+            order.set_output(orders.Output("tiles", relpath, ""))
+
+            out = io.BytesIO()
+            bundle = outputbundle.TarWriter(out=out)
+            writer = BundleWriter(workdir, bundle, max_pending_bytes=None)
+
+            async def run():
+                writer.start()
+                await writer.add(order)
+                await writer.stop()
+
+            with bundle:
+                asyncio.run(run())
+
+            out.seek(0)
+            with tarfile.open(fileobj=out) as tf:
+                self.assertCountEqual(
+                    tf.getnames(),
+                    [
+                        "version.txt",
+                        "tiles/1/0/0.png",
+                        "tiles/1/0/1.png",
+                        "tiles/1/1/0.png",
+                        "tiles/1/1/1.png",
+                        "tiles/0/0/0.png",
+                    ],
+                )
+            self.assertEqual(list(workdir.rglob("*.png")), [])
+
+        products = outputbundle.Products()
+        products.add_order(order)
+        georef = products.by_path["tiles/0/0/0.png"].georef
+        assert georef is not None
+        self.assertEqual(georef["epsg"], 3857)
+        self.assertAlmostEqual(georef["bbox"][0], -180.0)
+        self.assertAlmostEqual(georef["bbox"][2], 180.0)
+
+    def test_bundle_incomplete(self):
+        config = Config()
+        flavour = flavours.Simple(config=config, name="flavour", defined_in="flavour.yaml", args={})
+        recipe = Recipe(
+            config=config, name="recipe", defined_in="recipe.yaml", args={"recipe": [{"step": "add_basemap"}]}
+        )
+        instant = Instant(reftime=datetime.datetime(2023, 12, 15), step=12)
+        pyramid = orders.TilePyramid("tiles", 1, 0, [(x, y) for x in range(2) for y in range(2)])
+        # Only the left half of the tiles is rendered
+        order = orders.TileOrder(
+            flavour=flavour, recipe=recipe, input_files={}, instant=instant, z=1, x=0, y=0, w=1, h=2, pyramid=pyramid
+        )
+
+        with tempfile.TemporaryDirectory() as tempdir:
+            workdir = Path(tempdir)
+            relpath = "tiles/1/0-0-1-2.png"
+            (workdir / "tiles" / "1").mkdir(parents=True)
+            Image.new("RGBA", (256, 512), (10, 20, 30, 255)).save(workdir / relpath)
+            order.set_output(orders.Output("tiles", relpath, ""))
+
+            out = io.BytesIO()
+            bundle = outputbundle.TarWriter(out=out)
+            writer = BundleWriter(workdir, bundle, max_pending_bytes=None)
+
+            async def run():
+                writer.start()
+                await writer.add(order)
+                await writer.stop()
+
+            with bundle, self.assertLogs(level="WARNING"):
+                asyncio.run(run())
+
+            out.seek(0)
+            with tarfile.open(fileobj=out) as tf:
+                self.assertCountEqual(
+                    tf.getnames(), ["version.txt", "tiles/1/0/0.png", "tiles/1/0/1.png", "tiles/0/0/0.png"]
+                )
+
+        products = outputbundle.Products()
+        products.add_order(order)
+        self.assertIn("tiles/0/0/0.png", products.by_path)
@@ -0,0 +1,59 @@
+# from __future__ import annotations
+import datetime
+import tempfile
+import unittest
+from pathlib import Path
+
+from arkimapslib import flavours, orders
+from arkimapslib.config import Config
+from arkimapslib.inputs import Instant
+from arkimapslib.recipes import Recipe
+from arkimapslib.rendercache import RenderCache
+
+
+class TestRenderCache(unittest.TestCase):
+    def setUp(self):
+        super().setUp()
+        self.config = Config()
+        self.flavour = flavours.Simple(config=self.config, name="flavour", defined_in="flavour.yaml", args={})
+        self.recipe = Recipe(
+            config=self.config,
+            name="recipe",
+            defined_in="recipe.yaml",
+            args={"recipe": [{"step": "add_basemap"}]},
+        )
+
+    def make_order(self) -> orders.Order:
+        return orders.MapOrder(
+            flavour=self.flavour,
+            recipe=self.recipe,
+            input_files={},
+            instant=Instant(reftime=datetime.datetime(2023, 12, 15), step=12),
+        )
+
+    def test_store_lookup(self):
+        with tempfile.TemporaryDirectory() as cachedir, tempfile.TemporaryDirectory() as workdir:
+            cache = RenderCache(Path(cachedir))
+
+            order = self.make_order()
+            self.assertFalse(cache.lookup(order, Path(workdir)))
+            self.assertEqual(cache.misses, 1)
+
+            # Simulate rendering
+            relpath = "2023-12-15T00:00:00/recipe_flavour/recipe+012.png"
+            (Path(workdir) / relpath).parent.mkdir(parents=True)
+            (Path(workdir) / relpath).write_bytes(b"PNG")
+            order.set_output(orders.Output("order0", relpath, "magics output"))
+            cache.store(order, Path(workdir))
+            (Path(workdir) / relpath).unlink()
+
+            # A new order with the same inputs is found in the cache
+            order = self.make_order()
+            self.assertTrue(cache.lookup(order, Path(workdir)))
+            self.assertEqual(cache.hits, 1)
+            self.assertTrue(order.cached)
+            self.assertEqual(order.render_time_ns, 0)
+            assert order.output is not None
+            self.assertEqual(order.output.relpath, relpath)
+            self.assertEqual(order.output.magics_output, "magics output")
+            self.assertEqual((Path(workdir) / relpath).read_bytes(), b"PNG")